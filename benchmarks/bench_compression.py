@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the tunnel dispatcher wire compression. Encodes typical payloads
+as they would be sent over the tunnel and reports the compressed size, the time
+spent compressing and decompressing, and the resulting transfer time on links
+of different bandwidths.
+
+Usage: python benchmarks/bench_compression.py [iterations]
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+from typing import Any, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+# pylint: disable=wrong-import-position,protected-access
+import fora
+import fora.connectors.tunnel_dispatcher as td
+
+LINKS = [("1 Mbit/s", 1e6 / 8), ("10 Mbit/s", 10e6 / 8), ("100 Mbit/s", 100e6 / 8), ("1 Gbit/s", 1e9 / 8)]
+
+def _config() -> bytes:
+    """A typical configuration file."""
+    lines = []
+    for i in range(400):
+        lines.append(f"# Settings for worker {i}\n[worker.{i}]\nenabled = true\nthreads = {i % 8 + 1}\nlog_level = info\nsocket = /run/app/worker-{i}.sock\n\n")
+    return "".join(lines).encode()
+
+def _process_output() -> bytes:
+    """Typical output of a package manager."""
+    return b"".join(f"Unpacking libexample{i}:amd64 (1.{i}.0-1) ...\nSetting up libexample{i}:amd64 (1.{i}.0-1) ...\n".encode() for i in range(2000))
+
+def _source() -> bytes:
+    """A python source file (the dispatcher itself)."""
+    with open(td.__file__, 'rb') as f:
+        return f.read()
+
+PAYLOADS = [
+    ("config upload", lambda: td.PacketUpload(file="/etc/app/workers.conf", content=_config(), mode="644")),
+    ("source upload", lambda: td.PacketUpload(file="/opt/app/dispatcher.py", content=_source(), mode="644")),
+    ("process output", lambda: td.PacketProcessCompleted(stdout=_process_output(), stderr=b"", returncode=td.i32(0))),
+    ("random chunk", lambda: td.PacketUploadChunk(stream=td.u32(1), data=os.urandom(1 << 20))),
+]
+
+def encode(packet: Any, algorithm: Optional[str]) -> bytes:
+    """Writes the packet as it would be sent over a connection with the given compression."""
+    out = io.BytesIO()
+    conn = td.Connection(io.BytesIO(), out)
+    conn.compressor.algorithm = algorithm
+    conn.write_packet(packet)
+    return out.getvalue()
+
+def decode(data: bytes) -> Any:
+    """Reads a packet from the given data."""
+    return td.receive_packet(td.Connection(io.BytesIO(data), io.BytesIO()))
+
+def measure(func: Any, iterations: int) -> float:
+    """Returns the best time of the given function in seconds."""
+    best = float("inf")
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def main() -> None:
+    """Runs the benchmark."""
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    fora.args = argparse.Namespace(debug=False)
+    algorithms: list[Optional[str]] = [None] + sorted(td.compression_algorithms)
+    print(f"{'payload':<16} {'algorithm':<6} {'size':>10} {'ratio':>6} {'encode':>10} {'decode':>10}  " + " ".join(f"{name:>10}" for name, _ in LINKS))
+    for name, make in PAYLOADS:
+        packet = make()
+        raw_size = len(encode(packet, None))
+        for algorithm in algorithms:
+            data = encode(packet, algorithm)
+            assert decode(data) == packet
+            t_encode = measure(lambda p=packet, a=algorithm: encode(p, a), iterations)
+            t_decode = measure(lambda d=data: decode(d), iterations)
+            transfer = " ".join(f"{(t_encode + t_decode + len(data) / bandwidth) * 1e3:>7.1f} ms" for _, bandwidth in LINKS)
+            print(f"{name:<16} {algorithm or 'none':<6} {len(data):>10} {raw_size / len(data):>5.1f}x {t_encode * 1e3:>7.2f} ms {t_decode * 1e3:>7.2f} ms  {transfer}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the tunnel connection layer on the local and the in-process
+connector. Measures the rate of small request/response round trips, both
+sequential and pipelined, and the throughput of large uploads and downloads.
+
+Usage: python benchmarks/bench_connection.py [payload_mib]
+"""
+
+import argparse
+import functools
+import io
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, cast
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+# pylint: disable=wrong-import-position,protected-access
+import fora
+import fora.connectors.tunnel_dispatcher as td
+from fora.connectors.inproc import InprocConnector
+from fora.connectors.local import LocalConnector
+from fora.connectors.tunnel_connector import TunnelConnector
+
+def measure(func: Callable[[], Any], iterations: int = 3) -> float:
+    """Returns the best time of the given function in seconds."""
+    best = float("inf")
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def create(cls: type[TunnelConnector]) -> TunnelConnector:
+    """Creates a connector of the given type for the local machine."""
+    url = f"{cls.schema}:"
+    return cls(url, cast(Any, SimpleNamespace(name="localhost", url=url)))
+
+def connect(cls: type[TunnelConnector]) -> None:
+    """Opens and closes a connection."""
+    connector = create(cls)
+    connector.open()
+    connector.close()
+
+def run(connector: TunnelConnector, payload_size: int) -> None:
+    """Runs the benchmark on the given connector."""
+    connector.open()
+    try:
+        requests = 5000
+        t = measure(lambda: [connector.stat("/") for _ in range(requests)])
+        print(f"{'sequential stat':<20} {requests / t:>10.0f} requests/s")
+
+        def pipelined() -> None:
+            with connector.pipeline():
+                for _ in range(requests):
+                    connector._request_deferred(td.PacketStat(path="/"), lambda _: None)
+        t = measure(pipelined)
+        print(f"{'pipelined stat':<20} {requests / t:>10.0f} requests/s")
+
+        content = os.urandom(payload_size)
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, "payload")
+            t = measure(lambda: connector.upload(file, content))
+            print(f"{'upload':<20} {payload_size / t / 1e6:>10.0f} MB/s")
+            t = measure(lambda: connector.download(file))
+            print(f"{'download':<20} {payload_size / t / 1e6:>10.0f} MB/s")
+            t = measure(lambda: connector.upload_stream(file, io.BytesIO(content)))
+            print(f"{'streaming upload':<20} {payload_size / t / 1e6:>10.0f} MB/s")
+            t = measure(lambda: b"".join(connector.download_stream(file)))
+            print(f"{'streaming download':<20} {payload_size / t / 1e6:>10.0f} MB/s")
+    finally:
+        connector.close()
+
+def main() -> None:
+    """Runs the benchmark."""
+    payload_size = (int(sys.argv[1]) if len(sys.argv) > 1 else 256) << 20
+    fora.args = argparse.Namespace(debug=False, no_color=True)
+    for cls in (LocalConnector, InprocConnector):
+        print(f"{cls.schema}:")
+        t = measure(functools.partial(connect, cls), iterations=10)
+        print(f"{'open and close':<20} {t * 1000:>10.2f} ms")
+        run(create(cls), payload_size)
+
+if __name__ == "__main__":
+    main()
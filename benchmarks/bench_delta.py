@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark for delta uploads. Creates a synthetic random file and a copy of it
+with 1% churn (mostly in-place edits, with some insertions and deletions),
+then measures the time to calculate the remote block checksums and the delta,
+verifies that the delta reconstructs the new file, and compares the amount
+of transferred data and the resulting transfer time with a full upload.
+
+Usage: python benchmarks/bench_delta.py [size_in_mib] [churn_percent]
+"""
+
+import argparse
+import hashlib
+import io
+import mmap
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+# pylint: disable=wrong-import-position
+import fora
+import fora.connectors.tunnel_dispatcher as td
+from fora.connectors import delta
+
+LINKS = [("10 Mbit/s", 10e6 / 8), ("100 Mbit/s", 100e6 / 8), ("1 Gbit/s", 1e9 / 8)]
+EDIT_SIZE = 4096
+
+def create_files(directory: str, size: int, churn: float) -> tuple[str, str]:
+    """Creates the basis file and the edited file."""
+    basis_path = os.path.join(directory, "basis")
+    with open(basis_path, "wb") as f:
+        for offset in range(0, size, 64 << 20):
+            f.write(os.urandom(min(64 << 20, size - offset)))
+
+    rng = random.Random(0)
+    edits = sorted(rng.randrange(size) for _ in range(int(size * churn / EDIT_SIZE)))
+    new_path = os.path.join(directory, "new")
+    with open(basis_path, "rb") as src, open(new_path, "wb") as dst:
+        pos = 0
+        for edit in edits:
+            if edit < pos:
+                continue
+            dst.write(src.read(edit - pos))
+            kind = rng.random()
+            if kind < 0.8:
+                # In-place edit
+                dst.write(os.urandom(EDIT_SIZE))
+                src.seek(EDIT_SIZE, io.SEEK_CUR)
+            elif kind < 0.9:
+                # Insertion
+                dst.write(os.urandom(EDIT_SIZE))
+            else:
+                # Deletion
+                src.seek(EDIT_SIZE, io.SEEK_CUR)
+            pos = src.tell()
+        while chunk := src.read(64 << 20):
+            dst.write(chunk)
+    return (basis_path, new_path)
+
+def main() -> None:
+    """Runs the benchmark."""
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 1024) << 20
+    churn = (float(sys.argv[2]) if len(sys.argv) > 2 else 1.0) / 100
+    fora.args = argparse.Namespace(debug=False)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"creating {size >> 20} MiB files with {churn * 100:g}% churn ...")
+        basis_path, new_path = create_files(directory, size, churn)
+        new_size = os.path.getsize(new_path)
+        block_size = delta.block_size(new_size)
+
+        # Remote side: block checksums
+        t0 = time.perf_counter()
+        out = io.BytesIO()
+        td.PacketChecksumBlocks(file=basis_path, block_size=td.u32(block_size)).handle(td.Connection(io.BytesIO(), out))
+        t_checksums = time.perf_counter() - t0
+        checksums = td.receive_packet(td.Connection(io.BytesIO(out.getvalue()), io.BytesIO()))
+
+        # Local side: digest and delta
+        with open(new_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as data:
+            t0 = time.perf_counter()
+            sha512sum = hashlib.sha512(data).digest()
+            ops = list(delta.compute_delta(data, checksums.size, block_size, checksums.weak, checksums.strong))
+            t_delta = time.perf_counter() - t0
+
+            # Verify by reconstructing the new file from the basis
+            sha512 = hashlib.sha512()
+            with open(basis_path, "rb") as basis:
+                for op in ops:
+                    if isinstance(op, delta.DeltaCopy):
+                        sha512.update(os.pread(basis.fileno(), op.length, op.offset))
+                    else:
+                        sha512.update(data[op.start:op.end])
+            assert sha512.digest() == sha512sum
+
+        literal = sum(op.end - op.start for op in ops if isinstance(op, delta.DeltaLiteral))
+        copies = sum(1 for op in ops if isinstance(op, delta.DeltaCopy))
+        wire_delta = len(out.getvalue()) + literal + len(ops) * 32
+        wire_full = new_size
+
+        print(f"block size        {block_size} bytes, {len(checksums.weak) // 4} blocks")
+        print(f"checksums         {len(out.getvalue()) / 1e6:>10.2f} MB in {t_checksums:.2f} s (remote)")
+        print(f"delta             {literal / 1e6:>10.2f} MB literal, {copies} copies in {t_delta:.2f} s (local)")
+        print(f"transferred       {wire_delta / 1e6:>10.2f} MB delta vs {wire_full / 1e6:.2f} MB full upload ({wire_full / wire_delta:.1f}x less)")
+        for name, bandwidth in LINKS:
+            t_full = wire_full / bandwidth
+            t_with_delta = t_checksums + t_delta + wire_delta / bandwidth
+            print(f"{name:<17} {t_full:>8.1f} s full upload, {t_with_delta:>8.1f} s delta upload")
+
+if __name__ == "__main__":
+    main()
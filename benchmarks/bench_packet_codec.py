@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the tunnel dispatcher packet codecs. Compares the generic,
+annotation-walking (de)serialization with the precompiled per-packet codecs
+for typical request and response packets.
+
+Usage: python benchmarks/bench_packet_codec.py [iterations]
+"""
+
+import io
+import os
+import sys
+import timeit
+from typing import Any
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+# pylint: disable=wrong-import-position,protected-access
+import fora.connectors.tunnel_dispatcher as td
+
+def generic_encode(packet: Any) -> bytes:
+    """Encodes the packet field by field via the generic serializer."""
+    out = io.BytesIO()
+    conn = td.Connection(io.BytesIO(), out)
+    cls = type(packet)
+    td._serialize(conn, td.u32, td.packets.index(cls))
+    for f in cls._fields:
+        td._serialize(conn, cls.__annotations__[f], getattr(packet, f))
+    return out.getvalue()
+
+def generic_decode(cls: Any, data: bytes) -> Any:
+    """Decodes the packet field by field via the generic deserializer."""
+    conn = td.Connection(io.BytesIO(data), io.BytesIO())
+    td._deserialize(conn, td.u32)
+    return cls(**{f: td._deserialize(conn, cls.__annotations__[f]) for f in cls._fields})
+
+def compiled_encode(packet: Any) -> bytes:
+    """Encodes the packet with its precompiled encoder."""
+    return packet._encode()
+
+def compiled_decode(cls: Any, data: bytes) -> Any:
+    """Decodes the packet with its precompiled decoder."""
+    conn = td.Connection(io.BytesIO(data), io.BytesIO())
+    td._struct_u32.unpack(conn.read(4))
+    return td.packet_deserializers[td.packets.index(cls)](conn)
+
+PACKETS = [
+    td.PacketStat(path="/etc/fora/some/managed/file.conf", follow_links=False, sha512sum=True),
+    td.PacketStatResult(type="file", mode=0o644, owner="root", group="root", size=4096,
+                        mtime=1654300000000000000, ctime=1654300000000000000, sha512sum=os.urandom(64)),
+    td.PacketProcessRun(command=["chown", "root:root", "--", "/etc/fora/some/managed/file.conf"],
+                        stdin=None, capture_output=True, user="root", group="root", umask="077", cwd="/tmp"),
+    td.PacketProcessCompleted(stdout=b"", stderr=b"", returncode=0),
+]
+
+def main() -> None:
+    """Runs the benchmark."""
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print(f"{'packet':<24} {'op':<7} {'generic':>12} {'compiled':>12} {'speedup':>8}")
+    for packet in PACKETS:
+        cls = type(packet)
+        data = compiled_encode(packet)
+        assert data == generic_encode(packet)
+        assert compiled_decode(cls, data) == generic_decode(cls, data) == packet
+
+        for op, generic, compiled in [
+                ("encode", lambda p=packet: generic_encode(p), lambda p=packet: compiled_encode(p)),
+                ("decode", lambda c=cls, d=data: generic_decode(c, d), lambda c=cls, d=data: compiled_decode(c, d))]:
+            t_generic = min(timeit.repeat(generic, number=iterations, repeat=3)) / iterations
+            t_compiled = min(timeit.repeat(compiled, number=iterations, repeat=3)) / iterations
+            print(f"{cls.__name__:<24} {op:<7} {t_generic * 1e6:>9.2f} µs {t_compiled * 1e6:>9.2f} µs {t_generic / t_compiled:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,10 @@
 from __future__ import annotations
 
 import argparse
-from typing import TYPE_CHECKING, cast
+import sys
+from contextvars import ContextVar
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, cast
 
 if TYPE_CHECKING:
     from fora.types import GroupWrapper, HostWrapper, ScriptWrapper
@@ -22,6 +25,10 @@ The inventory module we are operating on.
 This is loaded from the inventory definition file.
 """
 
+# The variables below describe the current execution state. They are local to the current
+# context (see `contextvars`), so that hosts can be executed concurrently in threads or
+# asyncio tasks. Reading and assigning them as module attributes still works as usual.
+
 group: GroupWrapper = cast("GroupWrapper", None)
 """
 This variable wraps the currently loaded group module.
@@ -38,3 +45,33 @@ but inside the definition (source) of the actual module or inside of a script.
 
 script: ScriptWrapper = cast("ScriptWrapper", None) # Cast None to ease typechecking in user code.
 """This variable wraps the currently executed script module (if any)."""
+
+class _ContextAttribute:
+    """
+    A module attribute that is local to the current context. Contexts in which it was never assigned,
+    such as the initially empty context of a new thread, see the value assigned in the main context
+    (see `fora.utils.is_main_context`), just like a plain module attribute. Assignments in other
+    contexts, such as those of hosts running in lockstep or of asyncio tasks, are never visible outside of them.
+    """
+
+    def __init__(self, name: str):
+        self.var: ContextVar[Any] = ContextVar(name)
+        self.main_value: Any = None
+
+    def __get__(self, obj: Any, objtype: Any = None) -> Any:
+        return self.var.get(self.main_value)
+
+    def __set__(self, obj: Any, value: Any) -> None:
+        from fora.utils import is_main_context # pylint: disable=import-outside-toplevel,cyclic-import
+        self.var.set(value)
+        if is_main_context():
+            self.main_value = value
+
+class _ContextModule(ModuleType):
+    """The type of this module, which resolves the context-local attributes."""
+    group = _ContextAttribute("group")
+    host = _ContextAttribute("host")
+    script = _ContextAttribute("script")
+
+del group, host, script
+sys.modules[__name__].__class__ = _ContextModule
@@ -4,17 +4,48 @@ Stores state along with the connection.
 """
 
 from __future__ import annotations
+import asyncio
+import io
+import os
+import stat
+import tempfile
+from contextlib import contextmanager
 from copy import copy
 
 from types import TracebackType
-from typing import Type, cast, Optional
+from typing import BinaryIO, Callable, ContextManager, Generator, Iterable, Iterator, Type, Union, cast, Optional
 
 import fora
 from fora import logger
+from fora.connectors.async_tunnel_connector import AsyncTunnelConnector
 from fora.connectors.connector import Connector, CompletedRemoteCommand, GroupEntry, StatResult, UserEntry
+from fora.connectors.inproc import InprocConnector
+from fora.connectors.tunnel_connector import TunnelConnector
 from fora.remote_settings import RemoteSettings
 from fora.types import HostWrapper
 
+def _read_umask() -> int:
+    """Reads the umask of this process by briefly changing it, which affects files created concurrently by other threads."""
+    umask = os.umask(0o077)
+    os.umask(umask)
+    return umask
+
+_initial_umask = _read_umask()
+"""The umask of this process when this module was imported, before any hosts were run concurrently."""
+
+def _current_umask() -> int:
+    """Returns the umask of this process without changing it, which is possible on Linux 4.7 and later.
+    Otherwise, returns the umask of this process when this module was imported."""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    return _initial_umask
+
+# pylint: disable=too-many-public-methods
 class Connection:
     """
     The connection class represents a connection to a host.
@@ -27,6 +58,7 @@ class Connection:
         self.host = host
         self.connector: Connector = self.host.create_connector()
         self.base_settings: RemoteSettings = copy(self.host.inventory.base_remote_settings())
+        self._prefetched_stats: dict[tuple[str, bool, bool], Optional[StatResult]] = {}
 
     def __enter__(self) -> Connection:
         self.connector.open()
@@ -84,10 +116,18 @@ class Connection:
             except ValueError:
                 raise ValueError(f"Error while resolving settings: {name} is '{mask}' but must be octal!") # pylint: disable=raise-missing-from
 
-        settings.as_user  =  None if settings.as_user  is None else self.resolve_user(settings.as_user)
-        settings.as_group =  None if settings.as_group is None else self.resolve_group(settings.as_group)
-        settings.owner    =  None if settings.owner    is None else self.resolve_user(settings.owner)
-        settings.group    =  None if settings.group    is None else self.resolve_group(settings.group)
+        # Resolve all users and groups in one exchange each
+        def resolve_all(values: list[Optional[str]], resolve_many: Callable[[list[Optional[str]]], list[Optional[str]]], field: str) -> list[Optional[str]]:
+            to_resolve: list[Optional[str]] = [v for v in values if v is not None]
+            resolved = iter(resolve_many(to_resolve) if len(to_resolve) > 0 else [])
+            names = [None if v is None else next(resolved) for v in values]
+            for value, name in zip(values, names):
+                if value is not None and name is None:
+                    raise ValueError(f"Invalid value '{value}' given for field '{field}': The {field} does not exist")
+            return names
+
+        settings.as_user, settings.owner = resolve_all([settings.as_user, settings.owner], self.resolve_user_many, "user")
+        settings.as_group, settings.group = resolve_all([settings.as_group, settings.group], self.resolve_group_many, "group")
         check_mask(settings.file_mode, "file_mode")
         check_mask(settings.dir_mode, "dir_mode")
         check_mask(settings.umask, "umask")
@@ -100,17 +140,40 @@ class Connection:
 
         return settings
 
+    def pipeline(self) -> ContextManager[None]:
+        """See `fora.connectors.connector.Connector.pipeline`."""
+        return self.connector.pipeline()
+
     def run(self,
             command: list[str],
-            input: Optional[bytes] = None, # pylint: disable=redefined-builtin
+            input: Union[None, bytes, Iterable[bytes]] = None, # pylint: disable=redefined-builtin
             capture_output: bool = True,
             check: bool = True,
             user: Optional[str] = None,
             group: Optional[str] = None,
             umask: Optional[str] = None,
-            cwd: Optional[str] = None) -> CompletedRemoteCommand:
-        """See `fora.connectors.connector.Connector.run`."""
+            cwd: Optional[str] = None,
+            on_output: Optional[Callable[[int, bytes], None]] = None) -> CompletedRemoteCommand:
+        """
+        See `fora.connectors.connector.Connector.run`.
+
+        If on_output is given, the command is run via `Connection.run_stream` and the callback
+        is called with the file descriptor (1 for stdout, 2 for stderr) and the data of each chunk
+        of output as soon as it is received. The output is then not captured, regardless of capture_output,
+        and the input may also be given as an iterable of chunks.
+        """
         logger.debug_args("Connection.run", locals())
+        if on_output is not None:
+            stream = self.run_stream(command=command, input=input, check=check, user=user, group=group, umask=umask, cwd=cwd)
+            while True:
+                try:
+                    fd, data = next(stream)
+                except StopIteration as e:
+                    return cast(CompletedRemoteCommand, e.value)
+                on_output(fd, data)
+
+        if input is not None and not isinstance(input, bytes):
+            input = b"".join(input)
         defaults = fora.script.current_defaults()
         return self.connector.run(
             command=command,
@@ -122,6 +185,26 @@ class Connection:
             umask=umask if umask is not None else defaults.umask,
             cwd=cwd if cwd is not None else defaults.cwd)
 
+    def run_stream(self,
+                   command: list[str],
+                   input: Union[None, bytes, Iterable[bytes]] = None, # pylint: disable=redefined-builtin
+                   check: bool = True,
+                   user: Optional[str] = None,
+                   group: Optional[str] = None,
+                   umask: Optional[str] = None,
+                   cwd: Optional[str] = None) -> Generator[tuple[int, bytes], None, CompletedRemoteCommand]:
+        """See `fora.connectors.connector.Connector.run_stream`."""
+        logger.debug_args("Connection.run_stream", locals())
+        defaults = fora.script.current_defaults()
+        return self.connector.run_stream(
+            command=command,
+            input=input,
+            check=check,
+            user=user if user is not None else defaults.as_user,
+            group=group if group is not None else defaults.as_group,
+            umask=umask if umask is not None else defaults.umask,
+            cwd=cwd if cwd is not None else defaults.cwd)
+
     def resolve_user(self, user: Optional[str]) -> str:
         """See `fora.connectors.connector.Connector.resolve_user`."""
         logger.debug_args("Connection.resolve_user", locals())
@@ -132,34 +215,190 @@ class Connection:
         logger.debug_args("Connection.resolve_group", locals())
         return self.connector.resolve_group(group)
 
+    def resolve_user_many(self, users: list[Optional[str]]) -> list[Optional[str]]:
+        """See `fora.connectors.connector.Connector.resolve_user_many`."""
+        logger.debug_args("Connection.resolve_user_many", locals())
+        return self.connector.resolve_user_many(users)
+
+    def resolve_group_many(self, groups: list[Optional[str]]) -> list[Optional[str]]:
+        """See `fora.connectors.connector.Connector.resolve_group_many`."""
+        logger.debug_args("Connection.resolve_group_many", locals())
+        return self.connector.resolve_group_many(groups)
+
     def stat(self, path: str, follow_links: bool = False, sha512sum: bool = False) -> Optional[StatResult]:
         """See `fora.connectors.connector.Connector.stat`."""
         logger.debug_args("Connection.stat", locals())
+        key = (path, follow_links, sha512sum)
+        if key in self._prefetched_stats:
+            return self._prefetched_stats.pop(key)
         return self.connector.stat(
             path=path,
             follow_links=follow_links,
             sha512sum=sha512sum)
 
+    def stat_many(self, paths: list[str], follow_links: bool = False, sha512sum: bool = False) -> list[Optional[StatResult]]:
+        """See `fora.connectors.connector.Connector.stat_many`."""
+        logger.debug_args("Connection.stat_many", locals())
+        return self.connector.stat_many(
+            paths=paths,
+            follow_links=follow_links,
+            sha512sum=sha512sum)
+
+    @contextmanager
+    def prefetch_stat(self, paths: list[str], follow_links: bool = False, sha512sum: bool = False) -> Iterator[None]:
+        """
+        Stats all given paths in a single exchange and serves the next call to
+        `Connection.stat` for each of these paths (with the same arguments) from the
+        prefetched results while the context is active. Each prefetched result is
+        consumed on first use, so a repeated stat of the same path queries the remote
+        again. This allows operations that are executed in a loop to avoid one round trip per path.
+
+        Parameters
+        ----------
+        paths
+            The paths to stat.
+        follow_links
+            Whether to follow symbolic links instead of running stat on the link.
+        sha512sum
+            Whether to include the sha512sum for each path that is a file.
+
+        Raises
+        ------
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails for any reason other than file not found.
+        IOError
+            An error occurred with the connection.
+        """
+        results = self.stat_many(paths=paths, follow_links=follow_links, sha512sum=sha512sum)
+        for path, result in zip(paths, results):
+            self._prefetched_stats[(path, follow_links, sha512sum)] = result
+        try:
+            yield
+        finally:
+            self._prefetched_stats.clear()
+
     def upload(self,
             file: str,
-            content: bytes,
+            content: Union[bytes, str, os.PathLike, BinaryIO],
             mode: Optional[str] = None,
             owner: Optional[str] = None,
             group: Optional[str] = None) -> None:
-        """See `fora.connectors.connector.Connector.upload`."""
+        """
+        See `fora.connectors.connector.Connector.upload`. A str is uploaded as utf-8 encoded content,
+        just like in `fora.operations.files.upload_content`. Instead of the content itself, a local file path
+        (any `os.PathLike`, such as a `pathlib.Path`) or a binary file object may be given, in which case the content
+        is streamed in chunks via `fora.connectors.connector.Connector.upload_stream`.
+        A local file path is passed to `fora.connectors.connector.Connector.upload_path`,
+        so that connectors which share the local filesystem can copy the file directly.
+        """
         logger.debug_args("Connection.upload", locals())
-        return self.connector.upload(
-            file=file,
-            content=content,
-            mode=mode,
-            owner=owner,
-            group=group)
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        if isinstance(content, bytes):
+            return self.connector.upload(
+                file=file,
+                content=content,
+                mode=mode,
+                owner=owner,
+                group=group)
+
+        if isinstance(content, os.PathLike):
+            return self.connector.upload_path(file=file, source=os.fspath(content), mode=mode, owner=owner, group=group)
+
+        return self.connector.upload_stream(file=file, stream=content, mode=mode, owner=owner, group=group)
+
+    def upload_delta(self,
+            file: str,
+            content: Union[bytes, str, os.PathLike, BinaryIO],
+            mode: Optional[str] = None,
+            owner: Optional[str] = None,
+            group: Optional[str] = None) -> None:
+        """
+        See `fora.connectors.connector.Connector.upload_delta`. Just like `Connection.upload`,
+        a str is uploaded as utf-8 encoded content, and a local file path (`os.PathLike`)
+        or a binary file object may be given instead of the content itself.
+        """
+        logger.debug_args("Connection.upload_delta", locals())
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        if isinstance(content, bytes):
+            return self.connector.upload_delta(file=file, stream=io.BytesIO(content), mode=mode, owner=owner, group=group)
+
+        if isinstance(content, os.PathLike):
+            return self.connector.upload_path(file=file, source=os.fspath(content), mode=mode, owner=owner, group=group, delta=True)
+
+        return self.connector.upload_delta(file=file, stream=content, mode=mode, owner=owner, group=group)
+
+    def query_blobs(self, sha512sums: list[bytes]) -> list[bool]:
+        """See `fora.connectors.connector.Connector.query_blobs`."""
+        logger.debug_args("Connection.query_blobs", locals())
+        return self.connector.query_blobs(sha512sums=sha512sums)
+
+    def place_blob(self,
+                   file: str,
+                   sha512sum: bytes,
+                   mode: Optional[str] = None,
+                   owner: Optional[str] = None,
+                   group: Optional[str] = None) -> None:
+        """See `fora.connectors.connector.Connector.place_blob`."""
+        logger.debug_args("Connection.place_blob", locals())
+        self.connector.place_blob(file=file, sha512sum=sha512sum, mode=mode, owner=owner, group=group)
 
     def download(self, file: str) -> bytes:
         """See `fora.connectors.connector.Connector.download`."""
         logger.debug_args("Connection.download", locals())
         return self.connector.download(file=file)
 
+    def download_stream(self, file: str) -> Iterator[bytes]:
+        """See `fora.connectors.connector.Connector.download_stream`."""
+        logger.debug_args("Connection.download_stream", locals())
+        return self.connector.download_stream(file=file)
+
+    def download_to(self, file: str, dest: Union[str, os.PathLike, BinaryIO]) -> None:
+        """
+        Downloads the given file in chunks and writes it to the given local path or binary file object,
+        so that the memory usage stays bounded regardless of the file size. A local path is only
+        replaced once the download has completed successfully.
+
+        Parameters
+        ----------
+        file
+            The file to download.
+        dest
+            The local path or file object to which the content is written.
+
+        Raises
+        ------
+        ValueError
+            If the file was not found.
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails for any reason other than file not found.
+        IOError
+            An error occurred with the connection.
+        """
+        logger.debug_args("Connection.download_to", locals())
+        if not isinstance(dest, (str, os.PathLike)):
+            for chunk in self.connector.download_stream(file=file):
+                dest.write(chunk)
+            return
+
+        dest = os.fspath(dest)
+        # The temporary file is created with mode 0600, so apply the mode the file would otherwise have
+        try:
+            mode = stat.S_IMODE(os.stat(dest).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_current_umask()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest)), prefix=f".{os.path.basename(dest)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                os.fchmod(f.fileno(), mode)
+                for chunk in self.connector.download_stream(file=file):
+                    f.write(chunk)
+            os.replace(tmp, dest)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
     def download_or(self, file: str, default: Optional[bytes] = None) -> Optional[bytes]:
         """
         Same as `Connection.download`, but returns the given default in case the file doesn't exist.
@@ -204,6 +443,16 @@ class Connection:
         except ValueError:
             return default
 
+    def query_user_many(self, users: list[str], query_password_hash: bool = False) -> list[Optional[UserEntry]]:
+        """See `fora.connectors.connector.Connector.query_user_many`."""
+        logger.debug_args("Connection.query_user_many", locals())
+        return self.connector.query_user_many(users=users, query_password_hash=query_password_hash)
+
+    def query_group_many(self, groups: list[str]) -> list[Optional[GroupEntry]]:
+        """See `fora.connectors.connector.Connector.query_group_many`."""
+        logger.debug_args("Connection.query_group_many", locals())
+        return self.connector.query_group_many(groups=groups)
+
     def home_dir(self, user: Optional[str] = None) -> str:
         """
         Return's the home directory of the given user. If the user is None,
@@ -239,6 +488,11 @@ class Connection:
         val = self.connector.getenv(key=key)
         return default if val is None else val
 
+    def getenv_many(self, keys: list[str]) -> list[Optional[str]]:
+        """See `fora.connectors.connector.Connector.getenv_many`."""
+        logger.debug_args("Connection.getenv_many", locals())
+        return self.connector.getenv_many(keys=keys)
+
 def open_connection(host: HostWrapper) -> Connection:
     """
     Returns a connection (context manager) that opens the connection when it is entered and
@@ -256,3 +510,148 @@ def open_connection(host: HostWrapper) -> Connection:
         The connection (context manager)
     """
     return Connection(host)
+
+class AsyncConnection:
+    """
+    The asyncio counterpart of `Connection`, which allows a single thread to drive connections
+    to many hosts concurrently. All methods are coroutines that behave like the method of the same
+    name in `Connection`, and are implemented by a `fora.connectors.async_tunnel_connector.AsyncTunnelConnector`
+    around the host's connector, so the host must use a tunnel connector such as `ssh:` or `local:`.
+
+    Commands are run with the defaults of the current script if one is running, and otherwise
+    with the base settings of the inventory. The connection is not registered as host.connection,
+    as operations use the blocking `Connection`.
+
+    Example:
+
+    ```python
+    async with AsyncConnection(host) as conn:
+        result = await conn.run(["uname", "-a"])
+    ```
+    """
+
+    def __init__(self, host: HostWrapper):
+        self.host = host
+        connector = self.host.create_connector()
+        if not isinstance(connector, TunnelConnector) or isinstance(connector, InprocConnector):
+            raise ValueError(f"The connector of host '{host.name}' ({type(connector).__name__}) cannot be used asynchronously")
+        self.connector: AsyncTunnelConnector = AsyncTunnelConnector(connector)
+        self.base_settings: RemoteSettings = copy(self.host.inventory.base_remote_settings())
+
+    async def __aenter__(self) -> AsyncConnection:
+        await self.connector.open()
+        try:
+            await self._resolve_identity()
+        except BaseException:
+            await self.connector.close()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        _ = (exc_type, exc, traceback)
+        await self.connector.close()
+
+    async def _resolve_identity(self) -> None:
+        """See `Connection._resolve_identity`."""
+        user, group = await asyncio.gather(self.resolve_user(None), self.resolve_group(None))
+        self.base_settings.as_user = user
+        self.base_settings.as_group = group
+        self.base_settings.owner = user
+        self.base_settings.group = group
+
+    def _defaults(self) -> RemoteSettings:
+        """Returns the defaults of the current script, or the base settings if no script is running."""
+        return fora.script.current_defaults() if fora.script is not None else self.base_settings
+
+    async def run(self,
+                  command: list[str],
+                  input: Optional[bytes] = None, # pylint: disable=redefined-builtin
+                  capture_output: bool = True,
+                  check: bool = True,
+                  user: Optional[str] = None,
+                  group: Optional[str] = None,
+                  umask: Optional[str] = None,
+                  cwd: Optional[str] = None) -> CompletedRemoteCommand:
+        """See `Connection.run`. The output can't be streamed."""
+        logger.debug_args("AsyncConnection.run", locals())
+        defaults = self._defaults()
+        return await self.connector.run(
+            command=command,
+            input=input,
+            capture_output=capture_output,
+            check=check,
+            user=user if user is not None else defaults.as_user,
+            group=group if group is not None else defaults.as_group,
+            umask=umask if umask is not None else defaults.umask,
+            cwd=cwd if cwd is not None else defaults.cwd)
+
+    async def resolve_user(self, user: Optional[str]) -> str:
+        """See `Connection.resolve_user`."""
+        logger.debug_args("AsyncConnection.resolve_user", locals())
+        return await self.connector.resolve_user(user)
+
+    async def resolve_group(self, group: Optional[str]) -> str:
+        """See `Connection.resolve_group`."""
+        logger.debug_args("AsyncConnection.resolve_group", locals())
+        return await self.connector.resolve_group(group)
+
+    async def stat(self, path: str, follow_links: bool = False, sha512sum: bool = False) -> Optional[StatResult]:
+        """See `Connection.stat`."""
+        logger.debug_args("AsyncConnection.stat", locals())
+        return await self.connector.stat(path=path, follow_links=follow_links, sha512sum=sha512sum)
+
+    async def stat_many(self, paths: list[str], follow_links: bool = False, sha512sum: bool = False) -> list[Optional[StatResult]]:
+        """See `Connection.stat_many`."""
+        logger.debug_args("AsyncConnection.stat_many", locals())
+        return await self.connector.stat_many(paths=paths, follow_links=follow_links, sha512sum=sha512sum)
+
+    async def upload(self,
+                     file: str,
+                     content: bytes,
+                     mode: Optional[str] = None,
+                     owner: Optional[str] = None,
+                     group: Optional[str] = None) -> None:
+        """See `Connection.upload`. Only content given as bytes is supported."""
+        logger.debug_args("AsyncConnection.upload", locals())
+        await self.connector.upload(file=file, content=content, mode=mode, owner=owner, group=group)
+
+    async def download(self, file: str) -> bytes:
+        """See `Connection.download`."""
+        logger.debug_args("AsyncConnection.download", locals())
+        return await self.connector.download(file=file)
+
+    async def download_or(self, file: str, default: Optional[bytes] = None) -> Optional[bytes]:
+        """See `Connection.download_or`."""
+        try:
+            return await self.download(file=file)
+        except ValueError:
+            return default
+
+    async def query_user(self, user: str, query_password_hash: bool = False, default: Optional[UserEntry] = None) -> Optional[UserEntry]:
+        """See `Connection.query_user`."""
+        logger.debug_args("AsyncConnection.query_user", locals())
+        try:
+            return await self.connector.query_user(user=user, query_password_hash=query_password_hash)
+        except ValueError:
+            return default
+
+    async def query_group(self, group: str, default: Optional[GroupEntry] = None) -> Optional[GroupEntry]:
+        """See `Connection.query_group`."""
+        logger.debug_args("AsyncConnection.query_group", locals())
+        try:
+            return await self.connector.query_group(group=group)
+        except ValueError:
+            return default
+
+    async def home_dir(self, user: Optional[str] = None) -> str:
+        """See `Connection.home_dir`."""
+        logger.debug_args("AsyncConnection.home_dir", locals())
+        if user is None:
+            user = await self.resolve_user(None)
+        return (await self.connector.query_user(user=user)).home
+
+    async def getenv(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """See `Connection.getenv`."""
+        logger.debug_args("AsyncConnection.getenv", locals())
+        val = await self.connector.getenv(key=key)
+        return default if val is None else val
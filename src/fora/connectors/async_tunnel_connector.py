@@ -0,0 +1,382 @@
+"""
+Contains an asyncio implementation of the tunnel connector, which allows a single thread
+to drive many tunnel dispatchers concurrently.
+"""
+
+import asyncio
+import hashlib
+import io
+import itertools
+import subprocess
+import sys
+from asyncio.subprocess import Process
+from typing import Any, Optional, cast
+
+from fora import logger
+from fora.connectors import tunnel_dispatcher as td
+from fora.connectors.connector import CompletedRemoteCommand, GroupEntry, StatResult, UserEntry
+from fora.connectors.tunnel_connector import TunnelConnector, _expect_response_packet, _group_entry, _stat_result, _user_entry
+
+class _Incomplete(Exception):
+    """Raised when a frame is decoded from a buffer that doesn't contain the whole frame yet."""
+
+    def __init__(self, size: int):
+        super().__init__(size)
+        self.size = size
+
+class FrameDecoder(td.Connection):
+    """
+    Decodes frames incrementally from data as it arrives. Frames carry no length, as each packet
+    delimits itself, so a frame is decoded with the regular packet decoders as soon as
+    enough data has arrived. A decoder that reads past the end of the available data raises `_Incomplete`,
+    which also tells how much data is needed at least, so that the decoding is only retried
+    when the frame can have been completed.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(io.BytesIO(), io.BytesIO())
+        self.data = bytearray()
+        self.pos = 0
+        self.required = 0
+
+    def read(self, count: int) -> bytes:
+        end = self.pos + count
+        if end > len(self.data):
+            raise _Incomplete(end)
+        with memoryview(self.data) as view:
+            chunk = bytes(view[self.pos:end])
+        self.pos = end
+        return chunk
+
+    def readinto(self, buffer: bytearray) -> bool:
+        buffer[:] = self.read(len(buffer))
+        return True
+
+    def feed(self, data: bytes) -> list[tuple[td.u32, td.u32, Any]]:
+        """
+        Appends the given data and decodes all frames that are complete.
+
+        Parameters
+        ----------
+        data
+            The received data.
+
+        Returns
+        -------
+        list[tuple[td.u32, td.u32, Any]]
+            The channel, the request id and the packet of each complete frame.
+        """
+        self.data += data
+        frames = []
+        while len(self.data) >= self.required:
+            start = self.pos
+            try:
+                frames.append(td.receive_frame(self))
+            except _Incomplete as e:
+                self.pos = start
+                self.required = e.size
+                break
+            # Consumed data is only discarded after the loop
+            self.required = self.pos
+        del self.data[:self.pos]
+        self.required -= self.pos
+        self.pos = 0
+        return frames
+
+class _StreamOutput:
+    """The output buffer of a connection, which passes all data to an asyncio stream."""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+    def write(self, data: bytes) -> None:
+        """Writes the data to the stream's transport, which buffers it until it can be written."""
+        self.writer.write(data)
+
+    def flush(self) -> None:
+        """Nothing to do, the transport writes as soon as possible."""
+
+# pylint: disable=too-many-instance-attributes
+class AsyncTunnelConnector:
+    """
+    An asyncio implementation of the tunnel connector, which starts and talks to the tunnel dispatcher
+    of the given `TunnelConnector` without blocking. All methods are coroutines, and
+    any number of requests may be awaited concurrently, also on many connectors at once. Each request
+    is sent on its own channel, so that the dispatcher handles concurrent requests concurrently.
+    A single task receives all responses and passes them on to the waiting requests.
+
+    The connector only provides the command that starts the dispatcher and the data to bootstrap it,
+    so `SshConnector` and `LocalConnector` can both be used, while `InprocConnector`, which starts no command,
+    cannot. The blocking API of the given connector is not used. Scripts should usually
+    use `fora.connection.AsyncConnection`, which applies the current defaults like `fora.connection.Connection`.
+
+    Example:
+
+    ```python
+    async with AsyncTunnelConnector(SshConnector(url, host)) as conn:
+        result = await conn.run(["uname", "-a"])
+    ```
+    """
+
+    def __init__(self, connector: TunnelConnector):
+        self.connector = connector
+        self.process: Optional[Process] = None
+        self.conn: td.Connection
+        self.is_open: bool = False
+        self.blob_store: bool = False
+        self.same_machine: bool = False
+
+        self.next_channel_id = itertools.count(1)
+        self.next_request_id = itertools.count(1)
+        self.next_stream_id = itertools.count(1)
+        self.responses: dict[int, asyncio.Future[Any]] = {}
+        """The futures of all requests whose response is outstanding, by request id."""
+        self.receiver: Optional[asyncio.Task[None]] = None
+        self.error: Optional[BaseException] = None
+
+    async def __aenter__(self) -> "AsyncTunnelConnector":
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        """Starts the tunnel dispatcher and checks that it is alive, like `TunnelConnector.open`."""
+        logger.connection_init(self.connector)
+        self.process = await asyncio.create_subprocess_exec(*self.connector.command(),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr)
+        if self.process.stdout is None or self.process.stdin is None:
+            raise RuntimeError("Subprocess has no stdin/stdout. If is a bug.")
+        self.conn = td.Connection(io.BytesIO(), cast(Any, _StreamOutput(self.process.stdin)))
+
+        try:
+            await self._bootstrap()
+            self.receiver = asyncio.create_task(self._receive())
+            request = self.connector.handshake_request()
+            response = await self._request(request)
+            _expect_response_packet(response, td.PacketAck)
+            self.conn.compressor.algorithm = cast(td.PacketAck, response).compression
+            self.blob_store = request.blob_store_size > 0
+            self.same_machine = cast(td.PacketAck, response).same_machine
+
+            # As a last action record that the connection is opened successfully,
+            # otherwise the finally block will kill the process.
+            self.is_open = True
+        except (IOError, asyncio.IncompleteReadError) as e:
+            returncode = self.process.returncode
+            if returncode is None:
+                logger.connection_failed(str(e))
+            else:
+                logger.connection_failed(f"command exited with code {returncode}")
+            raise IOError(str(e)) from e
+        finally:
+            # If the connection failed for any reason, be sure to kill the background process.
+            if not self.is_open:
+                if self.receiver is not None:
+                    self.receiver.cancel()
+                    await asyncio.gather(self.receiver, return_exceptions=True)
+                    self.receiver = None
+                if self.process.returncode is None:
+                    self.process.terminate()
+                await self.process.wait()
+                self.process = None
+
+        logger.connection_established()
+
+    async def _bootstrap(self) -> None:
+        """Sends the bootstrap payload of the connector when the command requests it (see `TunnelConnector.bootstrap`)."""
+        payload = self.connector.bootstrap_payload()
+        if payload is None:
+            return
+
+        process = cast(Process, self.process)
+        status = await cast(asyncio.StreamReader, process.stdout).readexactly(1)
+        if status == b"U":
+            stdin = cast(asyncio.StreamWriter, process.stdin)
+            stdin.write(payload)
+            await stdin.drain()
+        elif status != b"C":
+            raise IOError("Unexpected response while starting the tunnel dispatcher")
+
+    async def close(self) -> None:
+        """Asks the dispatcher to exit and waits until it has."""
+        if self.process is None:
+            return
+        if self.is_open:
+            self.is_open = False
+            self.conn.write_packet(td.PacketExit())
+        stdin = cast(asyncio.StreamWriter, self.process.stdin)
+        stdin.close()
+        try:
+            await stdin.wait_closed()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        if self.receiver is not None:
+            await asyncio.gather(self.receiver, return_exceptions=True)
+            self.receiver = None
+        await self.process.wait()
+        self.process = None
+
+    async def _receive(self) -> None:
+        """Receives all responses and passes each to the future of its request, until the connection is closed."""
+        decoder = FrameDecoder()
+        stdout = cast(asyncio.StreamReader, cast(Process, self.process).stdout)
+        try:
+            while True:
+                data = await stdout.read(1 << 16)
+                if len(data) == 0:
+                    raise IOError("Unexpected EOF in data stream")
+                for _, request_id, packet in decoder.feed(data):
+                    future = self.responses.pop(request_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(packet)
+        except BaseException as e: # pylint: disable=broad-except
+            self.error = e if isinstance(e, IOError) else IOError(f"Connection failed: {e!r}")
+            for future in self.responses.values():
+                if not future.done():
+                    future.set_exception(self.error)
+            self.responses.clear()
+            if not isinstance(e, IOError):
+                raise
+
+    def _send(self, packet: Any, channel: td.u32, expect_response: bool = True) -> Optional[asyncio.Future[Any]]:
+        """Writes the request packet on the given channel and returns the future of its response."""
+        if self.error is not None:
+            raise self.error
+        request_id = td.u32(next(self.next_request_id) & 0xffffffff)
+        future: Optional[asyncio.Future[Any]] = None
+        if expect_response:
+            future = asyncio.get_running_loop().create_future()
+            self.responses[request_id] = future
+        self.conn.for_request(channel, request_id).write_packet(packet)
+        return future
+
+    def _channel(self) -> td.u32:
+        """Returns a new channel."""
+        return td.u32(next(self.next_channel_id) & 0xffffffff)
+
+    async def _drain(self) -> None:
+        """Waits until the written requests were passed on to the dispatcher, or enough of them to continue writing."""
+        await cast(asyncio.StreamWriter, cast(Process, self.process).stdin).drain()
+
+    async def _request(self, packet: Any) -> Any:
+        """Sends the request packet on a new channel and returns the response.
+        Propagates exceptions raised from td.check_response."""
+        future = cast(asyncio.Future[Any], self._send(packet, self._channel()))
+        await self._drain()
+        return td.check_response(await future, request=packet)
+
+    async def run(self,
+                  command: list[str],
+                  input: Optional[bytes] = None, # pylint: disable=redefined-builtin
+                  capture_output: bool = True,
+                  check: bool = True,
+                  user: Optional[str] = None,
+                  group: Optional[str] = None,
+                  umask: Optional[str] = None,
+                  cwd: Optional[str] = None) -> CompletedRemoteCommand:
+        """See `fora.connectors.connector.Connector.run`."""
+        response = await self._request(td.PacketProcessRun(
+            command=command,
+            stdin=input,
+            capture_output=capture_output,
+            user=user,
+            group=group,
+            umask=umask,
+            cwd=cwd))
+        if isinstance(response, td.PacketProcessError):
+            raise ValueError(response.message)
+
+        _expect_response_packet(response, td.PacketProcessCompleted)
+        result = CompletedRemoteCommand(stdout=response.stdout,
+                                        stderr=response.stderr,
+                                        returncode=response.returncode)
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(returncode=result.returncode,
+                                                output=result.stdout,
+                                                stderr=result.stderr,
+                                                cmd=command)
+        return result
+
+    async def stat(self, path: str, follow_links: bool = False, sha512sum: bool = False) -> Optional[StatResult]:
+        """See `fora.connectors.connector.Connector.stat`."""
+        try:
+            response = await self._request(td.PacketStat(path=path, follow_links=follow_links, sha512sum=sha512sum))
+        except ValueError:
+            # File was not found, return None
+            return None
+        _expect_response_packet(response, td.PacketStatResult)
+        return _stat_result(response)
+
+    async def stat_many(self, paths: list[str], follow_links: bool = False, sha512sum: bool = False) -> list[Optional[StatResult]]:
+        """See `fora.connectors.connector.Connector.stat_many`."""
+        response = await self._request(td.PacketStatMany(paths=paths, follow_links=follow_links, sha512sum=sha512sum))
+        _expect_response_packet(response, td.PacketStatManyResult)
+        return [None if r is None else _stat_result(r) for r in cast(td.PacketStatManyResult, response).results]
+
+    async def resolve_user(self, user: Optional[str]) -> str:
+        """See `fora.connectors.connector.Connector.resolve_user`."""
+        response = await self._request(td.PacketResolveUser(user=user))
+        _expect_response_packet(response, td.PacketResolveResult)
+        return cast(td.PacketResolveResult, response).value
+
+    async def resolve_group(self, group: Optional[str]) -> str:
+        """See `fora.connectors.connector.Connector.resolve_group`."""
+        response = await self._request(td.PacketResolveGroup(group=group))
+        _expect_response_packet(response, td.PacketResolveResult)
+        return cast(td.PacketResolveResult, response).value
+
+    async def query_user(self, user: str, query_password_hash: bool = False) -> UserEntry:
+        """See `fora.connectors.connector.Connector.query_user`."""
+        response = await self._request(td.PacketQueryUser(user=user, query_password_hash=query_password_hash))
+        _expect_response_packet(response, td.PacketUserEntry)
+        return _user_entry(response)
+
+    async def query_group(self, group: str) -> GroupEntry:
+        """See `fora.connectors.connector.Connector.query_group`."""
+        response = await self._request(td.PacketQueryGroup(group=group))
+        _expect_response_packet(response, td.PacketGroupEntry)
+        return _group_entry(response)
+
+    async def getenv(self, key: str) -> Optional[str]:
+        """See `fora.connectors.connector.Connector.getenv`."""
+        response = await self._request(td.PacketGetenv(key=key))
+        _expect_response_packet(response, td.PacketEnvironVar)
+        return cast(td.PacketEnvironVar, response).value
+
+    async def upload(self,
+                     file: str,
+                     content: bytes,
+                     mode: Optional[str] = None,
+                     owner: Optional[str] = None,
+                     group: Optional[str] = None) -> None:
+        """See `fora.connectors.connector.Connector.upload`. Large content is sent
+        in chunks as a streaming upload, like `TunnelConnector.upload` does."""
+        chunk_size = self.connector.chunk_size
+        if len(content) <= chunk_size:
+            response = await self._request(td.PacketUpload(file=file, content=content, mode=mode, owner=owner, group=group))
+            _expect_response_packet(response, td.PacketOk)
+            return
+
+        stream_id = td.u32(next(self.next_stream_id) & 0xffffffff)
+        channel = self._channel()
+        begin = td.PacketUploadBegin(stream=stream_id, file=file, mode=mode, owner=owner, group=group)
+        begin_response = cast(asyncio.Future[Any], self._send(begin, channel))
+        for i in range(0, len(content), chunk_size):
+            self._send(td.PacketUploadChunk(stream=stream_id, data=content[i:i + chunk_size]), channel, expect_response=False)
+            await self._drain()
+        end = td.PacketUploadEnd(stream=stream_id, sha512sum=hashlib.sha512(content).digest())
+        end_response = cast(asyncio.Future[Any], self._send(end, channel))
+        await self._drain()
+        try:
+            _expect_response_packet(td.check_response(await begin_response, request=begin), td.PacketOk)
+        finally:
+            response = await end_response
+        _expect_response_packet(td.check_response(response, request=end), td.PacketOk)
+
+    async def download(self, file: str) -> bytes:
+        """See `fora.connectors.connector.Connector.download`."""
+        response = await self._request(td.PacketDownload(file=file))
+        _expect_response_packet(response, td.PacketDownloadResult)
+        return cast(td.PacketDownloadResult, response).content
@@ -3,8 +3,10 @@ Defines the connector interface.
 """
 
 from __future__ import annotations
+import subprocess
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Callable, Optional, Type, Union
+from typing import Any, BinaryIO, Callable, Generator, Iterable, Iterator, Optional, Type, Union
 
 from fora.types import HostWrapper
 
@@ -20,6 +22,31 @@ class CompletedRemoteCommand:
     returncode: int
     """The return code of the remote command."""
 
+class PendingRemoteCommand(CompletedRemoteCommand):
+    """
+    The return value of `Connector.run()` inside of a `Connector.pipeline()` block,
+    representing a remote process whose response has not been received yet.
+    Accessing any of the attributes waits for all pending responses (see `Connector.pipeline()`).
+    """
+    def __init__(self, drain: Callable[[], None]): # pylint: disable=super-init-not-called
+        # The dataclass fields are intentionally left unset until the response arrives,
+        # so that accessing them is routed through __getattr__.
+        self._drain = drain
+
+    def complete(self, result: CompletedRemoteCommand) -> None:
+        """Stores the result once the response has been received."""
+        self.stdout = result.stdout
+        self.stderr = result.stderr
+        self.returncode = result.returncode
+
+    def __getattr__(self, name: str) -> Any:
+        if name not in ("stdout", "stderr", "returncode"):
+            raise AttributeError(name)
+        self._drain()
+        if name not in self.__dict__:
+            raise RuntimeError("The pipelined command failed and has no result.")
+        return self.__dict__[name]
+
 class StatResult:
     """
     The return value of stat(), representing information about a remote file.
@@ -76,6 +103,7 @@ class GroupEntry:
     members: list[str]
     """All the group member's user names"""
 
+# pylint: disable=too-many-public-methods
 class Connector:
     """The base class for all connectors."""
 
@@ -101,6 +129,33 @@ class Connector:
         """Closes the connection to the remote host."""
         raise NotImplementedError("Must be overwritten by subclass.")
 
+    @contextmanager
+    def pipeline(self) -> Iterator[None]:
+        """
+        Returns a context manager in which mutating requests (`Connector.run` and
+        `Connector.upload`) are sent back-to-back without waiting for their responses.
+        The responses are collected in order at the end of the block or before the next
+        request that returns information (e.g. `Connector.stat`). Any error of a pipelined
+        request (including non-zero exit codes if check=True) is raised at that point.
+        If multiple requests failed, the error of the first one is raised.
+        Inside of the block, `Connector.run` returns a `PendingRemoteCommand`. Blocks may be nested,
+        in which case only the outermost block collects the responses.
+
+        The default implementation executes all requests immediately.
+
+        Raises
+        ------
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If a pipelined request failed because of an remote OSError.
+        ValueError
+            If a pipelined request contained an invalid value.
+        subprocess.CalledProcessError
+            If a pipelined command with check=True returned a non-zero exit code.
+        IOError
+            An error occurred with the connection.
+        """
+        yield
+
     def run(self,
             command: list[str],
             input: Optional[bytes] = None, # pylint: disable=redefined-builtin
@@ -156,6 +211,71 @@ class Connector:
         _ = (self, command, input, capture_output, check, user, group, umask, cwd)
         raise NotImplementedError("Must be overwritten by subclass.")
 
+    def run_stream(self,
+                   command: list[str],
+                   input: Union[None, bytes, Iterable[bytes]] = None, # pylint: disable=redefined-builtin
+                   check: bool = True,
+                   user: Optional[str] = None,
+                   group: Optional[str] = None,
+                   umask: Optional[str] = None,
+                   cwd: Optional[str] = None) -> Generator[tuple[int, bytes], None, CompletedRemoteCommand]:
+        """
+        Same as `Connector.run`, but yields the output of the command while it is running
+        as tuples of the file descriptor (1 for stdout, 2 for stderr) and the data.
+        The input may also be given as an iterable of chunks, which are sent to the
+        command as they are produced. The output is not captured, so the returned
+        `CompletedRemoteCommand` (the value of the final StopIteration) only contains the return code.
+        If the iteration is stopped early, the remote command is killed.
+
+        Connectors should override this to transfer the output while the command is running,
+        so that the memory usage stays bounded regardless of the output size.
+        The default implementation runs the command to completion and then yields its output.
+
+        Parameters
+        ----------
+        command
+            The command to be executed on the remote host.
+        input
+            Input to the remote command, either as bytes or an iterable of chunks.
+        check
+            Whether to raise an exception after the output was yielded if the remote command returns with a non-zero exit status.
+        user
+            See `Connector.run`.
+        group
+            See `Connector.run`.
+        umask
+            See `Connector.run`.
+        cwd
+            See `Connector.run`.
+
+        Returns
+        -------
+        Generator[tuple[int, bytes], None, CompletedRemoteCommand]
+            The output chunks of the remote command.
+
+        Raises
+        ------
+        subprocess.CalledProcessError
+            If check is True and the process returned a non-zero exit status.
+        ValueError
+            A parameter was invalid.
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        if input is not None and not isinstance(input, bytes):
+            input = b"".join(input)
+        result = self.run(command=command, input=input, capture_output=True, check=False,
+                          user=user, group=group, umask=umask, cwd=cwd)
+        if result.stdout:
+            yield (1, result.stdout)
+        if result.stderr:
+            yield (2, result.stderr)
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(returncode=result.returncode, cmd=command)
+        return CompletedRemoteCommand(stdout=None, stderr=None, returncode=result.returncode)
+
     def resolve_user(self, user: Optional[str]) -> str:
         """
         Resolves the given user on the remote, returning
@@ -243,6 +363,98 @@ class Connector:
         _ = (self, path, follow_links, sha512sum)
         raise NotImplementedError("Must be overwritten by subclass.")
 
+    def stat_many(self, paths: list[str], follow_links: bool = False, sha512sum: bool = False) -> list[Optional[StatResult]]:
+        """
+        Same as `Connector.stat`, but stats all given paths at once. The default implementation
+        calls `Connector.stat` for each path, connectors should override this to query all paths
+        in a single round trip.
+
+        Parameters
+        ----------
+        paths
+            The paths to stat.
+        follow_links
+            Whether to follow symbolic links instead of running stat on the link.
+        sha512sum
+            Whether to include the sha512sum for each path that is a file.
+
+        Returns
+        -------
+        list[Optional[StatResult]]
+            The stat results in the same order as the given paths. Paths that don't exist
+            (including paths below a non-directory) yield None.
+
+        Raises
+        ------
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails for any reason other than file not found.
+        IOError
+            An error occurred with the connection.
+        """
+        return [self.stat(path=p, follow_links=follow_links, sha512sum=sha512sum) for p in paths]
+
+    def resolve_user_many(self, users: list[Optional[str]]) -> list[Optional[str]]:
+        """
+        Same as `Connector.resolve_user`, but resolves all given users at once. Instead of raising
+        a ValueError, users that cannot be resolved yield None. The default implementation
+        calls `Connector.resolve_user` for each user, connectors should override this to
+        resolve all users in a single round trip.
+
+        Parameters
+        ----------
+        users
+            The usernames or uids that should be resolved. Each None entry queries the current user.
+
+        Returns
+        -------
+        list[Optional[str]]
+            The resolved usernames in the same order as the given users, or None for each user that doesn't exist.
+
+        Raises
+        ------
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        def _resolve(user: Optional[str]) -> Optional[str]:
+            try:
+                return self.resolve_user(user)
+            except ValueError:
+                return None
+        return [_resolve(u) for u in users]
+
+    def resolve_group_many(self, groups: list[Optional[str]]) -> list[Optional[str]]:
+        """
+        Same as `Connector.resolve_group`, but resolves all given groups at once. Instead of raising
+        a ValueError, groups that cannot be resolved yield None. The default implementation
+        calls `Connector.resolve_group` for each group, connectors should override this to
+        resolve all groups in a single round trip.
+
+        Parameters
+        ----------
+        groups
+            The groupnames or gids that should be resolved. Each None entry queries the current group.
+
+        Returns
+        -------
+        list[Optional[str]]
+            The resolved groupnames in the same order as the given groups, or None for each group that doesn't exist.
+
+        Raises
+        ------
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        def _resolve(group: Optional[str]) -> Optional[str]:
+            try:
+                return self.resolve_group(group)
+            except ValueError:
+                return None
+        return [_resolve(g) for g in groups]
+
     def upload(self,
                file: str,
                content: bytes,
@@ -250,7 +462,8 @@ class Connector:
                owner: Optional[str] = None,
                group: Optional[str] = None) -> None:
         """
-        Uploads the given content to the remote system and saves it under the given file path. Overwrites existing files.
+        Uploads the given content to the remote system and saves it under the given file path.
+        Overwrites existing files atomically, by replacing them with a completely written temporary file.
 
         Parameters
         ----------
@@ -259,12 +472,12 @@ class Connector:
         content
             The file content.
         owner
-            The owner for the file. Defaults to root if not given.
+            The owner for the file. Keeps the owner of an existing file, or defaults to the remote user if not given.
         group
             The group for the file. If the owner is given, defaults to the primary
-            group of the owner, otherwise defaults to root.
+            group of the owner, otherwise keeps the group of an existing file or defaults to the remote user's group.
         mode
-            The mode for the file. Defaults to '600' if not given.
+            The mode for the file. Keeps the mode of an existing file, or defaults to '600' if not given.
 
         Raises
         ------
@@ -278,6 +491,183 @@ class Connector:
         _ = (self, file, content, mode, owner, group)
         raise NotImplementedError("Must be overwritten by subclass.")
 
+    def upload_stream(self,
+                      file: str,
+                      stream: BinaryIO,
+                      mode: Optional[str] = None,
+                      owner: Optional[str] = None,
+                      group: Optional[str] = None) -> None:
+        """
+        Same as `Connector.upload`, but reads the content from the given binary file object.
+        Connectors should override this to send the content in chunks, so that
+        the memory usage stays bounded regardless of the file size. The remote
+        side verifies the sha512sum of the received content before saving it.
+        The default implementation reads the whole stream and calls `Connector.upload`.
+
+        Parameters
+        ----------
+        file
+            The file where the content will be saved.
+        stream
+            The file object from which the content is read until EOF.
+        owner
+            See `Connector.upload`.
+        group
+            See `Connector.upload`.
+        mode
+            See `Connector.upload`.
+
+        Raises
+        ------
+        ValueError
+            A parameter was invalid or the content was corrupted in transit.
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        self.upload(file=file, content=stream.read(), mode=mode, owner=owner, group=group)
+
+    def upload_delta(self,
+                     file: str,
+                     stream: BinaryIO,
+                     mode: Optional[str] = None,
+                     owner: Optional[str] = None,
+                     group: Optional[str] = None) -> None:
+        """
+        Same as `Connector.upload_stream`, but intended to replace an existing remote file whose
+        content is similar to the new content. Connectors should override this to only transfer
+        the parts of the content that differ from the existing file. The default implementation
+        calls `Connector.upload_stream`.
+
+        Parameters
+        ----------
+        file
+            The file where the content will be saved.
+        stream
+            The seekable file object from which the content is read until EOF.
+        owner
+            See `Connector.upload`.
+        group
+            See `Connector.upload`.
+        mode
+            See `Connector.upload`.
+
+        Raises
+        ------
+        ValueError
+            A parameter was invalid or the content was corrupted in transit.
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        self.upload_stream(file=file, stream=stream, mode=mode, owner=owner, group=group)
+
+    def upload_path(self,
+                    file: str,
+                    source: str,
+                    mode: Optional[str] = None,
+                    owner: Optional[str] = None,
+                    group: Optional[str] = None,
+                    delta: bool = False) -> None:
+        """
+        Uploads the local file at the given source path. Connectors whose remote host shares the
+        local filesystem should override this to copy the file directly on the remote host.
+        The default implementation reads the file via `Connector.upload_stream`,
+        or via `Connector.upload_delta` if requested.
+
+        Parameters
+        ----------
+        file
+            The file where the content will be saved.
+        source
+            The path of the local file whose content will be uploaded.
+        owner
+            See `Connector.upload`.
+        group
+            See `Connector.upload`.
+        mode
+            See `Connector.upload`.
+        delta
+            Whether the upload replaces an existing remote file with similar content (see `Connector.upload_delta`).
+
+        Raises
+        ------
+        ValueError
+            A parameter was invalid or the content was corrupted in transit.
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        with open(source, 'rb') as f:
+            if delta:
+                self.upload_delta(file=file, stream=f, mode=mode, owner=owner, group=group)
+            else:
+                self.upload_stream(file=file, stream=f, mode=mode, owner=owner, group=group)
+
+    def query_blobs(self, sha512sums: list[bytes]) -> list[bool]:
+        """
+        Queries which of the given blobs (file contents identified by their sha512sum) are in the
+        remote blob store, so that they can be placed with `Connector.place_blob` instead of being
+        uploaded again. The default implementation has no blob store and reports all blobs as missing.
+
+        Parameters
+        ----------
+        sha512sums
+            The sha512sums of the blobs.
+
+        Returns
+        -------
+        list[bool]
+            Whether each blob is in the store, in the same order as the given sha512sums.
+
+        Raises
+        ------
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        _ = (self)
+        return [False] * len(sha512sums)
+
+    def place_blob(self,
+                   file: str,
+                   sha512sum: bytes,
+                   mode: Optional[str] = None,
+                   owner: Optional[str] = None,
+                   group: Optional[str] = None) -> None:
+        """
+        Same as `Connector.upload`, but saves a copy of a blob from the remote blob store
+        (see `Connector.query_blobs`) instead of transferring the content.
+
+        Parameters
+        ----------
+        file
+            The file where the content will be saved.
+        sha512sum
+            The sha512sum of the content.
+        owner
+            See `Connector.upload`.
+        group
+            See `Connector.upload`.
+        mode
+            See `Connector.upload`.
+
+        Raises
+        ------
+        ValueError
+            A parameter was invalid or the blob is not in the store.
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        _ = (self, file, mode, owner, group)
+        raise ValueError(f"The blob {sha512sum.hex()} is not in the store")
+
     def download(self, file: str) -> bytes:
         """
         Downloads the given file from the remote system.
@@ -299,6 +689,34 @@ class Connector:
         _ = (self, file)
         raise NotImplementedError("Must be overwritten by subclass.")
 
+    def download_stream(self, file: str) -> Iterator[bytes]:
+        """
+        Same as `Connector.download`, but yields the content of the file in chunks.
+        Connectors should override this to transfer the file in chunks, so that
+        the memory usage stays bounded regardless of the file size.
+        The default implementation downloads the whole file and yields it at once.
+
+        Parameters
+        ----------
+        file
+            The file to download.
+
+        Returns
+        -------
+        Iterator[bytes]
+            The content of the file in consecutive chunks.
+
+        Raises
+        ------
+        ValueError
+            If the file was not found.
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails for any reason other than file not found.
+        IOError
+            An error occurred with the connection.
+        """
+        yield self.download(file=file)
+
     def query_user(self, user: str, query_password_hash: bool = False) -> UserEntry:
         """
         Queries information about a user on the reomte system.
@@ -353,6 +771,69 @@ class Connector:
         _ = (self, group)
         raise NotImplementedError("Must be overwritten by subclass.")
 
+    def query_user_many(self, users: list[str], query_password_hash: bool = False) -> list[Optional[UserEntry]]:
+        """
+        Same as `Connector.query_user`, but queries all given users at once. Instead of raising
+        a ValueError, users that don't exist yield None. The default implementation calls
+        `Connector.query_user` for each existing user, connectors should override this to
+        query all users in a single round trip.
+
+        Parameters
+        ----------
+        users
+            The usernames or uids that should be queried.
+        query_password_hash
+            Whether the password hashes should also be returned. Requires elevated privileges.
+
+        Returns
+        -------
+        list[Optional[UserEntry]]
+            The information about the users in the same order as the given users, or None for each user that doesn't exist.
+
+        Raises
+        ------
+        ValueError
+            If the password hash of an existing user was requested but is inaccessible.
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        to_resolve: list[Optional[str]] = list(users)
+        resolved = self.resolve_user_many(to_resolve)
+        return [None if r is None else self.query_user(u, query_password_hash=query_password_hash) for u, r in zip(users, resolved)]
+
+    def query_group_many(self, groups: list[str]) -> list[Optional[GroupEntry]]:
+        """
+        Same as `Connector.query_group`, but queries all given groups at once. Instead of raising
+        a ValueError, groups that don't exist yield None. The default implementation calls
+        `Connector.query_group` for each group, connectors should override this to
+        query all groups in a single round trip.
+
+        Parameters
+        ----------
+        groups
+            The groupnames or gids that should be queried.
+
+        Returns
+        -------
+        list[Optional[GroupEntry]]
+            The information about the groups in the same order as the given groups, or None for each group that doesn't exist.
+
+        Raises
+        ------
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        def _query(group: str) -> Optional[GroupEntry]:
+            try:
+                return self.query_group(group)
+            except ValueError:
+                return None
+        return [_query(g) for g in groups]
+
     def getenv(self, key: str) -> Optional[str]:
         """
         Return's an environment variable from the remote host.
@@ -379,6 +860,31 @@ class Connector:
         _ = (self, key)
         raise NotImplementedError("Must be overwritten by subclass.")
 
+    def getenv_many(self, keys: list[str]) -> list[Optional[str]]:
+        """
+        Same as `Connector.getenv`, but returns all given environment variables at once.
+        The default implementation calls `Connector.getenv` for each key, connectors should
+        override this to query all variables in a single round trip.
+
+        Parameters
+        ----------
+        keys
+            The variables to get.
+
+        Returns
+        -------
+        list[Optional[str]]
+            The corresponding variables in the same order as the given keys, None for each variable that wasn't found.
+
+        Raises
+        ------
+        fora.connectors.tunnel_dispatcher.RemoteOSError
+            If the remote command fails because of an remote OSError.
+        IOError
+            An error occurred with the connection.
+        """
+        return [self.getenv(key=k) for k in keys]
+
     @classmethod
     def extract_hostname(cls, url: str) -> str:
         """
@@ -0,0 +1,200 @@
+"""
+Computes the difference between local content and an existing remote file from the block checksums
+of the remote file, similar to rsync. The remote file is split into blocks of a fixed size. Each block
+is identified by a weak adler32 checksum, which can be rolled over the local content byte by byte,
+and a strong blake2b checksum that confirms a match. The local content is then expressed as a sequence
+of copies of remote blocks and literal data.
+"""
+
+import hashlib
+import math
+import struct
+import zlib
+from typing import Iterator, NamedTuple, Optional, Union
+
+_ADLER_MOD = 65521
+
+strong_checksum_size = 16
+"""The size of the strong checksum of each block in bytes."""
+
+Buffer = Union[bytes, memoryview]
+
+class DeltaCopy(NamedTuple):
+    """Copies the given range of the remote file."""
+    offset: int
+    length: int
+
+class DeltaLiteral(NamedTuple):
+    """Sends the given range of the local content."""
+    start: int
+    end: int
+
+def block_size(size: int) -> int:
+    """
+    Returns the block size to use for a remote file of the given size. Like in rsync,
+    the block size grows with the square root of the file size, so that both the number
+    of checksums and the amount of data resent for each changed block stay moderate.
+
+    Parameters
+    ----------
+    size
+        The size of the remote file.
+
+    Returns
+    -------
+    int
+        The block size.
+    """
+    return max(2048, min(1 << 17, math.isqrt(size) & ~7))
+
+def weak_checksum(block: Buffer) -> int:
+    """Returns the weak (rolling) checksum of the given block."""
+    return zlib.adler32(block)
+
+def strong_checksum(block: Buffer) -> bytes:
+    """Returns the strong checksum of the given block."""
+    return hashlib.blake2b(block, digest_size=strong_checksum_size).digest()
+
+class _BlockIndex:
+    """Looks up remote blocks by their checksums."""
+    def __init__(self, size: int, block_size: int, weak: bytes, strong: bytes): # pylint: disable=redefined-outer-name
+        self.block_size = block_size
+        self.strong = strong
+        self.count = len(weak) // 4
+        # The last block may be shorter than the block size
+        self.last_length = size - (self.count - 1) * block_size if self.count > 0 else 0
+        self.blocks: dict[int, list[int]] = {}
+        for i, (w,) in enumerate(struct.iter_unpack(">I", weak)):
+            self.blocks.setdefault(w, []).append(i)
+
+    def find(self, weak: int, block: Buffer, expected: int) -> Optional[int]:
+        """Returns the index of a remote block with the given checksum and content, preferring the expected one."""
+        candidates = self.blocks.get(weak)
+        if candidates is None:
+            return None
+        strong = strong_checksum(block)
+        if expected in candidates and self._strong(expected) == strong:
+            return expected
+        for i in candidates:
+            if self._strong(i) == strong:
+                return i
+        return None
+
+    def _strong(self, i: int) -> bytes:
+        return self.strong[i * strong_checksum_size:(i + 1) * strong_checksum_size]
+
+def _roll(data: Buffer, index: _BlockIndex, start: int, end: int, weak: int, expected: int) -> Optional[int]:
+    """
+    Rolls the weak checksum of the window at start forward until end (exclusive)
+    and returns the first position at which a remote block matches, if any.
+    """
+    n = index.block_size
+    blocks = index.blocks
+    a = weak & 0xffff
+    b = weak >> 16
+    for pos in range(start + 1, end):
+        x_out = data[pos - 1]
+        a = (a - x_out + data[pos + n - 1]) % _ADLER_MOD
+        b = (b - n * x_out + a - 1) % _ADLER_MOD
+        w = (b << 16) | a
+        if w in blocks and index.find(w, data[pos:pos + n], expected) is not None:
+            return pos
+    return None
+
+def compute_delta(data: Buffer, size: int, block_size: int, weak: bytes, strong: bytes) -> Iterator[Union[DeltaCopy, DeltaLiteral]]: # pylint: disable=redefined-outer-name
+    """
+    Computes the delta of the given content against a remote file. Consecutive copies
+    and literals are merged. Matching blocks that are found at their expected place are
+    detected with a single checksum calculation. After a mismatch, the weak checksum is
+    rolled over the following block to detect shifted content (e.g. after an insertion),
+    unless the next block is found at its expected place.
+    If that fails, further rolling searches are spaced out exponentially, so that content
+    that has nothing in common with the remote file doesn't need to be rolled over byte by byte.
+
+    Parameters
+    ----------
+    data
+        The local content.
+    size
+        The size of the remote file.
+    block_size
+        The block size of the remote checksums.
+    weak
+        The weak checksums of the remote blocks as consecutive big-endian u32.
+    strong
+        The concatenated strong checksums of the remote blocks.
+
+    Returns
+    -------
+    Iterator[Union[DeltaCopy, DeltaLiteral]]
+        The operations that reconstruct the content.
+    """
+    # pylint: disable=too-many-locals,too-many-statements
+    index = _BlockIndex(size, block_size, weak, strong)
+    n = len(data)
+    literal_start = 0
+    copy: Optional[DeltaCopy] = None
+    expected = 0
+    skip = 0
+    backoff = 1
+
+    def match(pos: int, i: int, length: int) -> Iterator[Union[DeltaCopy, DeltaLiteral]]:
+        nonlocal copy, literal_start, expected
+        if literal_start < pos:
+            if copy is not None:
+                yield copy
+                copy = None
+            yield DeltaLiteral(literal_start, pos)
+        if copy is not None and copy.offset + copy.length == i * block_size:
+            copy = DeltaCopy(copy.offset, copy.length + length)
+        else:
+            if copy is not None:
+                yield copy
+            copy = DeltaCopy(i * block_size, length)
+        literal_start = pos + length
+        expected = i + 1
+
+    pos = 0
+    while pos + block_size <= n:
+        block = data[pos:pos + block_size]
+        w = weak_checksum(block)
+        i = index.find(w, block, expected)
+        if i is not None and (i < index.count - 1 or index.last_length == block_size):
+            yield from match(pos, i, block_size)
+            pos += block_size
+            skip = 0
+            backoff = 1
+            continue
+
+        if skip > 0:
+            skip -= 1
+            pos += block_size
+            continue
+
+        # Content that was changed in-place is followed by the next block at its expected place
+        following = data[pos + block_size:pos + 2 * block_size]
+        if len(following) == block_size and index.find(weak_checksum(following), following, expected + 1) is not None:
+            pos += block_size
+            continue
+
+        found = _roll(data, index, pos, min(pos + block_size, n - block_size + 1), w, expected)
+        if found is not None:
+            pos = found
+            continue
+        pos += block_size
+        skip = backoff
+        backoff *= 2
+
+    # The remaining content can only match a shorter last block
+    if index.count > 0 and 0 < n - pos == index.last_length < block_size:
+        block = data[pos:]
+        if index.find(weak_checksum(block), block, index.count - 1) == index.count - 1:
+            yield from match(pos, index.count - 1, n - pos)
+            pos = n
+
+    if copy is not None and literal_start == n:
+        yield copy
+    elif literal_start < n:
+        if copy is not None:
+            yield copy
+        yield DeltaLiteral(literal_start, n)
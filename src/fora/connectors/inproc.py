@@ -0,0 +1,96 @@
+"""Contains a connector which handles requests for the local machine directly in the current process."""
+
+import io
+import queue
+import traceback
+from typing import Any, Callable, Optional
+
+from fora import logger
+from fora.connectors import tunnel_dispatcher as td
+from fora.connectors.connector import connector
+from fora.connectors.tunnel_connector import TunnelConnector
+from fora.types import HostWrapper
+
+class _InprocConnection(td.Connection):
+    """
+    A connection which passes written packets on as they are, instead of serializing them.
+    Packets are immutable, so they can be shared between the sending and the receiving thread.
+    """
+
+    def __init__(self, deliver: Callable[[td.u32, td.u32, Any], None]):
+        super().__init__(io.BytesIO(), io.BytesIO())
+        self.deliver = deliver
+
+    def flush(self) -> None:
+        """Nothing is ever buffered."""
+
+    def write_packet(self, packet: Any) -> None:
+        """Passes the given packet on together with the channel and request id of this view."""
+        self.deliver(self.channel, self.request_id, packet)
+
+class _InprocDispatcher(td._Dispatcher): # pylint: disable=protected-access
+    """A dispatcher which reports unexpected exceptions to the connector instead of exiting the process."""
+
+    def __init__(self, conn: td.Connection, workers: int, frames: "queue.SimpleQueue[Optional[tuple[td.u32, td.u32, Any]]]"):
+        super().__init__(conn, workers)
+        self.frames = frames
+
+    def fail(self) -> None:
+        traceback.print_exc()
+        # Wakes up the receiving thread, which then treats the connection as broken
+        self.frames.put(None)
+
+@connector(schema='inproc')
+class InprocConnector(TunnelConnector): # pylint: disable=abstract-method
+    """
+    A tunnel connector that provides access to the current local machine by handling all requests
+    in this process, with the same packet handlers as the tunnel dispatcher. Requests are submitted
+    directly to a dispatcher running on worker threads, and the response packets are passed back
+    through a queue. Compared to `LocalConnector`, this avoids spawning a subprocess and serializing packets.
+    """
+
+    def __init__(self, url: Optional[str], host: HostWrapper):
+        super().__init__(url, host)
+
+        if url is not None and url.startswith(f"{self.schema}:"):
+            self.url = url
+        else:
+            self.url = "inproc:localhost"
+
+        self.frames: queue.SimpleQueue[Optional[tuple[td.u32, td.u32, Any]]] = queue.SimpleQueue()
+        self.server_conn: _InprocConnection
+        self.dispatcher: _InprocDispatcher
+
+    def open(self) -> None:
+        logger.connection_init(self)
+        self.frames = queue.SimpleQueue()
+        self.server_conn = _InprocConnection(lambda channel, request_id, packet: self.frames.put((channel, request_id, packet)))
+        self.dispatcher = _InprocDispatcher(self.server_conn, td.max_workers, self.frames)
+        self.conn = _InprocConnection(self.dispatcher.submit)
+        try:
+            self._handshake()
+        except IOError as e:
+            logger.connection_failed(str(e))
+            raise
+        self.is_open = True
+        logger.connection_established()
+
+    def close(self) -> None:
+        if self.is_open:
+            self.is_open = False
+            td._close_session(self.server_conn, self.dispatcher) # pylint: disable=protected-access
+
+    def _receive_frame(self) -> tuple[td.u32, td.u32, Any]:
+        frame = self.frames.get()
+        if frame is None:
+            # Let any other receiving thread see the failure, too
+            self.frames.put(None)
+            raise IOError("Unexpected exception in the in-process dispatcher")
+        return frame
+
+    @classmethod
+    def extract_hostname(cls, url: str) -> str:
+        if not url.startswith(f"{cls.schema}:"):
+            raise ValueError(f"Cannot extract hostname from url without matching schema (expected '{cls.schema}', got '{url}').")
+        hostname = url[len(cls.schema) + 1:]
+        return hostname if len(hostname) > 0 else "localhost"
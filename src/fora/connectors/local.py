@@ -3,7 +3,6 @@
 import os
 from typing import Optional
 
-import fora
 from fora.connectors import tunnel_dispatcher as td
 from fora.connectors.connector import connector
 from fora.connectors.tunnel_connector import TunnelConnector
@@ -30,10 +29,7 @@ class LocalConnector(TunnelConnector):
         list[str]
             The required ssh command.
         """
-        command = ["python3", os.path.realpath(td.__file__)]
-        if fora.args.debug:
-            command.append("--debug")
-        return command
+        return ["python3", os.path.realpath(td.__file__)] + self.dispatcher_args()
 
     @classmethod
     def extract_hostname(cls, url: str) -> str:
@@ -1,15 +1,141 @@
 """Contains a connector which handles connections to hosts via SSH."""
 
 import base64
+import hashlib
+import os
+import shlex
+import stat
+import subprocess
+import tempfile
 import zlib
 from typing import Optional
 
 import fora
-from fora.connectors import tunnel_dispatcher as td
+from fora import logger
 from fora.connectors.connector import connector
-from fora.connectors.tunnel_connector import TunnelConnector
+from fora.connectors.tunnel_connector import TunnelConnector, dispatcher_source, dispatcher_version
 from fora.types import HostWrapper
 
+# Runs on the remote host with the version hash and the size of the compressed dispatcher as arguments.
+# Imports the cached dispatcher for this version, so python can reuse its bytecode. On a miss, it
+# requests the compressed dispatcher on stdin by writing b"U" and stores it in the cache together
+# with its bytecode first.
+# If the cache is not writable, the received dispatcher is executed directly.
+_BOOTSTRAP_LOADER = """
+import os, py_compile, sys, tempfile, zlib
+h, n = sys.argv[1], int(sys.argv[2])
+d = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "fora")
+m = "tunnel_dispatcher_" + h
+f = os.path.join(d, m + ".py")
+sys.argv = [f] + sys.argv[3:]
+if os.path.exists(f):
+    os.write(1, b"C")
+else:
+    os.write(1, b"U")
+    data = b""
+    while len(data) < n:
+        chunk = os.read(0, n - len(data))
+        if not chunk:
+            sys.exit(3)
+        data += chunk
+    code = zlib.decompress(data)
+    try:
+        os.makedirs(d, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=d, prefix="." + m)
+        with os.fdopen(fd, "wb") as t:
+            t.write(code)
+        os.replace(tmp, f)
+        py_compile.compile(f, doraise=True)
+    except (OSError, py_compile.PyCompileError):
+        exec(compile(code, f, "exec"), {"__name__": "__main__"})
+        sys.exit(0)
+sys.path.insert(0, d)
+__import__(m)._main()
+"""
+
+class ControlMasterPool:
+    """
+    Manages shared ssh master connections (ControlMaster) in a private socket directory,
+    so that subsequent connections to the same host skip the key exchange and authentication.
+    The masters outlive fora for the configured ControlPersist time, so they are also reused
+    by later invocations.
+    """
+
+    ssh_program: str = "ssh"
+    """The ssh executable that is used for all commands."""
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory if directory is not None else self.default_directory()
+
+    @staticmethod
+    def default_directory() -> str:
+        """Returns the default socket directory, a private directory in $XDG_RUNTIME_DIR or the temporary directory."""
+        return os.path.join(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), f"fora-ssh-{os.getuid()}")
+
+    def ensure_directory(self) -> bool:
+        """Creates the socket directory if necessary and returns whether it is private to the current user."""
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            s = os.lstat(self.directory)
+        except OSError:
+            return False
+        return stat.S_ISDIR(s.st_mode) and s.st_uid == os.getuid() and (s.st_mode & 0o077) == 0
+
+    def socket(self, url: str, ssh_opts: list[str]) -> str:
+        """Returns the control socket for the given destination. The name is hashed to stay below the socket path length limit."""
+        key = hashlib.sha256("\0".join([url] + ssh_opts).encode()).hexdigest()[:24]
+        return os.path.join(self.directory, f"{key}.sock")
+
+    def run(self, args: list[str]) -> int:
+        """Runs an ssh control command with the given arguments and returns its exit code."""
+        return subprocess.run([self.ssh_program] + args, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False).returncode
+
+    def check(self, socket: str, url: str) -> bool:
+        """Returns whether a live master is listening on the given socket."""
+        return os.path.exists(socket) and self.run(["-S", socket, "-O", "check", url]) == 0
+
+    def options(self, url: str, ssh_opts: list[str], persist: int) -> list[str]:
+        """
+        Returns the ssh options that attach a connection to the shared master for the
+        given destination, or start a new master if none is alive. Sockets of dead
+        masters are removed first.
+
+        Parameters
+        ----------
+        url
+            The destination.
+        ssh_opts
+            Additional ssh options of the destination, which are part of the identity of the master.
+        persist
+            The time in seconds an idle master is kept alive. 0 closes the master together with its first connection.
+
+        Returns
+        -------
+        list[str]
+            The ssh options, or an empty list if the socket directory is not usable.
+        """
+        if not self.ensure_directory():
+            logger.debug(f"ssh control directory {self.directory} is not private, not sharing connections")
+            return []
+
+        socket = self.socket(url, ssh_opts)
+        if os.path.exists(socket) and not self.check(socket, url):
+            try:
+                os.unlink(socket)
+            except FileNotFoundError:
+                pass
+
+        return ["-o", "ControlMaster=auto",
+                "-o", f"ControlPath={socket}",
+                "-o", f"ControlPersist={persist if persist > 0 else 'no'}"]
+
+    def close(self, url: str, ssh_opts: list[str]) -> None:
+        """Asks the master for the given destination to exit, if one is running."""
+        socket = self.socket(url, ssh_opts)
+        if os.path.exists(socket):
+            self.run(["-S", socket, "-O", "exit", url])
+
 @connector(schema='ssh')
 class SshConnector(TunnelConnector):
     """A tunnel connector that provides remote access via SSH."""
@@ -28,6 +154,44 @@ class SshConnector(TunnelConnector):
         else:
             self.url: str = f"{self.schema}://{host.ssh_host}:{host.ssh_port}"
 
+        self.control_persist: Optional[int] = getattr(host, "ssh_control_persist", None)
+        self.control_pool: Optional[ControlMasterPool] = None
+        if self.control_persist is not None:
+            self.control_pool = ControlMasterPool(getattr(host, "ssh_control_dir", None))
+
+        self.dispatcher_cache: bool = getattr(fora.args, "dispatcher_cache", True)
+        self.dispatcher_version: str = ""
+        self.dispatcher_gz: bytes = b""
+
+    def _load_dispatcher(self) -> None:
+        """Loads and compresses the tunnel dispatcher and determines its version hash."""
+        if self.dispatcher_gz:
+            return
+        self.dispatcher_version = dispatcher_version()
+        self.dispatcher_gz = zlib.compress(dispatcher_source(), 9)
+
+    def remote_command(self) -> str:
+        """
+        Constructs the shell command that starts the tunnel dispatcher on the remote host.
+        By default, a cached copy of the dispatcher in ~/.cache/fora on the remote host is
+        started, which is transferred by `SshConnector.bootstrap` only if it is missing.
+        Otherwise, the dispatcher is passed inline as base64 in the command itself.
+
+        Returns
+        -------
+        str
+            The remote command.
+        """
+        self._load_dispatcher()
+        params = " ".join(self.dispatcher_args())
+
+        if self.dispatcher_cache:
+            return f"env python3 -c {shlex.quote(_BOOTSTRAP_LOADER)} {self.dispatcher_version} {len(self.dispatcher_gz)} {params}"
+
+        # Start the remote dispatcher by uploading it inline as base64
+        tunnel_dispatcher_gz_b64 = base64.b64encode(self.dispatcher_gz).decode('ascii')
+        return f"env python3 -c \"$(echo '{tunnel_dispatcher_gz_b64}' | base64 -d | python -c 'import zlib,sys;sys.stdout.buffer.write(zlib.decompress(sys.stdin.buffer.read()))')\" {params}"
+
     def command(self) -> list[str]:
         """
         Constructs the full ssh command needed to execute a
@@ -38,19 +202,21 @@ class SshConnector(TunnelConnector):
         list[str]
             The required ssh command.
         """
-        with open(td.__file__, 'rb') as f:
-            tunnel_dispatcher_gz_b64 = base64.b64encode(zlib.compress(f.read(), 9)).decode('ascii')
-
-        # Start the remote dispatcher by uploading it inline as base64
-        param_debug = "--debug" if fora.args.debug else ""
-
-        command = ["ssh"]
+        command = [ControlMasterPool.ssh_program]
         command.extend(self.ssh_opts)
+        if self.control_pool is not None and self.control_persist is not None:
+            command.extend(self.control_pool.options(self.url, self.ssh_opts, self.control_persist))
         command.append(self.url)
-        command.append(f"env python3 -c \"$(echo '{tunnel_dispatcher_gz_b64}' | base64 -d | python -c 'import zlib,sys;sys.stdout.buffer.write(zlib.decompress(sys.stdin.buffer.read()))')\" {param_debug}")
-
+        command.append(self.remote_command())
         return command
 
+    def bootstrap_payload(self) -> Optional[bytes]:
+        """Returns the compressed tunnel dispatcher, which is uploaded if the remote host has no cached copy of this version."""
+        if not self.dispatcher_cache:
+            return None
+        self._load_dispatcher()
+        return self.dispatcher_gz
+
     @classmethod
     def extract_hostname(cls, url: str) -> str:
         if not url.startswith(f"{cls.schema}:"):
@@ -1,14 +1,66 @@
 """Contains a connector base which handles communication via any spawned subprocess command that can run a tunnel dispatcher on the remote host."""
 
+import functools
+import hashlib
+import itertools
+import mmap
+import os
+import stat
 import sys
 import subprocess
-from typing import Any, Optional, Type, cast
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Callable, Generator, Iterable, Iterator, Optional, Type, Union, cast
 
+import fora
 from fora import logger
-from fora.connectors import tunnel_dispatcher as td
-from fora.connectors.connector import CompletedRemoteCommand, Connector, GroupEntry, StatResult, UserEntry
+from fora.connectors import delta, tunnel_dispatcher as td
+from fora.connectors.connector import CompletedRemoteCommand, Connector, GroupEntry, PendingRemoteCommand, StatResult, UserEntry
 from fora.types import HostWrapper
 
+@functools.cache
+def dispatcher_source() -> bytes:
+    """Returns the source code of the tunnel dispatcher."""
+    with open(td.__file__, 'rb') as f:
+        return f.read()
+
+def dispatcher_version() -> str:
+    """Returns a hash that identifies the version of the tunnel dispatcher."""
+    return hashlib.sha256(dispatcher_source()).hexdigest()[:32]
+
+def _stat_result(packet: td.PacketStatResult) -> StatResult:
+    """Converts a PacketStatResult to a StatResult."""
+    return StatResult(
+        type=packet.type,
+        mode=packet.mode,
+        owner=packet.owner,
+        group=packet.group,
+        size=packet.size,
+        mtime=packet.mtime,
+        ctime=packet.ctime,
+        sha512sum=packet.sha512sum)
+
+def _user_entry(packet: td.PacketUserEntry) -> UserEntry:
+    """Converts a PacketUserEntry to a UserEntry."""
+    return UserEntry(
+        name=packet.name,
+        uid=packet.uid,
+        group=packet.group,
+        gid=packet.gid,
+        groups=packet.groups,
+        password_hash=packet.password_hash,
+        gecos=packet.gecos,
+        home=packet.home,
+        shell=packet.shell)
+
+def _group_entry(packet: td.PacketGroupEntry) -> GroupEntry:
+    """Converts a PacketGroupEntry to a GroupEntry."""
+    return GroupEntry(
+        name=packet.name,
+        gid=packet.gid,
+        members=packet.members)
+
 def _expect_response_packet(packet: Any, expected_type: Type) -> None:
     """
     Check if the given packet is of the expected type, otherwise raise a IOError.
@@ -23,21 +75,95 @@ def _expect_response_packet(packet: Any, expected_type: Type) -> None:
     if not isinstance(packet, expected_type):
         raise IOError(f"Invalid response '{type(packet)}' from remote dispatcher. This is a bug.")
 
+class _Channel:
+    """
+    The request state of a single thread on a tunnel connection. Each thread sends its
+    requests on its own channel, so the remote dispatcher handles them in order, while
+    requests from different threads are handled concurrently.
+    """
+    def __init__(self, channel_id: td.u32):
+        self.id = channel_id
+        self.pipeline_depth: int = 0
+        self.pending: list[tuple[td.u32, Any, Callable[[Any], None]]] = []
+
+# pylint: disable=too-many-public-methods
 class TunnelConnector(Connector):
     """A connector that handles requests via an externally supplied subprocess running a tunnel dispatcher.
     Any subclass must override command()."""
 
+    chunk_size: int = 1 << 20
+    """The size of the chunks in which content is sent in streaming uploads and downloads."""
+
+    download_window: int = 4
+    """The number of chunks that are requested ahead of time in streaming downloads."""
+
+    delta_threshold: int = 16 << 20
+    """Content of at least this size is sent as a delta to the existing remote file in `TunnelConnector.upload_delta`.
+    Smaller content is uploaded as a whole, as calculating the delta would take longer than the round trip it costs."""
+
+    max_pending: int = 32
+    """The maximum number of pipelined requests whose responses are outstanding. Bounds the amount
+    of unread response data, so the remote dispatcher can never block on a full pipe while we are still writing."""
+
     def __init__(self, url: Optional[str], host: HostWrapper):
         super().__init__(url, host)
 
         self.process: Optional[subprocess.Popen] = None
         self.conn: td.Connection
         self.is_open: bool = False
+        self.blob_store: bool = False
+        self.same_machine: bool = False
+
+        self.local = threading.local()
+        self.next_channel_id = itertools.count(1)
+        self.next_request_id = itertools.count(1)
+        self.next_stream_id = itertools.count(1)
+        # Responses that were received by another thread than the one waiting for them, by request id.
+        self.responses: dict[int, deque[Any]] = {}
+        self.responses_cv = threading.Condition()
+        self.is_receiving: bool = False
 
     def command(self) -> list[str]:
         """Returns the command that should be executed to open a tunnel dispatcher to the destination."""
         raise NotImplementedError("Must be overwritten by subclass.")
 
+    def dispatcher_args(self) -> list[str]:
+        """Returns the command line arguments for the tunnel dispatcher, as selected by --debug and --remote-daemon."""
+        args = ["--debug"] if fora.args.debug else []
+        idle_timeout = int(getattr(fora.args, "remote_daemon", 0) or 0)
+        if idle_timeout > 0:
+            args.extend(["--daemon", dispatcher_version(), str(idle_timeout)])
+        return args
+
+    def bootstrap(self) -> None:
+        """Called after the command has been started and before the first packet is sent.
+        Subclasses can use this to transfer the tunnel dispatcher to the remote host if necessary.
+        By default, this sends the `TunnelConnector.bootstrap_payload` when the command requests it."""
+        payload = self.bootstrap_payload() # pylint: disable=assignment-from-none
+        if payload is None:
+            return
+
+        status = self.conn.read(1)
+        if status == b"U":
+            self.conn.write(payload, len(payload))
+            self.conn.flush()
+        elif status != b"C":
+            raise IOError("Unexpected response while starting the tunnel dispatcher")
+
+    def bootstrap_payload(self) -> Optional[bytes]:
+        """Returns the data the command may request before it starts the tunnel dispatcher, or None if it
+        starts the dispatcher right away. The command first writes b"U" if it needs the data, and b"C" otherwise."""
+        return None
+
+    def compression_preference(self) -> list[str]:
+        """Returns the compression algorithms to offer to the remote dispatcher in order of
+        preference, as selected by the --compression option. Falls back to zlib if the
+        remote doesn't support lzma."""
+        compression = getattr(fora.args, "compression", None) or "none"
+        if compression == "none":
+            return []
+        return [compression] if compression == "zlib" else [compression, "zlib"]
+
     def open(self) -> None:
         logger.connection_init(self)
 
@@ -49,8 +175,8 @@ class TunnelConnector(Connector):
         self.conn = td.Connection(self.process.stdout, self.process.stdin)
 
         try:
-            response = self._request(td.PacketCheckAlive())
-            _expect_response_packet(response, td.PacketAck)
+            self.bootstrap()
+            self._handshake()
 
             # As a last action record that the connection is opened successfully,
             # otherwise the finally block will kill the process.
@@ -70,6 +196,25 @@ class TunnelConnector(Connector):
 
         logger.connection_established()
 
+    def handshake_request(self) -> td.PacketCheckAlive:
+        """Returns the first request sent to the dispatcher, which checks that it is alive and
+        negotiates compression, the digest cache and the blob store as selected by the command line options."""
+        blob_store_size = int(getattr(fora.args, "blob_store_size", 0) or 0) << 20
+        return td.PacketCheckAlive(
+            compression=self.compression_preference(),
+            digest_cache=bool(getattr(fora.args, "digest_cache", False)),
+            blob_store_size=td.u64(blob_store_size),
+            boot_id=td.boot_id())
+
+    def _handshake(self) -> None:
+        """Checks that the dispatcher is alive and negotiates compression, the digest cache and the blob store."""
+        request = self.handshake_request()
+        response = self._request(request)
+        _expect_response_packet(response, td.PacketAck)
+        self.conn.compressor.algorithm = cast(td.PacketAck, response).compression
+        self.blob_store = request.blob_store_size > 0
+        self.same_machine = cast(td.PacketAck, response).same_machine
+
     def close(self) -> None:
         if self.is_open:
             self.conn.write_packet(td.PacketExit())
@@ -82,11 +227,122 @@ class TunnelConnector(Connector):
                 self.process.stdout.close()
             self.process = None
 
+    def _channel(self) -> _Channel:
+        """Returns the channel of the current thread."""
+        channel = getattr(self.local, "channel", None)
+        if channel is None:
+            channel = _Channel(td.u32(next(self.next_channel_id)))
+            self.local.channel = channel
+        return channel
+
+    @property
+    def pending(self) -> list[tuple[td.u32, Any, Callable[[Any], None]]]:
+        """The pipelined requests of the current thread, whose responses are still outstanding."""
+        return self._channel().pending
+
+    @contextmanager
+    def pipeline(self) -> Iterator[None]:
+        channel = self._channel()
+        channel.pipeline_depth += 1
+        try:
+            yield
+        except BaseException:
+            channel.pipeline_depth -= 1
+            if channel.pipeline_depth == 0:
+                # Keep the connection in sync, but don't mask the original exception.
+                self._drain(raise_errors=False)
+            raise
+        channel.pipeline_depth -= 1
+        if channel.pipeline_depth == 0:
+            self._drain()
+
+    def _drain(self, raise_errors: bool = True) -> None:
+        """
+        Receives the responses of all pending pipelined requests in order and passes
+        each to its response handler. Connection errors are propagated immediately,
+        while errors of the individual requests are collected and the first one is raised
+        after all responses have been received.
+        """
+        channel = self._channel()
+        pending, channel.pending = channel.pending, []
+        error: Optional[Exception] = None
+        for request_id, request, on_response in pending:
+            try:
+                on_response(td.check_response(self._receive(request_id), request=request))
+            except (td.RemoteOSError, ValueError, subprocess.CalledProcessError) as e:
+                if error is None:
+                    error = e
+        if error is not None and raise_errors:
+            raise error
+
+    def _send(self, packet: Any, channel: _Channel) -> td.u32:
+        """Sends the request packet on the given channel and returns its request id.
+        Inside of a pipeline block, the packet is only written when the connection is flushed
+        before the next response is awaited, so that consecutive requests are sent together."""
+        request_id = td.u32(next(self.next_request_id) & 0xffffffff)
+        conn = self.conn.for_request(channel.id, request_id)
+        conn.flush_writes = channel.pipeline_depth == 0
+        conn.write_packet(packet)
+        return request_id
+
+    def _receive(self, request_id: td.u32) -> Any:
+        """
+        Returns the next response packet for the given request id. Only one thread reads
+        from the connection at a time, and responses for other requests are set aside
+        for the threads waiting for them.
+        """
+        # The request may still be waiting to be sent together with other pipelined requests
+        self.conn.flush()
+        with self.responses_cv:
+            while True:
+                queue = self.responses.get(request_id)
+                if queue:
+                    packet = queue.popleft()
+                    if len(queue) == 0:
+                        del self.responses[request_id]
+                    return packet
+                if not self.is_receiving:
+                    self.is_receiving = True
+                    break
+                self.responses_cv.wait()
+
+        try:
+            while True:
+                _, response_id, packet = self._receive_frame()
+                if response_id == request_id:
+                    return packet
+                with self.responses_cv:
+                    self.responses.setdefault(response_id, deque()).append(packet)
+                    self.responses_cv.notify_all()
+        finally:
+            with self.responses_cv:
+                self.is_receiving = False
+                self.responses_cv.notify_all()
+
+    def _receive_frame(self) -> tuple[td.u32, td.u32, Any]:
+        """Receives the next response from the dispatcher together with its channel and request id."""
+        return td.receive_frame(self.conn)
+
     def _request(self, packet: Any) -> Any:
         """Sends the request packet and returns the response.
-        Propagates exceptions from raised from td.receive_packet."""
-        self.conn.write_packet(packet)
-        return td.receive_packet(self.conn, request=packet)
+        Propagates exceptions from raised from td.check_response.
+        Any pending pipelined requests are completed first."""
+        channel = self._channel()
+        if len(channel.pending) > 0:
+            self._drain()
+        return td.check_response(self._receive(self._send(packet, channel)), request=packet)
+
+    def _request_deferred(self, packet: Any, on_response: Callable[[Any], None]) -> None:
+        """Sends the request packet and passes the response to the given handler.
+        Inside of a pipeline block, the response will be received later
+        and any exception raised by the handler is deferred until then."""
+        channel = self._channel()
+        if channel.pipeline_depth == 0:
+            on_response(self._request(packet))
+            return
+        if len(channel.pending) >= self.max_pending:
+            self._drain()
+        channel.pending.append((self._send(packet, channel), packet, on_response))
 
     def run(self,
             command: list[str],
@@ -106,24 +362,101 @@ class TunnelConnector(Connector):
             group=group,
             umask=umask,
             cwd=cwd)
-        response = self._request(request)
 
+        def to_result(response: Any) -> CompletedRemoteCommand:
+            if isinstance(response, td.PacketProcessError):
+                raise ValueError(response.message)
+
+            _expect_response_packet(response, td.PacketProcessCompleted)
+            result = CompletedRemoteCommand(stdout=response.stdout,
+                                            stderr=response.stderr,
+                                            returncode=response.returncode)
+
+            # Check output if requested
+            if check and result.returncode != 0:
+                raise subprocess.CalledProcessError(returncode=result.returncode,
+                                                    output=result.stdout,
+                                                    stderr=result.stderr,
+                                                    cmd=command)
+            return result
+
+        if self._channel().pipeline_depth == 0:
+            return to_result(self._request(request))
+
+        pending = PendingRemoteCommand(self._drain)
+        self._request_deferred(request, lambda response: pending.complete(to_result(response)))
+        return pending
+
+    def run_stream(self,
+                   command: list[str],
+                   input: Union[None, bytes, Iterable[bytes]] = None, # pylint: disable=redefined-builtin
+                   check: bool = True,
+                   user: Optional[str] = None,
+                   group: Optional[str] = None,
+                   umask: Optional[str] = None,
+                   cwd: Optional[str] = None) -> Generator[tuple[int, bytes], None, CompletedRemoteCommand]:
+        channel = self._channel()
+        if len(channel.pending) > 0:
+            self._drain()
+
+        request = td.PacketProcessStart(
+            command=command,
+            stdin=input is not None,
+            user=user,
+            group=group,
+            umask=umask,
+            cwd=cwd)
+        request_id = self._send(request, channel)
+
+        response = td.check_response(self._receive(request_id), request=request)
         if isinstance(response, td.PacketProcessError):
             raise ValueError(response.message)
+        _expect_response_packet(response, td.PacketOk)
 
-        _expect_response_packet(response, td.PacketProcessCompleted)
-        result = CompletedRemoteCommand(stdout=response.stdout,
-                                        stderr=response.stderr,
-                                        returncode=response.returncode)
-
-        # Check output if requested
-        if check and result.returncode != 0:
-            raise subprocess.CalledProcessError(returncode=result.returncode,
-                                                output=result.stdout,
-                                                stderr=result.stderr,
-                                                cmd=command)
+        # The input is sent from a separate thread (and thereby on a separate channel),
+        # so that a command which only reads its input after writing output can't dead-lock us.
+        input_error: list[BaseException] = []
+        if input is not None:
+            threading.Thread(target=self._feed_input, args=(request_id, input, input_error), daemon=True).start()
 
-        return result
+        completed = False
+        try:
+            while True:
+                response = td.check_response(self._receive(request_id), request=request)
+                if isinstance(response, td.PacketProcessOutput):
+                    yield (response.fd, response.data)
+                    continue
+                _expect_response_packet(response, td.PacketProcessCompleted)
+                completed = True
+                break
+        finally:
+            if not completed:
+                # Kill the process of a prematurely closed stream and consume the remaining responses
+                self._send(td.PacketProcessKill(process=request_id), channel)
+                while not isinstance(self._receive(request_id), td.PacketProcessCompleted):
+                    pass
+
+        if len(input_error) > 0:
+            raise input_error[0]
+
+        returncode = cast(td.PacketProcessCompleted, response).returncode
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode=returncode, cmd=command)
+        return CompletedRemoteCommand(stdout=None, stderr=None, returncode=returncode)
+
+    def _feed_input(self, process: td.u32, input: Union[bytes, Iterable[bytes]], error: list[BaseException]) -> None: # pylint: disable=redefined-builtin
+        """Sends the given input to the stdin of a streaming process and closes it afterwards.
+        An exception raised while producing the input is stored in error."""
+        channel = self._channel()
+        content = input
+        chunks = (content[i:i + self.chunk_size] for i in range(0, len(content), self.chunk_size)) if isinstance(content, bytes) else content
+        try:
+            for chunk in chunks:
+                self._send(td.PacketProcessInput(process=process, data=chunk), channel)
+        except BaseException as e: # pylint: disable=broad-except
+            error.append(e)
+        finally:
+            self._send(td.PacketProcessInput(process=process, data=b"", eof=True), channel)
 
     def stat(self, path: str, follow_links: bool = False, sha512sum: bool = False) -> Optional[StatResult]:
         # Construct and send packet with process information
@@ -139,15 +472,17 @@ class TunnelConnector(Connector):
             return None
 
         _expect_response_packet(response, td.PacketStatResult)
-        return StatResult(
-            type=response.type,
-            mode=response.mode,
-            owner=response.owner,
-            group=response.group,
-            size=response.size,
-            mtime=response.mtime,
-            ctime=response.ctime,
-            sha512sum=response.sha512sum)
+        return _stat_result(response)
+
+    def stat_many(self, paths: list[str], follow_links: bool = False, sha512sum: bool = False) -> list[Optional[StatResult]]:
+        request = td.PacketStatMany(
+            paths=paths,
+            follow_links=follow_links,
+            sha512sum=sha512sum)
+        response = self._request(request)
+
+        _expect_response_packet(response, td.PacketStatManyResult)
+        return [None if r is None else _stat_result(r) for r in cast(td.PacketStatManyResult, response).results]
 
     def resolve_user(self, user: Optional[str]) -> str:
         request = td.PacketResolveUser(user=user)
@@ -163,31 +498,47 @@ class TunnelConnector(Connector):
         _expect_response_packet(response, td.PacketResolveResult)
         return cast(td.PacketResolveResult, response).value
 
+    def resolve_user_many(self, users: list[Optional[str]]) -> list[Optional[str]]:
+        request = td.PacketResolveUserMany(users=users)
+        response = self._request(request)
+
+        _expect_response_packet(response, td.PacketResolveManyResult)
+        return cast(td.PacketResolveManyResult, response).values
+
+    def resolve_group_many(self, groups: list[Optional[str]]) -> list[Optional[str]]:
+        request = td.PacketResolveGroupMany(groups=groups)
+        response = self._request(request)
+
+        _expect_response_packet(response, td.PacketResolveManyResult)
+        return cast(td.PacketResolveManyResult, response).values
+
     def query_user(self, user: str, query_password_hash: bool = False) -> UserEntry:
         request = td.PacketQueryUser(user=user, query_password_hash=query_password_hash)
         response = self._request(request)
 
         _expect_response_packet(response, td.PacketUserEntry)
-        return UserEntry(
-            name=response.name,
-            uid=response.uid,
-            group=response.group,
-            gid=response.gid,
-            groups=response.groups,
-            password_hash=response.password_hash,
-            gecos=response.gecos,
-            home=response.home,
-            shell=response.shell)
+        return _user_entry(response)
 
     def query_group(self, group: str) -> GroupEntry:
         request = td.PacketQueryGroup(group=group)
         response = self._request(request)
 
         _expect_response_packet(response, td.PacketGroupEntry)
-        return GroupEntry(
-            name=response.name,
-            gid=response.gid,
-            members=response.members)
+        return _group_entry(response)
+
+    def query_user_many(self, users: list[str], query_password_hash: bool = False) -> list[Optional[UserEntry]]:
+        request = td.PacketQueryUserMany(users=users, query_password_hash=query_password_hash)
+        response = self._request(request)
+
+        _expect_response_packet(response, td.PacketUserEntries)
+        return [None if e is None else _user_entry(e) for e in cast(td.PacketUserEntries, response).entries]
+
+    def query_group_many(self, groups: list[str]) -> list[Optional[GroupEntry]]:
+        request = td.PacketQueryGroupMany(groups=groups)
+        response = self._request(request)
+
+        _expect_response_packet(response, td.PacketGroupEntries)
+        return [None if e is None else _group_entry(e) for e in cast(td.PacketGroupEntries, response).entries]
 
     def getenv(self, key: str) -> Optional[str]:
         request = td.PacketGetenv(key=key)
@@ -196,20 +547,206 @@ class TunnelConnector(Connector):
         _expect_response_packet(response, td.PacketEnvironVar)
         return cast(td.PacketEnvironVar, response).value
 
+    def getenv_many(self, keys: list[str]) -> list[Optional[str]]:
+        request = td.PacketGetenvMany(keys=keys)
+        response = self._request(request)
+
+        _expect_response_packet(response, td.PacketEnvironVars)
+        return cast(td.PacketEnvironVars, response).values
+
     def upload(self,
             file: str,
             content: bytes,
             mode: Optional[str] = None,
             owner: Optional[str] = None,
             group: Optional[str] = None) -> None:
+        if len(content) > self.chunk_size:
+            # Avoid holding the whole content in a single packet on the remote
+            chunks = (content[i:i + self.chunk_size] for i in range(0, len(content), self.chunk_size))
+            self._upload_chunks(file=file, chunks=chunks, mode=mode, owner=owner, group=group)
+            return
+
         request = td.PacketUpload(
                 file=file,
                 content=content,
                 mode=mode,
                 owner=owner,
                 group=group)
-        response = self._request(request)
-        _expect_response_packet(response, td.PacketOk)
+        self._request_deferred(request, lambda response: _expect_response_packet(response, td.PacketOk))
+
+    def upload_stream(self,
+                      file: str,
+                      stream: BinaryIO,
+                      mode: Optional[str] = None,
+                      owner: Optional[str] = None,
+                      group: Optional[str] = None) -> None:
+        chunks = iter(lambda: stream.read(self.chunk_size), b"")
+        self._upload_chunks(file=file, chunks=chunks, mode=mode, owner=owner, group=group)
+
+    def _upload_chunks(self,
+                       file: str,
+                       chunks: Iterator[bytes],
+                       mode: Optional[str],
+                       owner: Optional[str],
+                       group: Optional[str]) -> None:
+        """Uploads the content given as chunks in a streaming upload. The whole upload is pipelined,
+        so the chunks are sent back-to-back and only the final result is awaited."""
+        stream_id = td.u32(next(self.next_stream_id) & 0xffffffff)
+        channel = self._channel()
+        def expect_ok(response: Any) -> None:
+            _expect_response_packet(response, td.PacketOk)
+        sha512 = hashlib.sha512()
+
+        with self.pipeline():
+            self._request_deferred(td.PacketUploadBegin(stream=stream_id, file=file, mode=mode, owner=owner, group=group), expect_ok)
+            try:
+                for chunk in chunks:
+                    sha512.update(chunk)
+                    self._send(td.PacketUploadChunk(stream=stream_id, data=chunk), channel)
+            except BaseException:
+                self._send(td.PacketUploadAbort(stream=stream_id), channel)
+                raise
+            self._request_deferred(td.PacketUploadEnd(stream=stream_id, sha512sum=sha512.digest()), expect_ok)
+
+    def upload_delta(self,
+                     file: str,
+                     stream: BinaryIO,
+                     mode: Optional[str] = None,
+                     owner: Optional[str] = None,
+                     group: Optional[str] = None) -> None:
+        start = stream.tell()
+        size = stream.seek(0, os.SEEK_END) - start
+        stream.seek(start)
+        if size < self.delta_threshold:
+            if size <= self.chunk_size:
+                self.upload(file=file, content=stream.read(), mode=mode, owner=owner, group=group)
+            else:
+                self.upload_stream(file=file, stream=stream, mode=mode, owner=owner, group=group)
+            return
+
+        # Errors of earlier pipelined requests must be raised, and not be mistaken for a failed delta
+        if len(self._channel().pending) > 0:
+            self._drain()
+
+        try:
+            # Map the content if possible, so that large files are not read into memory
+            m: Optional[mmap.mmap] = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            m = None
+
+        try:
+            with (memoryview(m)[start:] if m is not None else memoryview(stream.read())) as data:
+                sent = self._upload_delta(file, data, mode=mode, owner=owner, group=group)
+        finally:
+            if m is not None:
+                m.close()
+
+        if not sent:
+            stream.seek(start)
+            self.upload_stream(file=file, stream=stream, mode=mode, owner=owner, group=group)
+
+    def _upload_delta(self,
+                      file: str,
+                      data: memoryview,
+                      mode: Optional[str],
+                      owner: Optional[str],
+                      group: Optional[str]) -> bool:
+        """Uploads the given content as a delta to the existing remote file. Returns False
+        if the remote file doesn't exist or the delta couldn't be applied, so the content
+        must be uploaded as a whole instead. There must be no pending pipelined requests."""
+        # pylint: disable=too-many-locals
+        sha512sum = hashlib.sha512(data).digest()
+
+        size = len(data)
+        try:
+            response = self._request(td.PacketChecksumBlocks(file=file, block_size=td.u32(delta.block_size(size))))
+        except (ValueError, td.RemoteOSError):
+            # The remote file doesn't exist or can't be read
+            return False
+        _expect_response_packet(response, td.PacketBlockChecksums)
+        checksums = cast(td.PacketBlockChecksums, response)
+        block_size = delta.block_size(size)
+
+        stream_id = td.u32(next(self.next_stream_id) & 0xffffffff)
+        channel = self._channel()
+        begin = td.PacketUploadBegin(stream=stream_id, file=file, mode=mode, owner=owner, group=group)
+        begin_id = self._send(begin, channel)
+        try:
+            for op in delta.compute_delta(data, checksums.size, block_size, checksums.weak, checksums.strong):
+                if isinstance(op, delta.DeltaCopy):
+                    self._send(td.PacketUploadCopy(stream=stream_id, offset=td.u64(op.offset), length=td.u64(op.length)), channel)
+                    continue
+                for i in range(op.start, op.end, self.chunk_size):
+                    chunk = bytes(data[i:min(i + self.chunk_size, op.end)])
+                    self._send(td.PacketUploadChunk(stream=stream_id, data=chunk), channel)
+        except BaseException:
+            self._send(td.PacketUploadAbort(stream=stream_id), channel)
+            self._receive(begin_id)
+            raise
+
+        end = td.PacketUploadEnd(stream=stream_id, sha512sum=sha512sum)
+        end_id = self._send(end, channel)
+        begin_response = self._receive(begin_id)
+        end_response = self._receive(end_id)
+        try:
+            _expect_response_packet(td.check_response(begin_response, request=begin), td.PacketOk)
+            _expect_response_packet(td.check_response(end_response, request=end), td.PacketOk)
+        except (ValueError, td.RemoteOSError):
+            # The delta couldn't be applied, e.g. because the remote file was changed in the meantime
+            return False
+        return True
+
+    def upload_path(self,
+                    file: str,
+                    source: str,
+                    mode: Optional[str] = None,
+                    owner: Optional[str] = None,
+                    group: Optional[str] = None,
+                    delta: bool = False) -> None: # pylint: disable=redefined-outer-name
+        if self.same_machine:
+            # The dispatcher copies the file itself, after verifying that it sees the same file as we do.
+            # The file may still be unreachable for it, e.g. in another mount namespace or without permissions.
+            s = os.stat(source)
+            if stat.S_ISREG(s.st_mode):
+                request = td.PacketUploadPath(
+                        file=file,
+                        source=os.path.abspath(source),
+                        dev=td.u64(s.st_dev),
+                        ino=td.u64(s.st_ino),
+                        size=td.u64(s.st_size),
+                        mtime_ns=td.i64(s.st_mtime_ns),
+                        mode=mode,
+                        owner=owner,
+                        group=group)
+                try:
+                    _expect_response_packet(self._request(request), td.PacketOk)
+                    return
+                except ValueError:
+                    # Any invalid attribute is reported again by the upload below
+                    pass
+        super().upload_path(file=file, source=source, mode=mode, owner=owner, group=group, delta=delta)
+
+    def query_blobs(self, sha512sums: list[bytes]) -> list[bool]:
+        if not self.blob_store or len(sha512sums) == 0:
+            return [False] * len(sha512sums)
+
+        response = self._request(td.PacketBlobQuery(sha512sums=sha512sums))
+        _expect_response_packet(response, td.PacketBlobQueryResult)
+        return cast(td.PacketBlobQueryResult, response).present
+
+    def place_blob(self,
+                   file: str,
+                   sha512sum: bytes,
+                   mode: Optional[str] = None,
+                   owner: Optional[str] = None,
+                   group: Optional[str] = None) -> None:
+        request = td.PacketPlaceBlob(
+                file=file,
+                sha512sum=sha512sum,
+                mode=mode,
+                owner=owner,
+                group=group)
+        self._request_deferred(request, lambda response: _expect_response_packet(response, td.PacketOk))
 
     def download(self, file: str) -> bytes:
         request = td.PacketDownload(file=file)
@@ -217,3 +754,41 @@ class TunnelConnector(Connector):
 
         _expect_response_packet(response, td.PacketDownloadResult)
         return cast(td.PacketDownloadResult, response).content
+
+    def download_stream(self, file: str) -> Iterator[bytes]:
+        response = self._request(td.PacketDownloadOpen(file=file))
+        _expect_response_packet(response, td.PacketDownloadOpened)
+        file_handle = cast(td.PacketDownloadOpened, response).file_handle
+
+        # Keep a window of read requests in flight, so that the transfer
+        # isn't limited by the round trip time.
+        channel = self._channel()
+        in_flight: deque[tuple[td.u32, td.PacketDownloadRead]] = deque()
+        offset = 0
+        eof = False
+        try:
+            while not eof or len(in_flight) > 0:
+                while not eof and len(in_flight) < self.download_window:
+                    request = td.PacketDownloadRead(file_handle=file_handle, offset=td.u64(offset), size=td.u64(self.chunk_size))
+                    in_flight.append((self._send(request, channel), request))
+                    offset += self.chunk_size
+
+                request_id, request = in_flight.popleft()
+                response = td.check_response(self._receive(request_id), request=request)
+                _expect_response_packet(response, td.PacketDownloadData)
+                data = cast(td.PacketDownloadData, response).data
+                if len(data) < self.chunk_size:
+                    eof = True
+                    # Discard reads beyond the end of the file
+                    for request_id, _ in in_flight:
+                        self._receive(request_id)
+                    in_flight.clear()
+                if len(data) > 0:
+                    yield data
+        finally:
+            # Consume responses of a prematurely closed stream and release the handle
+            try:
+                for request_id, _ in in_flight:
+                    self._receive(request_id)
+            finally:
+                self._send(td.PacketDownloadClose(file_handle=file_handle), channel)
@@ -8,20 +8,60 @@ needed remote system related utilities.
 """
 
 import errno as sys_errno
-import hashlib
+import io
+import itertools
 import os
 import stat
 import struct
-import subprocess
 import sys
+import threading
+import time
 import typing
+import zlib
 
-from pwd import getpwnam, getpwuid
-from grp import getgrnam, getgrgid, getgrall
-from spwd import getspnam
+from pwd import getpwnam, getpwuid, struct_passwd
+from grp import getgrnam, getgrgid, getgrall, struct_group
+from collections import deque
 from struct import pack, unpack
 from typing import IO, Any, Type, TypeVar, Callable, Optional, Union, NamedTuple, NewType, cast
 
+class _LazyModule:
+    """
+    Stands in for a module that is only needed by some packets. The module is imported on first
+    use and then replaces this placeholder in the globals, so that the handshake doesn't pay for
+    importing modules it never uses. This matters on small remote hosts, where the startup time
+    of the dispatcher directly adds to the latency of each connection.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, attr: str) -> Any:
+        module = __import__(self.name)
+        globals()[self.name] = module
+        return getattr(module, attr)
+
+if typing.TYPE_CHECKING:
+    import fcntl
+    import hashlib
+    import lzma
+    import mmap
+    import socket
+    import spwd
+    import subprocess
+    import tempfile
+    import traceback
+else:
+    fcntl = _LazyModule("fcntl")
+    hashlib = _LazyModule("hashlib")
+    lzma = _LazyModule("lzma")
+    mmap = _LazyModule("mmap")
+    socket = _LazyModule("socket")
+    spwd = _LazyModule("spwd")
+    subprocess = _LazyModule("subprocess")
+    tempfile = _LazyModule("tempfile")
+    traceback = _LazyModule("traceback")
+
 T = TypeVar('T')
 i32 = NewType('i32', int)
 u32 = NewType('u32', int)
@@ -30,6 +70,8 @@ u64 = NewType('u64', int)
 
 is_server = False
 debug = False
+max_workers = 8
+"""The number of worker threads that handle requests on the server. Requests on different channels are handled concurrently."""
 try:
     import fora
 except ModuleNotFoundError:
@@ -90,6 +132,97 @@ def _resolve_oct(value: str) -> int:
     except ValueError:
         raise ValueError(f"Invalid value '{value}': Must be in octal format.") # pylint: disable=raise-missing-from
 
+class _UserDatabase:
+    """
+    Caches lookups in the user and group databases for the duration of a session, as each lookup
+    may be expensive when the databases are backed by a directory service (e.g. LDAP). Failed lookups
+    are cached, too. The cache is invalidated when /etc/passwd or /etc/group is modified and after
+    each executed process, as these may have changed the databases by other means.
+    """
+
+    watched_files = ["/etc/passwd", "/etc/group"]
+    """Files whose modification invalidates the cache."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.mtimes: list[Optional[int]] = []
+        self.tables: dict[Callable[[Any], Any], dict[Any, Any]] = {}
+        self.memberships: Optional[dict[str, list[str]]] = None
+
+    def invalidate(self) -> None:
+        """Discards all cached entries."""
+        with self.lock:
+            self.tables = {}
+            self.memberships = None
+
+    def _check_files(self) -> None:
+        """Discards all cached entries if any of the watched files was modified. Must be called with the lock held."""
+        mtimes: list[Optional[int]] = []
+        for path in self.watched_files:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        if mtimes != self.mtimes:
+            self.mtimes = mtimes
+            self.tables = {}
+            self.memberships = None
+
+    def _lookup(self, func: Callable[[Any], T], key: Any) -> T:
+        """Returns the cached result of func(key), which raises a KeyError if the entry doesn't exist."""
+        with self.lock:
+            self._check_files()
+            table = self.tables.setdefault(func, {})
+            if key in table:
+                entry = table[key]
+                if entry is None:
+                    raise KeyError(key)
+                return cast(T, entry)
+
+        try:
+            result = func(key)
+        except KeyError:
+            with self.lock:
+                table[key] = None
+            raise
+        with self.lock:
+            table[key] = result
+        return result
+
+    def getpwnam(self, name: str) -> struct_passwd:
+        """Same as pwd.getpwnam, but cached."""
+        return self._lookup(getpwnam, name)
+
+    def getpwuid(self, uid: int) -> struct_passwd:
+        """Same as pwd.getpwuid, but cached."""
+        return self._lookup(getpwuid, uid)
+
+    def getgrnam(self, name: str) -> struct_group:
+        """Same as grp.getgrnam, but cached."""
+        return self._lookup(getgrnam, name)
+
+    def getgrgid(self, gid: int) -> struct_group:
+        """Same as grp.getgrgid, but cached."""
+        return self._lookup(getgrgid, gid)
+
+    def supplementary_groups(self, user: str) -> list[str]:
+        """Returns the names of all groups that list the given user as a member.
+        The index is built from a single enumeration of all groups on first use."""
+        with self.lock:
+            self._check_files()
+            memberships = self.memberships
+        if memberships is None:
+            memberships = {}
+            for g in getgrall():
+                for member in g.gr_mem:
+                    memberships.setdefault(member, []).append(g.gr_name)
+            with self.lock:
+                self.memberships = memberships
+        return list(memberships.get(user, []))
+
+_user_db = _UserDatabase()
+"""The user and group database cache of this dispatcher, shared by all sessions."""
+
 def _resolve_user(user: str) -> tuple[int, int]:
     """
     Resolves the given user string to a uid and gid.
@@ -107,12 +240,12 @@ def _resolve_user(user: str) -> tuple[int, int]:
         A tuple (uid, gid) with the numeric ids of the user and its primary group
     """
     try:
-        pw = getpwnam(user)
+        pw = _user_db.getpwnam(user)
     except KeyError:
         try:
             uid = int(user)
             try:
-                pw = getpwuid(uid)
+                pw = _user_db.getpwuid(uid)
             except KeyError:
                 raise ValueError(f"The user with the uid '{uid}' does not exist.") # pylint: disable=raise-missing-from
         except ValueError:
@@ -137,12 +270,12 @@ def _resolve_group(group: str) -> int:
         The numeric gid of the group
     """
     try:
-        gr = getgrnam(group)
+        gr = _user_db.getgrnam(group)
     except KeyError:
         try:
             gid = int(group)
             try:
-                gr = getgrgid(gid)
+                gr = _user_db.getgrgid(gid)
             except KeyError:
                 raise ValueError(f"The group with the gid '{gid}' does not exist.") # pylint: disable=raise-missing-from
         except ValueError:
@@ -150,29 +283,240 @@ def _resolve_group(group: str) -> int:
 
     return gr.gr_gid
 
+# Compression
+# ----------------------------------------------------------------
+
+compression_algorithms: dict[str, tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (lambda data: lzma.compress(data, preset=1), lambda data: lzma.decompress(data)), # pylint: disable=unnecessary-lambda
+}
+"""All known compression algorithms as a map from name to (compress, decompress).
+Whether an algorithm can actually be used is checked by `compression_supported`."""
+
+def compression_supported(algorithm: str) -> bool:
+    """Returns whether the given compression algorithm can be used. The lzma module is
+    optional in Python builds, and it is only imported once it is requested, as it loads liblzma."""
+    if algorithm not in compression_algorithms:
+        return False
+    if algorithm == "lzma":
+        try:
+            _ = lzma.LZMAError
+        except ImportError:
+            return False
+    return True
+
+compression_threshold = 512
+"""Packets smaller than this amount of bytes are never compressed."""
+
+class _Compressor:
+    """Compresses outgoing packets with the algorithm negotiated in the initial handshake."""
+
+    def __init__(self) -> None:
+        self.algorithm: Optional[str] = None
+
+    def compress(self, data: bytes) -> Optional[bytes]:
+        """
+        Compresses the given data, if a compression algorithm was negotiated
+        and compressing the data is worthwhile.
+
+        Parameters
+        ----------
+        data
+            The data to compress.
+
+        Returns
+        -------
+        Optional[bytes]
+            The compressed data, or None if the data should be sent uncompressed.
+        """
+        if self.algorithm is None or len(data) < compression_threshold:
+            return None
+        # Probe a sample of large payloads first to avoid spending time on incompressible data
+        if len(data) > 65536 and len(zlib.compress(data[:4096], 1)) > 4096 * 0.9:
+            return None
+        compressed = compression_algorithms[self.algorithm][0](data)
+        if len(compressed) > len(data) * 0.9:
+            return None
+        return compressed
+
 # Connection wrapper
 # ----------------------------------------------------------------
 
+class _Session:
+    """
+    The state of a single client session. A daemon (see `_run_daemon`) serves multiple sessions
+    concurrently, so streaming processes, uploads and downloads must not be shared between them.
+    """
+
+    def __init__(self) -> None:
+        self.processes: dict[u32, subprocess.Popen] = {}
+        """All currently running streaming processes by the request id of their PacketProcessStart."""
+        self.process_inputs: dict[u32, "_ProcessInput"] = {}
+        """The stdin writers of all streaming processes that accept input, by the request id of their PacketProcessStart."""
+        self.upload_streams: dict[u32, "_UploadFile"] = {}
+        """All currently active upload streams by their id."""
+        self.download_handles: dict[u32, IO[bytes]] = {}
+        """All currently open download handles."""
+        self.next_download_handle = itertools.count(1)
+        self.digest_cache: Optional["_DigestCache"] = None
+        """The digest cache, if it was enabled by the client. The cache is shared with other sessions that enabled it."""
+        self.blob_store: Optional["_BlobStore"] = None
+        """The blob store, if it was enabled by the client."""
+        self.environ: Optional[dict[str, str]] = None
+        """The environment of the client session, if it differs from the one of this process (see `_run_daemon`).
+        Environment variables are queried from it, and processes are started with it."""
+
+    def getenv(self, key: str) -> Optional[str]:
+        """Returns the given environment variable of the client session."""
+        return os.environ.get(key) if self.environ is None else self.environ.get(key)
+
+    def close(self) -> None:
+        """Kills all streaming processes, discards unfinished uploads and releases open downloads."""
+        for process in list(self.processes.values()):
+            process.kill()
+        for process_input in list(self.process_inputs.values()):
+            process_input.close()
+        for upload in list(self.upload_streams.values()):
+            upload.abort()
+        for f in list(self.download_handles.values()):
+            f.close()
+
+_iov_max = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 1024
+"""The maximum number of buffers in a single vectored write."""
+
+def _writev_all(fd: int, parts: list[Union[bytes, memoryview]]) -> None:
+    """Writes all given buffers to the file descriptor, using as few vectored writes as possible."""
+    i = 0
+    while i < len(parts):
+        written = os.writev(fd, parts[i:i + _iov_max])
+        # Skip the buffers that were written completely, and continue after the written part of a partial one.
+        while i < len(parts) and written >= len(parts[i]):
+            written -= len(parts[i])
+            i += 1
+        if written > 0:
+            parts[i] = memoryview(parts[i])[written:]
+
+class _Output:
+    """
+    The output side of a connection, shared by all of its views. Frames are collected
+    as lists of buffers without joining them, and written with a single vectored write
+    when flushed, so that a batch of packets costs a single system call and large payloads
+    are never copied. Outputs without a file descriptor (e.g. io.BytesIO) are written directly.
+    """
+
+    flush_threshold: int = 256 << 10
+    """Unflushed output is written as soon as it exceeds this size, to bound the memory used for batching."""
+
+    def __init__(self, buffer_out: IO[bytes]):
+        self.buffer_out = buffer_out
+        self.lock = threading.Lock()
+        self.parts: list[Union[bytes, memoryview]] = []
+        self.size = 0
+        try:
+            self.fd: Optional[int] = buffer_out.fileno()
+        except (AttributeError, OSError, ValueError):
+            self.fd = None
+
+    def write(self, parts: list[Union[bytes, memoryview]], flush: bool) -> None:
+        """Appends the given buffers atomically, and writes all pending output if requested or if too much is pending."""
+        with self.lock:
+            if self.fd is None:
+                for part in parts:
+                    self.buffer_out.write(part)
+                if flush:
+                    self.buffer_out.flush()
+                return
+            self.parts.extend(parts)
+            self.size += sum(len(part) for part in parts)
+            if flush or self.size >= self.flush_threshold:
+                self._flush()
+
+    def flush(self) -> None:
+        """Writes all pending output."""
+        with self.lock:
+            if self.fd is None:
+                self.buffer_out.flush()
+            else:
+                self._flush()
+
+    def _flush(self) -> None:
+        if self.fd is None or len(self.parts) == 0:
+            return
+        parts, self.parts, self.size = self.parts, [], 0
+        # Anything written to the stream itself must go out first
+        self.buffer_out.flush()
+        _writev_all(self.fd, parts)
+
 # pylint: disable=too-many-public-methods
 class Connection:
-    """Represents a connection to this dispatcher via an input and output buffer."""
+    """
+    Represents a connection to this dispatcher via an input and output buffer.
+    Every packet written to the connection is prefixed with a frame header consisting
+    of the channel and the request id it belongs to. Requests on the same channel
+    are handled in order, requests on different channels may be handled concurrently
+    and their responses can arrive in any order. Writing is thread safe, reading is not.
+
+    Packets are written immediately, unless `flush_writes` is disabled on a view. Then they
+    are collected until the connection is flushed, so that they can be sent together.
+    """
 
     def __init__(self, buffer_in: IO[bytes], buffer_out: IO[bytes]):
         self.buffer_in = buffer_in
         self.buffer_out = buffer_out
+        self.output = _Output(buffer_out)
+        self.flush_writes = True
+        self.header = bytearray(_struct_frame_packet.size)
+        """A reusable buffer for the headers of received frames. Reading is single threaded, so this is never shared."""
         self.should_close = False
+        self.compressor = _Compressor()
+        self.channel = u32(0)
+        self.request_id = u32(0)
+        self.session = _Session()
+
+    def for_request(self, channel: u32, request_id: u32) -> "Connection":
+        """
+        Returns a view of this connection which shares the underlying buffers,
+        but tags all written packets with the given channel and request id.
+
+        Parameters
+        ----------
+        channel
+            The channel of the request.
+        request_id
+            The id of the request.
+
+        Returns
+        -------
+        Connection
+            The view of this connection.
+        """
+        view = object.__new__(type(self))
+        view.__dict__.update(self.__dict__)
+        view.channel = channel
+        view.request_id = request_id
+        return view
 
     def flush(self) -> None:
-        """Flushes the output buffer."""
-        self.buffer_out.flush()
+        """Writes all pending output."""
+        self.output.flush()
 
     def read(self, count: int) -> bytes:
         """Reads exactly the given amount of bytes."""
         return self.buffer_in.read(count)
 
+    def readinto(self, buffer: bytearray) -> bool:
+        """Fills the given buffer completely. Returns False if the input ended before."""
+        view = memoryview(buffer)
+        while len(view) > 0:
+            count = self.buffer_in.readinto(view) # type: ignore[attr-defined]
+            if not count:
+                return False
+            view = view[count:]
+        return True
+
     def write(self, data: bytes, count: int) -> None:
         """Writes exactly the given amount of bytes from data."""
-        self.buffer_out.write(data[:count])
+        self.output.write([memoryview(data)[:count]], flush=False)
 
     def write_packet(self, packet: Any) -> None:
         """Writes the given packet."""
@@ -182,8 +526,10 @@ class Connection:
         # to determine whether this function exists, as it is added by the @Packet decorator.
         packet._write(self) # pylint: disable=protected-access
 
-# Primary serialization and deserialization
+# Generic serialization and deserialization
 # ----------------------------------------------------------------
+# These functions define the wire format by inspecting the type annotations on each call.
+# Packets use the equivalent precompiled codecs below, so this is only a reference implementation.
 
 def _is_optional(field: Type[Any]) -> bool:
     """Returns True when the given type annotation is Optional[...]."""
@@ -193,6 +539,10 @@ def _is_list(field: Type[Any]) -> bool:
     """Returns True when the given type annotation is list[...]."""
     return typing.get_origin(field) is list
 
+def _is_named_tuple(field: Type[Any]) -> bool:
+    """Returns True when the given type annotation is a NamedTuple (e.g. another packet type)."""
+    return isinstance(field, type) and issubclass(field, tuple) and hasattr(field, '_fields')
+
 _serializers: dict[Any, Callable[[Connection, Any], Any]] = {}
 _serializers[bool]  = lambda conn, v: conn.write(pack(">?", v), 1)
 _serializers[i32]   = lambda conn, v: conn.write(pack(">i", v), 4)
@@ -216,6 +566,9 @@ def _serialize(conn: Connection, vtype: Type[Any], v: Any) -> None:
         _serializers[u64](conn, len(v))
         for i in v:
             _serialize(conn, element_type, i)
+    elif _is_named_tuple(vtype):
+        for f in vtype._fields:
+            _serialize(conn, vtype.__annotations__[f], getattr(v, f))
     else:
         raise ValueError(f"Cannot serialize object of type {vtype}")
 
@@ -241,9 +594,181 @@ def _deserialize(conn: Connection, vtype: Type[Any]) -> Any:
     elif _is_list(vtype):
         element_type = typing.get_args(vtype)[0]
         return list(_deserialize(conn, element_type) for _ in range(_deserializers[u64](conn)))
+    elif _is_named_tuple(vtype):
+        return vtype(**{f: _deserialize(conn, vtype.__annotations__[f]) for f in vtype._fields})
+    else:
+        raise ValueError(f"Cannot deserialize object of type {vtype}")
+
+# Precompiled packet codecs
+# ----------------------------------------------------------------
+
+_struct_formats: dict[Any, str] = { bool: "?", i32: "i", u32: "I", i64: "q", u64: "Q" }
+"""The struct format characters of all fixed-width types."""
+
+_struct_bool = struct.Struct(">?")
+_struct_u32 = struct.Struct(">I")
+_struct_u64 = struct.Struct(">Q")
+
+def _compile_encoder(vtype: Type[Any]) -> Callable[[Any], bytes]:
+    """
+    Returns a function that encodes a value of the given type annotation to bytes.
+    All type introspection happens once in this function, so the returned encoder
+    doesn't need to inspect the type again when called.
+    """
+    # pylint: disable=no-else-return
+    if vtype in _struct_formats:
+        return struct.Struct(">" + _struct_formats[vtype]).pack
+    elif vtype is bytes:
+        return lambda v: _struct_u64.pack(len(v)) + v
+    elif vtype is str:
+        def _encode_str(v: str) -> bytes:
+            b = v.encode('utf-8')
+            return _struct_u64.pack(len(b)) + b
+        return _encode_str
+    elif _is_optional(vtype):
+        encode_real = _compile_encoder(typing.get_args(vtype)[0])
+        return lambda v: b"\x00" if v is None else b"\x01" + encode_real(v)
+    elif _is_list(vtype):
+        encode_element = _compile_encoder(typing.get_args(vtype)[0])
+        return lambda v: _struct_u64.pack(len(v)) + b"".join(encode_element(x) for x in v)
+    elif _is_named_tuple(vtype):
+        return _compile_tuple_codec(vtype, None).encode
+    else:
+        raise ValueError(f"Cannot serialize object of type {vtype}")
+
+def _compile_decoder(vtype: Type[Any]) -> Callable[[Connection], Any]:
+    """
+    Returns a function that decodes a value of the given type annotation from a connection.
+    All type introspection happens once in this function, so the returned decoder
+    doesn't need to inspect the type again when called.
+    """
+    # pylint: disable=no-else-return
+    if vtype in _struct_formats:
+        s = struct.Struct(">" + _struct_formats[vtype])
+        return lambda conn: s.unpack(conn.read(s.size))[0]
+    elif vtype is bytes:
+        return lambda conn: conn.read(_struct_u64.unpack(conn.read(8))[0])
+    elif vtype is str:
+        return lambda conn: conn.read(_struct_u64.unpack(conn.read(8))[0]).decode('utf-8')
+    elif _is_optional(vtype):
+        decode_real = _compile_decoder(typing.get_args(vtype)[0])
+        return lambda conn: decode_real(conn) if _struct_bool.unpack(conn.read(1))[0] else None
+    elif _is_list(vtype):
+        decode_element = _compile_decoder(typing.get_args(vtype)[0])
+        return lambda conn: [decode_element(conn) for _ in range(_struct_u64.unpack(conn.read(8))[0])]
+    elif _is_named_tuple(vtype):
+        return _compile_tuple_codec(vtype, None).decode
     else:
         raise ValueError(f"Cannot deserialize object of type {vtype}")
 
+class _PacketCodec(NamedTuple):
+    """The compiled codec of a packet (see `_compile_tuple_codec`)."""
+    encode: Callable[[Any], bytes]
+    """Converts a packet to bytes, including the packet id header."""
+    decode: Callable[[Connection], Any]
+    """Reads the packet's fields (excluding the packet id) from a connection."""
+    encode_frame: Callable[[Any, u32, u32], list[Union[bytes, memoryview]]]
+    """Converts a packet including the frame header with the given channel and request id to a list
+    of buffers, which can be written without joining them. Bytes fields are included without copying."""
+
+def _compile_tuple_codec(cls: Type[Any], packet_id: Optional[u32]) -> _PacketCodec:
+    """
+    Generates a specialized encoder and decoder for the given packet class.
+    Consecutive fixed-width fields (including the packet id header for the encoder)
+    are packed by a single precompiled struct.Struct, and only variable-length fields
+    require a call to an additional encoder or decoder.
+
+    Parameters
+    ----------
+    cls
+        The packet class (a NamedTuple).
+    packet_id
+        The id of the packet, which will be prepended by the encoder. If None,
+        no header is written, which is used for tuples nested in other packets.
+
+    Returns
+    -------
+    _PacketCodec
+        The encoders and the decoder. If packet_id is None, the frame encoder is not available.
+    """
+    # pylint: disable=too-many-branches,too-many-locals,too-many-statements
+    namespace: dict[str, Any] = { "_cls": cls, "_tuple_new": tuple.__new__, "_pack_u64": _struct_u64.pack }
+    fields: list[str] = list(cls._fields)
+
+    # Split the fields into runs of fixed-width fields (a struct format and field indices)
+    # and individual variable-length fields (None and a single field index).
+    runs: list[tuple[Optional[str], list[int]]] = []
+    for i, f in enumerate(fields):
+        ftype = cls.__annotations__[f]
+        if ftype in _struct_formats:
+            last_fmt = runs[-1][0] if len(runs) > 0 else None
+            if last_fmt is None:
+                runs.append((_struct_formats[ftype], [i]))
+            else:
+                runs[-1] = (last_fmt + _struct_formats[ftype], runs[-1][1] + [i])
+        else:
+            runs.append((None, [i]))
+
+    # Generate the encoder. The packet id is merged into the first fixed-width run,
+    # or becomes a separate run if the packet starts with a variable-length field.
+    namespace["_packet_id"] = packet_id
+    enc_parts: list[str] = []
+    enc_runs = list(runs)
+    first_fmt = enc_runs[0][0] if len(enc_runs) > 0 else None
+    if packet_id is None:
+        pass
+    elif first_fmt is not None:
+        enc_runs[0] = ("I" + first_fmt, [-1] + enc_runs[0][1])
+    else:
+        enc_runs.insert(0, ("I", [-1]))
+    for r, (fmt, indices) in enumerate(enc_runs):
+        args = ", ".join("_packet_id" if i < 0 else f"v[{i}]" for i in indices)
+        if fmt is None:
+            namespace[f"_enc_{r}"] = _compile_encoder(cls.__annotations__[fields[indices[0]]])
+            enc_parts.append(f"_enc_{r}({args})")
+        else:
+            namespace[f"_struct_{r}"] = struct.Struct(">" + fmt)
+            enc_parts.append(f"_struct_{r}.pack({args})")
+    enc_src = "def _encode(v):\n"
+    enc_src += f"    return b''.join(({''.join(p + ', ' for p in enc_parts)}))\n"
+
+    # Generate the frame encoder. The frame header is merged into the first fixed-width run like the packet id.
+    if packet_id is not None:
+        frame_parts: list[str] = []
+        for r, (fmt, indices) in enumerate(enc_runs):
+            args = ", ".join("_packet_id" if i < 0 else f"v[{i}]" for i in indices)
+            if r == 0:
+                namespace["_struct_frame"] = struct.Struct(">II" + cast(str, fmt))
+                frame_parts.append(f"_struct_frame.pack(channel, request_id, {args})")
+            elif fmt is not None:
+                frame_parts.append(f"_struct_{r}.pack({args})")
+            elif cls.__annotations__[fields[indices[0]]] is bytes:
+                frame_parts.append(f"_pack_u64(len({args})), {args}")
+            else:
+                frame_parts.append(f"_enc_{r}({args})")
+        enc_src += "def _encode_frame(v, channel, request_id):\n"
+        enc_src += f"    return [{', '.join(frame_parts)}]\n"
+
+    # Generate the decoder.
+    dec_src = "def _decode(conn):\n"
+    for r, (fmt, indices) in enumerate(runs):
+        targets = "".join(f"f{i}, " for i in indices)
+        if fmt is None:
+            namespace[f"_dec_{r}"] = _compile_decoder(cls.__annotations__[fields[indices[0]]])
+            dec_src += f"    {targets}= _dec_{r}(conn),\n"
+        else:
+            s = struct.Struct(">" + fmt)
+            namespace[f"_struct_dec_{r}"] = s
+            dec_src += f"    {targets}= _struct_dec_{r}.unpack(conn.read({s.size}))\n"
+    dec_src += f"    return _tuple_new(_cls, ({''.join(f'f{i}, ' for i in range(len(fields)))}))\n"
+
+    exec(enc_src + dec_src, namespace) # pylint: disable=exec-used
+    return _PacketCodec(namespace["_encode"], namespace["_decode"], namespace.get("_encode_frame", _no_frame_encoder))
+
+def _no_frame_encoder(v: Any, channel: u32, request_id: u32) -> list[Union[bytes, memoryview]]:
+    """The frame encoder of tuples that are nested in other packets, which are never sent on their own."""
+    raise TypeError("Nested tuples cannot be sent as a packet")
+
 # Packet helpers
 # ----------------------------------------------------------------
 
@@ -253,20 +778,35 @@ packet_deserializers: dict[int, Callable[[Connection], Any]] = {}
 def _handle_response_packet() -> None:
     raise RuntimeError("This packet is a server-side response packet and must never be sent by the client!")
 
-# Define generic read and write functions
-def _read_packet(cls: Type[Any], conn: Connection) -> Any:
-    kwargs: dict[str, Any] = {}
-    for f in cast(Any, cls)._fields:
-        ftype = cls.__annotations__[f]
-        kwargs[f] = _deserialize(conn, ftype)
-    return cls(**kwargs)
+_struct_frame_header = struct.Struct(">II")
+"""The frame header which precedes each packet on the wire: the channel and the request id."""
 
-def _write_packet(cls: Type[Any], packet_id: u32, this: object, conn: Connection) -> None:
-    _serialize(conn, u32, packet_id)
-    for f in cls._fields:
-        ftype = cls.__annotations__[f]
-        _serialize(conn, ftype, getattr(this, f))
-    conn.flush()
+_struct_frame_packet = struct.Struct(">III")
+"""The frame header followed by the packet id, which are read together."""
+
+def _write_packet(codec: _PacketCodec, this: object, conn: Connection) -> None:
+    if conn.compressor.algorithm is None:
+        parts = codec.encode_frame(this, conn.channel, conn.request_id)
+    else:
+        data = codec.encode(this)
+        compressed = conn.compressor.compress(data)
+        if compressed is not None:
+            data = PacketCompressed(algorithm=conn.compressor.algorithm, data=compressed)._encode() # type: ignore[attr-defined] # pylint: disable=protected-access,no-member
+        parts = [_struct_frame_header.pack(conn.channel, conn.request_id), data]
+    conn.output.write(parts, flush=conn.flush_writes)
+
+def _compile_packet(cls: Type[Any], packet_id: u32) -> _PacketCodec:
+    """
+    Compiles the codec of the given packet and replaces the placeholders installed by
+    the @Packet decorator. Compiling all packets upfront would noticeably delay the startup of the
+    dispatcher, while most sessions only ever use a few of them. Concurrent first uses may
+    compile the same codec twice, which is harmless.
+    """
+    codec = _compile_tuple_codec(cls, packet_id)
+    cls._encode = codec.encode # pylint: disable=protected-access
+    cls._write = lambda self, conn: _write_packet(codec, self, conn) # pylint: disable=protected-access
+    packet_deserializers[packet_id] = codec.decode
+    return codec
 
 def Packet(type: str) -> Callable[[Type[Any]], Any]: # pylint: disable=redefined-builtin
     """Decorator for packet types. Registers the packet and generates read and write methods."""
@@ -281,9 +821,10 @@ def Packet(type: str) -> Callable[[Type[Any]], Any]: # pylint: disable=redefined
         # Find next packet id
         packet_id = u32(len(packets))
 
-        # Replace functions
+        # Replace functions. The codec is only compiled when the packet is first used (see `_compile_packet`).
         cls._is_packet = True # pylint: disable=protected-access
-        cls._write = lambda self, conn: _write_packet(cls, packet_id, self, conn) # pylint: disable=protected-access
+        cls._encode = lambda self: _compile_packet(cls, packet_id).encode(self) # pylint: disable=protected-access
+        cls._write = lambda self, conn: _write_packet(_compile_packet(cls, packet_id), self, conn) # pylint: disable=protected-access
         if type == 'response':
             cls.handle = _handle_response_packet
         elif type == 'request':
@@ -292,11 +833,20 @@ def Packet(type: str) -> Callable[[Type[Any]], Any]: # pylint: disable=redefined
 
         # Register packet
         packets.append(cls)
-        packet_deserializers[packet_id] = lambda conn: _read_packet(cls, conn)
+        packet_deserializers[packet_id] = lambda conn: _compile_packet(cls, packet_id).decode(conn)
 
         return cls
     return wrapper
 
+def boot_id() -> Optional[str]:
+    """Returns the id of the running kernel instance, which identifies the machine until it is rebooted.
+    Processes in containers share the id of their host. Returns None if the id is unavailable."""
+    try:
+        with open("/proc/sys/kernel/random/boot_id", "r", encoding="ascii") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
 # Packets
 # ----------------------------------------------------------------
 
@@ -307,16 +857,47 @@ class PacketOk(NamedTuple):
 @Packet(type='response')
 class PacketAck(NamedTuple):
     """This packet is used to acknowledge a previous PacketCheckAlive packet."""
+    compression: Optional[str] = None
+    """The compression algorithm that will be used from now on, if any."""
+    same_machine: bool = False
+    """Whether the receiver runs on the same machine as the client, so that local files may be uploaded by path (see PacketUploadPath)."""
 
 @Packet(type='request')
 class PacketCheckAlive(NamedTuple):
     """This packet is used to check whether a connection is alive.
     The receiver must answer with PacketAck immediately."""
+    compression: list[str] = [] # pylint: disable=dangerous-default-value
+    """The compression algorithms supported by the client in order of preference. The first
+    algorithm that is also supported by the receiver will be used to compress large packets."""
+    digest_cache: bool = False
+    """Whether the receiver should remember the sha512sums of files across connections (see `_DigestCache`)."""
+    blob_store_size: u64 = u64(0)
+    """The maximum size of the receiver's blob store in bytes, or 0 to disable it (see `_BlobStore`)."""
+    boot_id: Optional[str] = None
+    """The `boot_id` of the client, if available."""
 
     def handle(self, conn: Connection) -> None:
-        """Responds with PacketAck."""
-        _ = (self)
-        conn.write_packet(PacketAck())
+        """Responds with PacketAck and enables compression, the digest cache and the blob store for this session as requested."""
+        if self.digest_cache:
+            conn.session.digest_cache = _shared_digest_cache(os.path.join(_cache_dir(), "digests"))
+        if self.blob_store_size > 0:
+            try:
+                conn.session.blob_store = _BlobStore(os.path.join(_cache_dir(), "blobs"), self.blob_store_size)
+            except OSError:
+                # The blob store is only an optimization, all blobs will just be reported as missing.
+                pass
+
+        algorithm = next((a for a in self.compression if compression_supported(a)), None)
+        same_machine = self.boot_id is not None and self.boot_id == boot_id()
+        conn.write_packet(PacketAck(compression=algorithm, same_machine=same_machine))
+        conn.compressor.algorithm = algorithm
+
+@Packet(type='response')
+class PacketCompressed(NamedTuple):
+    """This packet wraps another packet (including its packet id) in compressed form. It is
+    transparently unpacked when received, and can be sent in either direction."""
+    algorithm: str
+    data: bytes
 
 @Packet(type='request')
 class PacketExit(NamedTuple):
@@ -348,9 +929,51 @@ class PacketProcessCompleted(NamedTuple):
 
 @Packet(type='response')
 class PacketProcessError(NamedTuple):
-    """This packet is used to indicate an error when running a process or when running the preexec_fn."""
+    """This packet is used to indicate an error when running a process."""
     message: str
 
+def _resolve_process_attributes(conn: Connection, user: Optional[str], group: Optional[str], umask: Optional[str], cwd: Optional[str]) -> Optional[tuple[Optional[int], Optional[int], int]]:
+    """
+    Resolves the given user, group, umask and working directory of a process. Sends PacketInvalidField
+    and returns None if any of the fields contain an invalid value.
+
+    Returns
+    -------
+    Optional[tuple[Optional[int], Optional[int], int]]
+        The uid and gid (None if not given) and the numeric umask.
+    """
+    # By default we will run commands as the current user.
+    uid, gid = (None, None)
+    umask_oct = 0o077
+
+    if umask is not None:
+        try:
+            umask_oct = _resolve_oct(umask)
+        except ValueError as e:
+            conn.write_packet(PacketInvalidField("umask", str(e)))
+            return None
+
+    if user is not None:
+        try:
+            (uid, gid) = _resolve_user(user)
+        except ValueError as e:
+            conn.write_packet(PacketInvalidField("user", str(e)))
+            return None
+
+    if group is not None:
+        try:
+            gid = _resolve_group(group)
+        except ValueError as e:
+            conn.write_packet(PacketInvalidField("group", str(e)))
+            return None
+
+    if cwd is not None:
+        if not os.path.isdir(cwd):
+            conn.write_packet(PacketInvalidField("cwd", "The directory does not exist"))
+            return None
+
+    return (uid, gid, umask_oct)
+
 @Packet(type='request')
 class PacketProcessRun(NamedTuple):
     """This packet is used to run a process."""
@@ -364,62 +987,195 @@ class PacketProcessRun(NamedTuple):
 
     def handle(self, conn: Connection) -> None:
         """Runs the requested command."""
-        # By default we will run commands as the current user.
-        uid, gid = (None, None)
-        umask_oct = 0o077
+        attrs = _resolve_process_attributes(conn, self.user, self.group, self.umask, self.cwd)
+        if attrs is None:
+            return
+        uid, gid, umask_oct = attrs
 
-        if self.umask is not None:
-            try:
-                umask_oct = _resolve_oct(self.umask)
-            except ValueError as e:
-                conn.write_packet(PacketInvalidField("umask", str(e)))
-                return
+        # Execute command with desired parameters. The user, group and umask are applied
+        # by subprocess itself, as a preexec_fn is not safe to use with multiple threads.
+        try:
+            result = subprocess.run(self.command,
+                input=self.stdin,
+                capture_output=self.capture_output,
+                cwd=self.cwd,
+                user=uid,
+                group=gid,
+                umask=umask_oct,
+                env=conn.session.environ,
+                check=False)
+        except subprocess.SubprocessError as e:
+            conn.write_packet(PacketProcessError(str(e)))
+            return
 
-        if self.user is not None:
-            try:
-                (uid, gid) = _resolve_user(self.user)
-            except ValueError as e:
-                conn.write_packet(PacketInvalidField("user", str(e)))
-                return
+        # The command may have modified users or groups
+        _user_db.invalidate()
 
-        if self.group is not None:
-            try:
-                gid = _resolve_group(self.group)
-            except ValueError as e:
-                conn.write_packet(PacketInvalidField("group", str(e)))
+        # Send response for command result
+        conn.write_packet(PacketProcessCompleted(result.stdout, result.stderr, i32(result.returncode)))
+
+_process_read_size = 1 << 16
+"""The maximum size of a single output chunk of a streaming process."""
+
+@Packet(type='response')
+class PacketProcessOutput(NamedTuple):
+    """This packet is used to return a chunk of output of a streaming process as soon as it was produced."""
+    fd: u32
+    """1 for stdout, 2 for stderr."""
+    data: bytes
+
+def _pump_output(conn: Connection, fd: int, pipe: IO[bytes]) -> None:
+    """Sends everything that is read from the given pipe as PacketProcessOutput until the pipe is closed."""
+    with pipe:
+        while True:
+            data = pipe.read(_process_read_size)
+            if not data:
                 return
+            conn.write_packet(PacketProcessOutput(fd=u32(fd), data=data))
+
+class _ProcessInput:
+    """
+    Writes the input of a streaming process to its stdin on a thread of its own, so that a process
+    which doesn't read its input never blocks the channel on which the input arrives. Input is queued
+    until it was written, and discarded once the process has closed its stdin.
+    """
 
-        if self.cwd is not None:
-            if not os.path.isdir(self.cwd):
-                conn.write_packet(PacketInvalidField("cwd", "The directory does not exist"))
+    def __init__(self, stdin: IO[bytes]):
+        self.stdin = stdin
+        self.chunks: deque[Optional[bytes]] = deque()
+        """The queued input. None closes stdin."""
+        self.closed = False
+        self.cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def feed(self, data: bytes, eof: bool = False) -> None:
+        """Queues the given data, and closes stdin afterwards if eof is set."""
+        with self.cond:
+            if self.closed:
                 return
+            if len(data) > 0:
+                self.chunks.append(data)
+            if eof:
+                self.chunks.append(None)
+            self.cond.notify()
+
+    def close(self) -> None:
+        """Closes stdin once the queued input was written."""
+        self.feed(b"", eof=True)
+
+    def _run(self) -> None:
+        """Writes the queued input until stdin is closed."""
+        try:
+            while True:
+                with self.cond:
+                    while len(self.chunks) == 0:
+                        self.cond.wait()
+                    data = self.chunks.popleft()
+                if data is None:
+                    return
+                view = memoryview(data)
+                while len(view) > 0:
+                    view = view[os.write(self.stdin.fileno(), view):]
+        except OSError:
+            # The process has exited or closed its stdin. There is no response to report this,
+            # the client will receive the return code of the process anyway.
+            pass
+        finally:
+            with self.cond:
+                self.closed = True
+                self.chunks.clear()
+            self.stdin.close()
+
+def _pump_process(conn: Connection, process: "subprocess.Popen") -> None:
+    """Sends the output of the given process and finally its return code."""
+    assert process.stdout is not None and process.stderr is not None
+    stderr_pump = threading.Thread(target=_pump_output, args=(conn, 2, process.stderr), daemon=True)
+    stderr_pump.start()
+    _pump_output(conn, 1, process.stdout)
+    stderr_pump.join()
+    returncode = process.wait()
+    conn.session.processes.pop(conn.request_id, None)
+    process_input = conn.session.process_inputs.pop(conn.request_id, None)
+    if process_input is not None:
+        process_input.close()
+    _user_db.invalidate()
+    conn.write_packet(PacketProcessCompleted(None, None, i32(returncode)))
+
+@Packet(type='request')
+class PacketProcessStart(NamedTuple):
+    """This packet is used to start a process whose output is streamed back while it is running.
+    Responds with PacketOk once the process has been started, then with a PacketProcessOutput
+    for each chunk of output and finally with PacketProcessCompleted (without any output).
+    If the process cannot be started, responds with PacketInvalidField or PacketProcessError instead.
+    The process may be referenced by the request id of this packet in subsequent packets."""
+    command: list[str]
+    stdin: bool = False
+    """Whether input will be sent with PacketProcessInput. Otherwise, stdin is redirected from /dev/null."""
+    user: Optional[str] = None
+    group: Optional[str] = None
+    umask: Optional[str] = None
+    cwd: Optional[str] = None
 
-        def child_preexec() -> None:
-            """
-            Sets umask and becomes the correct user.
-            """
-            os.umask(umask_oct)
-            if gid is not None:
-                os.setresgid(gid, gid, gid)
-            if uid is not None:
-                os.setresuid(uid, uid, uid)
-            if self.cwd is not None:
-                os.chdir(self.cwd)
+    def handle(self, conn: Connection) -> None:
+        """Starts the requested command."""
+        attrs = _resolve_process_attributes(conn, self.user, self.group, self.umask, self.cwd)
+        if attrs is None:
+            return
+        uid, gid, umask_oct = attrs
 
-        # Execute command with desired parameters
         try:
-            result = subprocess.run(self.command,
-                input=self.stdin,
-                capture_output=self.capture_output,
+            process = subprocess.Popen(self.command, # pylint: disable=consider-using-with
+                stdin=subprocess.PIPE if self.stdin else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=0,
                 cwd=self.cwd,
-                preexec_fn=child_preexec,
-                check=False)
+                user=uid,
+                group=gid,
+                umask=umask_oct,
+                env=conn.session.environ)
         except subprocess.SubprocessError as e:
             conn.write_packet(PacketProcessError(str(e)))
             return
 
-        # Send response for command result
-        conn.write_packet(PacketProcessCompleted(result.stdout, result.stderr, i32(result.returncode)))
+        conn.session.processes[conn.request_id] = process
+        if process.stdin is not None:
+            conn.session.process_inputs[conn.request_id] = _ProcessInput(process.stdin)
+        conn.write_packet(PacketOk())
+        # Return immediately, so that the channel is free for input to the process.
+        threading.Thread(target=_pump_process, args=(conn, process), daemon=True).start()
+
+@Packet(type='request')
+class PacketProcessInput(NamedTuple):
+    """This packet is used to write data to the stdin of a process started by PacketProcessStart.
+    If eof is set, stdin is closed afterwards. There is no response. Input for unknown or
+    already exited processes is ignored. The data is queued and written by a separate thread
+    (see `_ProcessInput`), so the channel never waits for the process to read its input."""
+    process: u32
+    """The request id of the PacketProcessStart."""
+    data: bytes
+    eof: bool = False
+
+    def handle(self, conn: Connection) -> None:
+        """Queues the data for the process."""
+        process_input = conn.session.process_inputs.get(self.process)
+        if process_input is not None:
+            process_input.feed(self.data, self.eof)
+
+@Packet(type='request')
+class PacketProcessKill(NamedTuple):
+    """This packet is used to kill a process started by PacketProcessStart. There is no response,
+    the process will still send PacketProcessCompleted for its start request. It is handled as soon
+    as it is received, instead of waiting for the requests queued before it (see `_Dispatcher.submit`)."""
+    process: u32
+    """The request id of the PacketProcessStart."""
+
+    def handle(self, conn: Connection) -> None:
+        """Kills the process."""
+        _ = (conn)
+        process = conn.session.processes.get(self.process)
+        if process is not None:
+            process.kill()
 
 @Packet(type='response')
 class PacketStatResult(NamedTuple):
@@ -433,6 +1189,234 @@ class PacketStatResult(NamedTuple):
     ctime: u64
     sha512sum: Optional[bytes]
 
+hash_chunk_size = 1 << 20
+"""The size of the chunks in which files are read for hashing."""
+
+hash_mmap_threshold = 64 << 20
+"""Files of at least this size are hashed from a memory mapping instead of being read in chunks."""
+
+_hash_buffers = threading.local()
+
+def _sha512_file(path: str) -> bytes:
+    """
+    Calculates the sha512sum of the given file with bounded memory usage. Large files are hashed
+    from a read-only memory mapping, whose pages are backed by the page cache and can be reclaimed
+    at any time. Otherwise, or if the file cannot be mapped, the file is read in chunks into a reused buffer.
+
+    Parameters
+    ----------
+    path
+        The file to hash.
+
+    Returns
+    -------
+    bytes
+        The sha512sum of the file.
+    """
+    sha512 = hashlib.sha512()
+    with open(path, 'rb', buffering=0) as f:
+        if os.fstat(f.fileno()).st_size >= hash_mmap_threshold:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if hasattr(m, "madvise"):
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    sha512.update(m)
+                return sha512.digest()
+            except (OSError, ValueError):
+                # Some files (e.g. in special filesystems) cannot be mapped
+                sha512 = hashlib.sha512()
+                f.seek(0)
+
+        # Each worker thread reuses its own buffer
+        buf = getattr(_hash_buffers, "buf", None)
+        if buf is None or len(buf) != hash_chunk_size:
+            buf = bytearray(hash_chunk_size)
+            _hash_buffers.buf = buf
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            sha512.update(view[:n])
+    return sha512.digest()
+
+def _cache_dir() -> str:
+    """Returns the directory for persistent caches in the cache directory of the current user."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "fora")
+
+class _DigestCache:
+    """
+    A persistent cache of file digests, keyed by the device, inode, size, mtime and ctime of the file,
+    so that unchanged files don't have to be read again to calculate their sha512sum. The cache is loaded
+    when it is created and new entries are merged into the file by `_DigestCache.save` under an exclusive
+    lock, so that concurrent dispatchers don't lose each other's entries.
+    """
+
+    entry = struct.Struct(">QQQQQ64s")
+    """The format of a single entry in the cache file."""
+
+    max_entries: int = 100000
+    """The maximum number of entries in the cache file. The oldest entries are discarded first."""
+
+    racy_window_ns: int = 2_000_000_000
+    """Files that were modified less than this long before they were hashed are not cached, as a later
+    modification might not change their timestamps if it falls within the timestamp granularity."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self._load()
+        self.new_entries: dict[tuple[int, ...], bytes] = {}
+
+    @staticmethod
+    def key(s: os.stat_result) -> tuple[int, ...]:
+        """Returns the cache key for the given stat result."""
+        return (s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns, s.st_ctime_ns)
+
+    def _load(self) -> dict[tuple[int, ...], bytes]:
+        """Reads all entries from the cache file. A missing or unreadable file yields an empty cache."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return {}
+        data = data[:len(data) - len(data) % self.entry.size]
+        return {e[:5]: e[5] for e in self.entry.iter_unpack(data)}
+
+    def get(self, s: os.stat_result) -> Optional[bytes]:
+        """Returns the cached digest of the file with the given stat result, if any."""
+        with self.lock:
+            return self.entries.get(self.key(s))
+
+    def put(self, s: os.stat_result, digest: bytes) -> None:
+        """Remembers the digest of the file with the given stat result, unless it was modified too recently."""
+        if time.time_ns() - max(s.st_mtime_ns, s.st_ctime_ns) < self.racy_window_ns:
+            return
+        key = self.key(s)
+        with self.lock:
+            self.entries[key] = digest
+            self.new_entries[key] = digest
+
+    def save(self) -> None:
+        """Merges the new entries into the cache file."""
+        with self.lock:
+            new_entries, self.new_entries = self.new_entries, {}
+        if len(new_entries) == 0:
+            return
+
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        with open(self.path + ".lock", 'ab') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            entries = self._load()
+            for key, digest in new_entries.items():
+                entries.pop(key, None)
+                entries[key] = digest
+            data = b"".join(self.entry.pack(*key, digest) for key, digest in list(entries.items())[-self.max_entries:])
+
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".digests.")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+_digest_caches: dict[str, _DigestCache] = {}
+"""The digest caches that were enabled by any session, by their path. A daemon keeps them loaded across sessions,
+but each session only uses a cache if its own client enabled it (see `_Session.digest_cache`)."""
+
+_digest_caches_lock = threading.Lock()
+"""Protects `_digest_caches`."""
+
+def _shared_digest_cache(path: str) -> _DigestCache:
+    """Returns the digest cache stored at the given path, which is loaded on first use."""
+    with _digest_caches_lock:
+        cache = _digest_caches.get(path)
+        if cache is None:
+            cache = _digest_caches[path] = _DigestCache(path)
+        return cache
+
+def _file_digest(path: str, s: os.stat_result, cache: Optional[_DigestCache]) -> bytes:
+    """Returns the sha512sum of the given file, which has the given stat result. Uses the given digest cache, if any."""
+    if cache is None:
+        return _sha512_file(path)
+
+    digest = cache.get(s)
+    if digest is None:
+        digest = _sha512_file(path)
+        # Only remember the digest if the file wasn't changed or replaced in the meantime
+        if _DigestCache.key(os.stat(path)) == _DigestCache.key(s):
+            cache.put(s, digest)
+    return digest
+
+def _stat(path: str,
+          follow_links: bool,
+          sha512sum: bool,
+          missing_errnos: tuple[int, ...] = (sys_errno.ENOENT,),
+          digest_cache: Optional[_DigestCache] = None) -> Optional[PacketStatResult]:
+    """
+    Stats the given path and returns the result as a PacketStatResult,
+    or None if the path doesn't exist. Any other OSError is propagated.
+
+    Parameters
+    ----------
+    path
+        The path to stat.
+    follow_links
+        Whether to follow symbolic links.
+    sha512sum
+        Whether to include the sha512sum if the path is a file.
+    missing_errnos
+        The errnos that indicate a path that doesn't exist.
+    digest_cache
+        The digest cache to use for the sha512sum, if any.
+
+    Returns
+    -------
+    Optional[PacketStatResult]
+        The stat result, or None if the path doesn't exist.
+    """
+    try:
+        s = os.stat(path, follow_symlinks=follow_links)
+    except OSError as e:
+        if e.errno not in missing_errnos:
+            raise
+        return None
+
+    ftype = "dir"  if stat.S_ISDIR(s.st_mode)  else \
+            "chr"  if stat.S_ISCHR(s.st_mode)  else \
+            "blk"  if stat.S_ISBLK(s.st_mode)  else \
+            "file" if stat.S_ISREG(s.st_mode)  else \
+            "fifo" if stat.S_ISFIFO(s.st_mode) else \
+            "link" if stat.S_ISLNK(s.st_mode)  else \
+            "sock" if stat.S_ISSOCK(s.st_mode) else \
+            "other"
+
+    try:
+        owner = _user_db.getpwuid(s.st_uid).pw_name
+    except KeyError:
+        owner = str(s.st_uid)
+
+    try:
+        group = _user_db.getgrgid(s.st_gid).gr_name
+    except KeyError:
+        group = str(s.st_gid)
+
+    digest = _file_digest(path, s, digest_cache) if sha512sum and ftype == "file" else None
+
+    return PacketStatResult(
+        type=ftype,
+        mode=u64(stat.S_IMODE(s.st_mode)),
+        owner=owner,
+        group=group,
+        size=u64(s.st_size),
+        mtime=u64(s.st_mtime_ns),
+        ctime=u64(s.st_ctime_ns),
+        sha512sum=digest)
+
 @Packet(type='request')
 class PacketStat(NamedTuple):
     """This packet is used to retrieve information about a file or directory."""
@@ -442,56 +1426,61 @@ class PacketStat(NamedTuple):
 
     def handle(self, conn: Connection) -> None:
         """Stats the requested path."""
-        try:
-            s = os.stat(self.path, follow_symlinks=self.follow_links)
-        except OSError as e:
-            if e.errno != sys_errno.ENOENT:
-                raise
-            conn.write_packet(PacketInvalidField("path", str(e)))
+        result = _stat(self.path, self.follow_links, self.sha512sum, digest_cache=conn.session.digest_cache)
+        if result is None:
+            conn.write_packet(PacketInvalidField("path", f"[Errno {sys_errno.ENOENT}] {os.strerror(sys_errno.ENOENT)}: '{self.path}'"))
             return
 
-        ftype = "dir"  if stat.S_ISDIR(s.st_mode)  else \
-                "chr"  if stat.S_ISCHR(s.st_mode)  else \
-                "blk"  if stat.S_ISBLK(s.st_mode)  else \
-                "file" if stat.S_ISREG(s.st_mode)  else \
-                "fifo" if stat.S_ISFIFO(s.st_mode) else \
-                "link" if stat.S_ISLNK(s.st_mode)  else \
-                "sock" if stat.S_ISSOCK(s.st_mode) else \
-                "other"
-
-        try:
-            owner = getpwuid(s.st_uid).pw_name
-        except KeyError:
-            owner = str(s.st_uid)
+        # Send response
+        conn.write_packet(result)
 
-        try:
-            group = getgrgid(s.st_gid).gr_name
-        except KeyError:
-            group = str(s.st_gid)
+@Packet(type='response')
+class PacketStatManyResult(NamedTuple):
+    """This packet is used to return the results of a stat many packet."""
+    results: list[Optional[PacketStatResult]]
+    """The stat results in the same order as the requested paths. None denotes a path that doesn't exist (ENOENT or ENOTDIR)."""
 
-        sha512sum: Optional[bytes]
-        if self.sha512sum and ftype == "file":
-            with open(self.path, 'rb') as f:
-                sha512sum = hashlib.sha512(f.read()).digest()
-        else:
-            sha512sum = None
+@Packet(type='request')
+class PacketStatMany(NamedTuple):
+    """This packet is used to retrieve information about many files or directories in a single request."""
+    paths: list[str]
+    follow_links: bool = False
+    sha512sum: bool = False
 
-        # Send response
-        conn.write_packet(PacketStatResult(
-            type=ftype,
-            mode=u64(stat.S_IMODE(s.st_mode)),
-            owner=owner,
-            group=group,
-            size=u64(s.st_size),
-            mtime=u64(s.st_mtime_ns),
-            ctime=u64(s.st_ctime_ns),
-            sha512sum=sha512sum))
+    def handle(self, conn: Connection) -> None:
+        """Stats all requested paths."""
+        # A path below a non-directory (ENOTDIR) doesn't exist either, which allows querying
+        # e.g. a path and a child of it in the same request without knowing its type beforehand.
+        missing = (sys_errno.ENOENT, sys_errno.ENOTDIR)
+        conn.write_packet(PacketStatManyResult(results=[_stat(p, self.follow_links, self.sha512sum, missing, conn.session.digest_cache) for p in self.paths]))
 
 @Packet(type='response')
 class PacketResolveResult(NamedTuple):
     """This packet is used to return the results of a resolve packet."""
     value: str
 
+def _canonical_user(user: Optional[str]) -> Optional[str]:
+    """Returns the canonical name of the given user name or uid (or the current user if None), or None if it doesn't exist."""
+    user = user if user is not None else str(os.getuid())
+    try:
+        return _user_db.getpwnam(user).pw_name
+    except KeyError:
+        try:
+            return _user_db.getpwuid(int(user)).pw_name
+        except (KeyError, ValueError):
+            return None
+
+def _canonical_group(group: Optional[str]) -> Optional[str]:
+    """Returns the canonical name of the given group name or gid (or the current group if None), or None if it doesn't exist."""
+    group = group if group is not None else str(os.getgid())
+    try:
+        return _user_db.getgrnam(group).gr_name
+    except KeyError:
+        try:
+            return _user_db.getgrgid(int(group)).gr_name
+        except (KeyError, ValueError):
+            return None
+
 @Packet(type='request')
 class PacketResolveUser(NamedTuple):
     """
@@ -502,20 +1491,13 @@ class PacketResolveUser(NamedTuple):
 
     def handle(self, conn: Connection) -> None:
         """Resolves the requested user."""
-        user = self.user if self.user is not None else str(os.getuid())
-
-        try:
-            pw = getpwnam(user)
-        except KeyError:
-            try:
-                uid = int(user)
-                pw = getpwuid(uid)
-            except (KeyError, ValueError):
-                conn.write_packet(PacketInvalidField("user", "The user does not exist"))
-                return
+        name = _canonical_user(self.user)
+        if name is None:
+            conn.write_packet(PacketInvalidField("user", "The user does not exist"))
+            return
 
         # Send response
-        conn.write_packet(PacketResolveResult(value=pw.pw_name))
+        conn.write_packet(PacketResolveResult(value=name))
 
 @Packet(type='request')
 class PacketResolveGroup(NamedTuple):
@@ -527,67 +1509,621 @@ class PacketResolveGroup(NamedTuple):
 
     def handle(self, conn: Connection) -> None:
         """Resolves the requested group."""
-        group = self.group if self.group is not None else str(os.getgid())
-
-        try:
-            gr = getgrnam(group)
-        except KeyError:
-            try:
-                gid = int(group)
-                gr = getgrgid(gid)
-            except (KeyError, ValueError):
-                conn.write_packet(PacketInvalidField("group", "The group does not exist"))
-                return
+        name = _canonical_group(self.group)
+        if name is None:
+            conn.write_packet(PacketInvalidField("group", "The group does not exist"))
+            return
 
         # Send response
-        conn.write_packet(PacketResolveResult(value=gr.gr_name))
+        conn.write_packet(PacketResolveResult(value=name))
+
+@Packet(type='response')
+class PacketResolveManyResult(NamedTuple):
+    """This packet is used to return the results of a resolve many packet."""
+    values: list[Optional[str]]
+    """The canonical names in the same order as requested. None denotes a user or group that doesn't exist."""
 
 @Packet(type='request')
-class PacketUpload(NamedTuple):
-    """This packet is used to upload the given content to the remote and save it as a file.
-    Overwrites existing files. Responds with PacketOk if saving was successful, or PacketInvalidField if any
-    field contained an invalid value."""
-    file: str
-    content: bytes
-    mode: Optional[str] = None
-    owner: Optional[str] = None
-    group: Optional[str] = None
+class PacketResolveUserMany(NamedTuple):
+    """
+    This packet is used to canonicalize many user names / uids in a single request.
+    Each None entry queries the current user.
+    """
+    users: list[Optional[str]]
 
     def handle(self, conn: Connection) -> None:
-        """Saves the content under the given path."""
-        uid, gid = (None, None)
-        mode_oct = None
+        """Resolves all requested users."""
+        conn.write_packet(PacketResolveManyResult(values=[_canonical_user(u) for u in self.users]))
 
-        if self.mode is not None:
-            try:
-                mode_oct = _resolve_oct(self.mode)
-            except ValueError as e:
-                conn.write_packet(PacketInvalidField("mode", str(e)))
-                return
+@Packet(type='request')
+class PacketResolveGroupMany(NamedTuple):
+    """
+    This packet is used to canonicalize many group names / gids in a single request.
+    Each None entry queries the current group.
+    """
+    groups: list[Optional[str]]
+
+    def handle(self, conn: Connection) -> None:
+        """Resolves all requested groups."""
+        conn.write_packet(PacketResolveManyResult(values=[_canonical_group(g) for g in self.groups]))
+
+def _resolve_file_attributes(conn: Connection, mode: Optional[str], owner: Optional[str], group: Optional[str]) -> Optional[tuple[Optional[int], int, int]]:
+    """
+    Resolves the given mode, owner and group of a file. Sends PacketInvalidField
+    and returns None if any of the fields contain an invalid value.
+
+    Returns
+    -------
+    Optional[tuple[Optional[int], int, int]]
+        The numeric mode (None if not given), uid and gid (-1 if not given).
+    """
+    uid, gid = (-1, -1)
+    mode_oct = None
+
+    if mode is not None:
+        try:
+            mode_oct = _resolve_oct(mode)
+        except ValueError as e:
+            conn.write_packet(PacketInvalidField("mode", str(e)))
+            return None
+
+    if owner is not None:
+        try:
+            (uid, gid) = _resolve_user(owner)
+        except ValueError as e:
+            conn.write_packet(PacketInvalidField("owner", str(e)))
+            return None
+
+    if group is not None:
+        try:
+            gid = _resolve_group(group)
+        except ValueError as e:
+            conn.write_packet(PacketInvalidField("group", str(e)))
+            return None
+
+    return (mode_oct, uid, gid)
+
+_FICLONE = 0x40049409
+"""The ioctl request to share the data blocks of a file with another file (a reflink)."""
+
+def _clone_file(src: int, dst: int) -> None:
+    """
+    Copies the content of the file src to the empty file dst, both given as file descriptors
+    positioned at the start. Shares the data blocks if the filesystem supports reflinks, otherwise
+    copies within the kernel (with copy_file_range, or sendfile across filesystems on older kernels),
+    and only falls back to copying through userspace if neither is supported.
+    """
+    try:
+        fcntl.ioctl(dst, _FICLONE, src)
+        return
+    except OSError:
+        pass
+
+    for copy in (os.copy_file_range, lambda src, dst, count: os.sendfile(dst, src, None, count)):
+        try:
+            while copy(src, dst, 1 << 30) > 0:
+                pass
+            return
+        except OSError as e:
+            # Unsupported by the kernel or filesystem, but only if nothing was copied yet
+            if e.errno not in (sys_errno.EXDEV, sys_errno.EINVAL, sys_errno.ENOSYS, sys_errno.EOPNOTSUPP) \
+                    or os.lseek(dst, 0, os.SEEK_CUR) != 0:
+                raise
+
+    while True:
+        data = os.read(src, 1 << 20)
+        if not data:
+            return
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(dst, view):]
+
+class _UploadFile:
+    """
+    A file that is being uploaded. The content is written to a temporary file next to the
+    destination, which atomically replaces the destination when the upload is finished.
+    If no mode, owner or group is given, the ones of an existing destination are kept.
+    Special files, files with several hard links, files whose ownership we cannot keep and files in
+    directories that we cannot write to are written in-place instead, where only the given mode,
+    owner and group are applied. Their content is first written to an anonymous temporary file and
+    only copied to the destination when the upload is finished, so that the destination stays intact
+    if the upload fails and can still be the basis of a delta (see `copy_from_basis`).
+    """
+
+    def __init__(self, file: str, mode: Optional[int], uid: int, gid: int):
+        # Replace the target of a symlink instead of the link itself
+        self.file = os.path.realpath(file)
+        self.tmp_file: Optional[str] = None
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.sha512 = hashlib.sha512()
+        self.error: Optional[OSError] = None
+        self.basis: Optional[IO[bytes]] = None
+        self.replaced = False
+        """Whether the destination was replaced by the temporary file, so that it has exactly the uploaded content."""
+        self.in_place = False
+        """Whether the content is written to the destination in-place when the upload is finished."""
+
+        try:
+            st = os.stat(self.file)
+        except FileNotFoundError:
+            st = None
 
-        if self.owner is not None:
+        # Replacing the file would break its other hard links
+        if st is not None and (not stat.S_ISREG(st.st_mode) or st.st_nlink > 1):
+            self._write_in_place()
+            return
+
+        try:
+            fd, self.tmp_file = tempfile.mkstemp(dir=os.path.dirname(self.file), prefix=f".{os.path.basename(self.file)}.", suffix=".tmp")
+            self.f: IO[bytes] = os.fdopen(fd, 'wb')
+        except PermissionError:
+            self._write_in_place()
+            return
+
+        if st is None:
+            # New files are created according to the dispatcher's umask of 077
+            self.mode = 0o600 if mode is None else mode
+            return
+
+        self.mode = stat.S_IMODE(st.st_mode) if mode is None else mode
+        # The temporary file belongs to us, so the ownership of the existing file must only be
+        # kept if it differs. This requires the privilege to give the file away, otherwise we write in-place.
+        tmp_st = os.fstat(fd)
+        keep_uid = st.st_uid if uid == -1 and st.st_uid != tmp_st.st_uid else -1
+        keep_gid = st.st_gid if gid == -1 and st.st_gid != tmp_st.st_gid else -1
+        if keep_uid != -1 or keep_gid != -1:
             try:
-                (uid, gid) = _resolve_user(self.owner)
-            except ValueError as e:
-                conn.write_packet(PacketInvalidField("owner", str(e)))
-                return
+                os.fchown(fd, keep_uid, keep_gid)
+            except PermissionError:
+                self.abort()
+                self.tmp_file = None
+                self.mode = mode
+                self._write_in_place()
+
+    def _write_in_place(self) -> None:
+        """Writes the content to an anonymous temporary file, which is copied to the destination when the upload is finished."""
+        self.in_place = True
+        self.f = tempfile.TemporaryFile() # pylint: disable=consider-using-with
+
+    def write(self, data: bytes) -> None:
+        """Appends the given data. Errors are deferred until the upload is finished."""
+        if self.error is not None:
+            return
+        try:
+            self.f.write(data)
+        except OSError as e:
+            self.error = e
+            return
+        self.sha512.update(data)
+
+    def clone_from(self, src: IO[bytes]) -> None:
+        """Sets the content to a copy of the given file (see `_clone_file`). The content is not hashed.
+        Errors are deferred until the upload is finished."""
+        if self.error is not None:
+            return
+        try:
+            self.f.flush()
+            _clone_file(src.fileno(), self.f.fileno())
+        except OSError as e:
+            self.error = e
 
-        if self.group is not None:
+    def copy_from_basis(self, offset: int, length: int) -> None:
+        """Appends the given range of the file that is being replaced. Errors are deferred until the upload is finished.
+        If the range extends beyond the end of that file, the content will not match the expected digest."""
+        if self.error is not None:
+            return
+        try:
+            if self.basis is None:
+                self.basis = open(self.file, 'rb') # pylint: disable=consider-using-with
+            end = offset + length
+            while offset < end:
+                data = os.pread(self.basis.fileno(), min(end - offset, 1 << 20), offset)
+                if not data:
+                    return
+                self.write(data)
+                offset += len(data)
+        except OSError as e:
+            self.error = e
+
+    def abort(self) -> None:
+        """Discards the upload."""
+        if self.basis is not None:
+            self.basis.close()
+        self.f.close()
+        if self.tmp_file is not None:
             try:
-                gid = _resolve_group(self.group)
-            except ValueError as e:
-                conn.write_packet(PacketInvalidField("group", str(e)))
+                os.remove(self.tmp_file)
+            except FileNotFoundError:
+                pass
+
+    def finish(self, sha512sum: Optional[bytes]) -> bool:
+        """
+        Replaces the destination with the uploaded file, if the digest matches the
+        given one (or no digest is given). Otherwise, the upload is discarded.
+        Raises any deferred OSError.
+
+        Returns
+        -------
+        bool
+            False if the digest didn't match.
+        """
+        try:
+            if self.error is not None:
+                raise self.error
+            if sha512sum is not None and self.sha512.digest() != sha512sum:
+                return False
+            self.f.flush()
+            if self.in_place:
+                self.f.seek(0)
+                with open(self.file, 'wb') as dst:
+                    # The destination may be a special file, so the content is copied through userspace
+                    while data := self.f.read(1 << 20):
+                        dst.write(data)
+                    dst.flush()
+                    self._set_attributes(dst.fileno())
+                return True
+            self._set_attributes(self.f.fileno())
+            self.f.close()
+            if self.tmp_file is not None:
+                os.replace(self.tmp_file, self.file)
+                self.tmp_file = None
+                self.replaced = True
+            return True
+        finally:
+            self.abort()
+
+    def _set_attributes(self, fd: int) -> None:
+        """Applies the mode and ownership to the given file."""
+        if self.mode is not None:
+            os.fchmod(fd, self.mode)
+        if self.uid != -1 or self.gid != -1:
+            os.fchown(fd, self.uid, self.gid)
+
+class _BlobStore:
+    """
+    A content-addressed store of previously uploaded files, keyed by their sha512sum. Allows the client
+    to place a file that the remote host has seen before without transferring its content again.
+    Each blob is a file named after its digest. Blobs are touched whenever they are used, and the
+    least recently used blobs are evicted once the total size exceeds the maximum size. Blobs are added
+    atomically and evicted under an exclusive lock, so concurrent dispatchers may share the store.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    def _blob(self, sha512sum: bytes) -> str:
+        """Returns the path of the given blob."""
+        return os.path.join(self.path, sha512sum.hex())
+
+    def has(self, sha512sum: bytes) -> bool:
+        """Returns whether the given blob is in the store and marks it as recently used."""
+        try:
+            os.utime(self._blob(sha512sum))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def open(self, sha512sum: bytes) -> Optional[IO[bytes]]:
+        """Opens the given blob and marks it as recently used, or returns None if it isn't in the store."""
+        try:
+            f = open(self._blob(sha512sum), 'rb') # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            return None
+        os.utime(f.fileno())
+        return f
+
+    def add(self, file: str, sha512sum: bytes) -> None:
+        """Adds a copy of the given file to the store, if its content has the given sha512sum.
+        The copy is hashed while it is made, as the file may have been changed in the meantime."""
+        if self.has(sha512sum):
+            return
+        with open(file, 'rb') as src:
+            if os.fstat(src.fileno()).st_size > self.max_size:
                 return
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".blob.")
+            try:
+                sha512 = hashlib.sha512()
+                with os.fdopen(fd, 'wb') as dst:
+                    while True:
+                        data = src.read(1 << 20)
+                        if not data:
+                            break
+                        sha512.update(data)
+                        dst.write(data)
+                if sha512.digest() != sha512sum:
+                    os.unlink(tmp)
+                    return
+                os.replace(tmp, self._blob(sha512sum))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        self._evict()
+
+    def _evict(self) -> None:
+        """Removes the least recently used blobs until the store fits into the maximum size."""
+        with open(os.path.join(self.path, ".lock"), 'ab') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            blobs = []
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    blobs.append((st.st_mtime_ns, st.st_size, entry.path))
+
+            total = sum(size for _, size, _ in blobs)
+            for _, size, path in sorted(blobs):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+def _store_blob(conn: Connection, upload: _UploadFile, sha512sum: bytes) -> None:
+    """Adds a finished upload to the blob store of the session, if enabled. Only uploads that replaced the destination are
+    stored, as a file written in-place may be special or shared. Failures are ignored, as the store is only an optimization."""
+    store = conn.session.blob_store
+    if store is None or not upload.replaced:
+        return
+    try:
+        store.add(upload.file, sha512sum)
+    except OSError:
+        pass
+
+@Packet(type='request')
+class PacketUpload(NamedTuple):
+    """This packet is used to upload the given content to the remote and save it as a file.
+    Overwrites existing files atomically. Responds with PacketOk if saving was successful, or PacketInvalidField if any
+    field contained an invalid value."""
+    file: str
+    content: bytes
+    mode: Optional[str] = None
+    owner: Optional[str] = None
+    group: Optional[str] = None
+
+    def handle(self, conn: Connection) -> None:
+        """Saves the content under the given path."""
+        attrs = _resolve_file_attributes(conn, self.mode, self.owner, self.group)
+        if attrs is None:
+            return
+
+        upload = _UploadFile(self.file, *attrs)
+        upload.write(self.content)
+        upload.finish(None)
+        _store_blob(conn, upload, upload.sha512.digest())
+        conn.write_packet(PacketOk())
+
+@Packet(type='request')
+class PacketUploadBegin(NamedTuple):
+    """This packet is used to begin a streaming upload with the given stream id. The content
+    is then sent in PacketUploadChunk packets, and the upload is finished by PacketUploadEnd.
+    Responds with PacketOk if the upload was started, or PacketInvalidField if any
+    field contained an invalid value."""
+    stream: u32
+    file: str
+    mode: Optional[str] = None
+    owner: Optional[str] = None
+    group: Optional[str] = None
+
+    def handle(self, conn: Connection) -> None:
+        """Creates the temporary file for the upload."""
+        attrs = _resolve_file_attributes(conn, self.mode, self.owner, self.group)
+        if attrs is None:
+            return
 
-        with open(self.file, 'wb') as f:
-            f.write(self.content)
-        if mode_oct is not None:
-            os.chmod(self.file, mode_oct)
-        if uid is not None or gid is not None:
-            os.chown(self.file, uid or 0, gid or 0)
+        conn.session.upload_streams[self.stream] = _UploadFile(self.file, *attrs)
+        conn.write_packet(PacketOk())
+
+@Packet(type='request')
+class PacketUploadChunk(NamedTuple):
+    """This packet is used to send the next chunk of a streaming upload. There is no response,
+    errors are reported as the response to PacketUploadEnd. Chunks for unknown streams are ignored."""
+    stream: u32
+    data: bytes
+
+    def handle(self, conn: Connection) -> None:
+        """Appends the data to the upload."""
+        _ = (conn)
+        upload = conn.session.upload_streams.get(self.stream)
+        if upload is not None:
+            upload.write(self.data)
+
+@Packet(type='request')
+class PacketUploadCopy(NamedTuple):
+    """This packet is used to append a range of the file that is replaced by a streaming upload
+    to the upload, so that unchanged parts don't need to be transferred (see PacketChecksumBlocks).
+    There is no response, errors are reported as the response to PacketUploadEnd."""
+    stream: u32
+    offset: u64
+    length: u64
+
+    def handle(self, conn: Connection) -> None:
+        """Appends the range to the upload."""
+        _ = (conn)
+        upload = conn.session.upload_streams.get(self.stream)
+        if upload is not None:
+            upload.copy_from_basis(self.offset, self.length)
+
+@Packet(type='request')
+class PacketUploadEnd(NamedTuple):
+    """This packet is used to finish a streaming upload. The file is only saved if the given sha512sum
+    matches the received content. Responds with PacketOk if saving was successful, or PacketInvalidField
+    if the stream is unknown or the digest doesn't match."""
+    stream: u32
+    sha512sum: bytes
 
+    def handle(self, conn: Connection) -> None:
+        """Saves the uploaded file."""
+        upload = conn.session.upload_streams.pop(self.stream, None)
+        if upload is None:
+            conn.write_packet(PacketInvalidField("stream", "The upload stream does not exist"))
+            return
+
+        if not upload.finish(self.sha512sum):
+            conn.write_packet(PacketInvalidField("sha512sum", "The digest of the received content does not match"))
+            return
+
+        _store_blob(conn, upload, self.sha512sum)
         conn.write_packet(PacketOk())
 
+@Packet(type='request')
+class PacketUploadAbort(NamedTuple):
+    """This packet is used to discard a streaming upload. There is no response."""
+    stream: u32
+
+    def handle(self, conn: Connection) -> None:
+        """Discards the upload."""
+        _ = (conn)
+        upload = conn.session.upload_streams.pop(self.stream, None)
+        if upload is not None:
+            upload.abort()
+
+@Packet(type='response')
+class PacketBlobQueryResult(NamedTuple):
+    """This packet is used to return which blobs are in the blob store."""
+    present: list[bool]
+    """Whether each blob is in the store, in the same order as requested."""
+
+@Packet(type='request')
+class PacketBlobQuery(NamedTuple):
+    """This packet is used to query which of the given blobs are in the blob store.
+    Responds with PacketBlobQueryResult. If the store isn't enabled, all blobs are reported as missing."""
+    sha512sums: list[bytes]
+
+    def handle(self, conn: Connection) -> None:
+        """Queries the blobs."""
+        store = conn.session.blob_store
+        conn.write_packet(PacketBlobQueryResult(present=[store is not None and store.has(d) for d in self.sha512sums]))
+
+@Packet(type='request')
+class PacketPlaceBlob(NamedTuple):
+    """This packet is used to save a copy of a blob from the blob store as a file. Overwrites existing files
+    atomically, just like PacketUpload. Responds with PacketOk if saving was successful, or PacketInvalidField
+    if any field contained an invalid value or the blob isn't in the store."""
+    file: str
+    sha512sum: bytes
+    mode: Optional[str] = None
+    owner: Optional[str] = None
+    group: Optional[str] = None
+
+    def handle(self, conn: Connection) -> None:
+        """Saves a copy of the blob under the given path."""
+        attrs = _resolve_file_attributes(conn, self.mode, self.owner, self.group)
+        if attrs is None:
+            return
+
+        store = conn.session.blob_store
+        src = None if store is None else store.open(self.sha512sum)
+        if src is None:
+            conn.write_packet(PacketInvalidField("sha512sum", "The blob is not in the store"))
+            return
+
+        with src:
+            upload = _UploadFile(self.file, *attrs)
+            upload.clone_from(src)
+            upload.finish(None)
+        conn.write_packet(PacketOk())
+
+@Packet(type='request')
+class PacketUploadPath(NamedTuple):
+    """This packet is used to save a copy of a file of the client, if both run on the same machine
+    (see PacketAck). The copy is made within the kernel where possible, so the content is never transferred.
+    The source is identified by its path, and must still match the given device, inode, size and mtime
+    as seen by the client. Overwrites existing files atomically, just like PacketUpload. Responds with
+    PacketOk if saving was successful, or PacketInvalidField if any field contained an invalid value,
+    or the source is not accessible or not the file the client sees, in which case the client must upload
+    the content instead."""
+    file: str
+    source: str
+    dev: u64
+    ino: u64
+    size: u64
+    mtime_ns: i64
+    mode: Optional[str] = None
+    owner: Optional[str] = None
+    group: Optional[str] = None
+
+    def handle(self, conn: Connection) -> None:
+        """Saves a copy of the source file under the given path."""
+        attrs = _resolve_file_attributes(conn, self.mode, self.owner, self.group)
+        if attrs is None:
+            return
+
+        try:
+            # Don't block if the source was replaced by e.g. a fifo
+            src = os.fdopen(os.open(self.source, os.O_RDONLY | os.O_NONBLOCK), 'rb')
+        except OSError as e:
+            conn.write_packet(PacketInvalidField("source", str(e)))
+            return
+
+        with src:
+            s = os.fstat(src.fileno())
+            if (s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns) != (self.dev, self.ino, self.size, self.mtime_ns):
+                conn.write_packet(PacketInvalidField("source", "The source is a different file than the one seen by the client"))
+                return
+
+            upload = _UploadFile(self.file, *attrs)
+            upload.clone_from(src)
+            upload.finish(None)
+        conn.write_packet(PacketOk())
+
+@Packet(type='response')
+class PacketBlockChecksums(NamedTuple):
+    """This packet is used to return the checksums of the blocks of a file."""
+    size: u64
+    """The size of the file."""
+    weak: bytes
+    """The adler32 checksum of each block as consecutive big-endian u32."""
+    strong: bytes
+    """The 16 byte blake2b digest of each block, concatenated."""
+
+@Packet(type='request')
+class PacketChecksumBlocks(NamedTuple):
+    """This packet is used to calculate the checksums of each block of the given size of a file,
+    so that the client can send only the differences to the file (see PacketUploadCopy).
+    Responds with PacketBlockChecksums, or PacketInvalidField if the file doesn't exist."""
+    file: str
+    block_size: u32
+
+    def handle(self, conn: Connection) -> None:
+        """Calculates the checksums."""
+        if self.block_size == 0:
+            conn.write_packet(PacketInvalidField("block_size", "The block size must be positive"))
+            return
+
+        try:
+            f = open(self.file, 'rb', buffering=0) # pylint: disable=consider-using-with
+        except OSError as e:
+            if e.errno != sys_errno.ENOENT:
+                raise
+            conn.write_packet(PacketInvalidField("file", str(e)))
+            return
+
+        weak = bytearray()
+        strong = bytearray()
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            buf = bytearray(self.block_size)
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(view)
+                if not n:
+                    break
+                # A short read can only happen at the end of a regular file
+                block = view[:n]
+                weak += _struct_u32.pack(zlib.adler32(block))
+                strong += hashlib.blake2b(block, digest_size=16).digest()
+        conn.write_packet(PacketBlockChecksums(size=u64(size), weak=bytes(weak), strong=bytes(strong)))
+
 @Packet(type='response')
 class PacketDownloadResult(NamedTuple):
     """This packet is used to return the content of a file."""
@@ -613,6 +2149,76 @@ class PacketDownload(NamedTuple):
 
         conn.write_packet(PacketDownloadResult(content))
 
+@Packet(type='response')
+class PacketDownloadOpened(NamedTuple):
+    """This packet is used to return the handle of a file that was opened for a streaming download."""
+    file_handle: u32
+    size: u64
+
+@Packet(type='request')
+class PacketDownloadOpen(NamedTuple):
+    """This packet is used to open a file for a streaming download. The content is then requested
+    in chunks with PacketDownloadRead, and the handle must be released with PacketDownloadClose.
+    Responds with PacketDownloadOpened if opening was successful, or PacketInvalidField if the file doesn't exist."""
+    file: str
+
+    def handle(self, conn: Connection) -> None:
+        """Opens the file."""
+        try:
+            f = open(self.file, 'rb') # pylint: disable=consider-using-with
+        except OSError as e:
+            if e.errno != sys_errno.ENOENT:
+                raise
+            conn.write_packet(PacketInvalidField("file", str(e)))
+            return
+
+        file_handle = u32(next(conn.session.next_download_handle) & 0xffffffff)
+        conn.session.download_handles[file_handle] = f
+        conn.write_packet(PacketDownloadOpened(file_handle=file_handle, size=u64(os.fstat(f.fileno()).st_size)))
+
+@Packet(type='response')
+class PacketDownloadData(NamedTuple):
+    """This packet is used to return a chunk of a streaming download. Less data than requested denotes the end of the file."""
+    data: bytes
+
+@Packet(type='request')
+class PacketDownloadRead(NamedTuple):
+    """This packet is used to read a chunk at the given offset from a file opened by PacketDownloadOpen.
+    Responds with PacketDownloadData, or PacketInvalidField if the handle is unknown."""
+    file_handle: u32
+    offset: u64
+    size: u64
+
+    def handle(self, conn: Connection) -> None:
+        """Reads the requested chunk."""
+        f = conn.session.download_handles.get(self.file_handle)
+        if f is None:
+            conn.write_packet(PacketInvalidField("file_handle", "The download handle does not exist"))
+            return
+
+        # pread may return less than requested before the end of the file
+        chunks = []
+        remaining: int = self.size
+        while remaining > 0:
+            chunk = os.pread(f.fileno(), remaining, self.offset + self.size - remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        conn.write_packet(PacketDownloadData(data=b"".join(chunks)))
+
+@Packet(type='request')
+class PacketDownloadClose(NamedTuple):
+    """This packet is used to release a handle opened by PacketDownloadOpen. There is no response."""
+    file_handle: u32
+
+    def handle(self, conn: Connection) -> None:
+        """Closes the file."""
+        _ = (conn)
+        f = conn.session.download_handles.pop(self.file_handle, None)
+        if f is not None:
+            f.close()
+
 @Packet(type='response')
 class PacketUserEntry(NamedTuple):
     """This packet is used to return information about a user."""
@@ -635,6 +2241,46 @@ class PacketUserEntry(NamedTuple):
     shell: str
     """The default shell of the user"""
 
+def _user_entry(user: str, query_password_hash: bool) -> Optional[PacketUserEntry]:
+    """
+    Queries the given user. Returns None if the user doesn't exist.
+
+    Raises
+    ------
+    ValueError
+        If the password hash was requested but is inaccessible, or the user's primary group doesn't exist.
+    """
+    try:
+        pw = _user_db.getpwnam(user)
+    except KeyError:
+        try:
+            pw = _user_db.getpwuid(int(user))
+        except (KeyError, ValueError):
+            return None
+
+    pw_hash: Optional[str] = None
+    if query_password_hash:
+        try:
+            pw_hash = spwd.getspnam(pw.pw_name).sp_pwdp
+        except KeyError:
+            raise ValueError("The user has no shadow entry, or it is inaccessible.") # pylint: disable=raise-missing-from
+
+    try:
+        group = _user_db.getgrgid(pw.pw_gid).gr_name
+    except KeyError:
+        raise ValueError("The user's primary group doesn't exist") # pylint: disable=raise-missing-from
+
+    return PacketUserEntry(
+        name=pw.pw_name,
+        uid=i64(pw.pw_uid),
+        group=group,
+        gid=i64(pw.pw_gid),
+        groups=_user_db.supplementary_groups(pw.pw_name),
+        password_hash=pw_hash,
+        gecos=pw.pw_gecos,
+        home=pw.pw_dir,
+        shell=pw.pw_shell)
+
 @Packet(type='request')
 class PacketQueryUser(NamedTuple):
     """This packet is used to get information about a group via pwd.getpw*."""
@@ -646,38 +2292,41 @@ class PacketQueryUser(NamedTuple):
     def handle(self, conn: Connection) -> None:
         """Queries the requested user."""
         try:
-            pw = getpwnam(self.user)
-        except KeyError:
-            try:
-                gid = int(self.user)
-                pw = getpwuid(gid)
-            except (KeyError, ValueError):
-                conn.write_packet(PacketInvalidField("user", "The user does not exist"))
-                return
+            entry = _user_entry(self.user, self.query_password_hash)
+        except ValueError as e:
+            conn.write_packet(PacketInvalidField("user", str(e)))
+            return
 
-        pw_hash: Optional[str] = None
-        if self.query_password_hash:
+        if entry is None:
+            conn.write_packet(PacketInvalidField("user", "The user does not exist"))
+            return
+        conn.write_packet(entry)
+
+@Packet(type='response')
+class PacketUserEntries(NamedTuple):
+    """This packet is used to return information about many users."""
+    entries: list[Optional[PacketUserEntry]]
+    """The users in the same order as requested, None for each user that doesn't exist."""
+
+@Packet(type='request')
+class PacketQueryUserMany(NamedTuple):
+    """This packet is used to get information about many users at once.
+    Responds with PacketUserEntries, or PacketInvalidField if any existing user couldn't be queried."""
+    users: list[str]
+    """User names or decimal uids"""
+    query_password_hash: bool
+    """Whether the current password hashes from shadow should also be returned"""
+
+    def handle(self, conn: Connection) -> None:
+        """Queries the requested users."""
+        entries = []
+        for user in self.users:
             try:
-                pw_hash = getspnam(pw.pw_name).sp_pwdp
-            except KeyError:
-                conn.write_packet(PacketInvalidField("user", "The user has no shadow entry, or it is inaccessible."))
+                entries.append(_user_entry(user, self.query_password_hash))
+            except ValueError as e:
+                conn.write_packet(PacketInvalidField("users", f"{user}: {str(e)}"))
                 return
-
-        groups = [g.gr_name for g in getgrall() if pw.pw_name in g.gr_mem]
-        try:
-            conn.write_packet(PacketUserEntry(
-                name=pw.pw_name,
-                uid=i64(pw.pw_uid),
-                group=getgrgid(pw.pw_gid).gr_name,
-                gid=i64(pw.pw_gid),
-                groups=groups,
-                password_hash=pw_hash,
-                gecos=pw.pw_gecos,
-                home=pw.pw_dir,
-                shell=pw.pw_shell))
-        except KeyError:
-            conn.write_packet(PacketInvalidField("user", "The user's primary group doesn't exist"))
-            return
+        conn.write_packet(PacketUserEntries(entries=entries))
 
 @Packet(type='response')
 class PacketGroupEntry(NamedTuple):
@@ -689,6 +2338,17 @@ class PacketGroupEntry(NamedTuple):
     members: list[str]
     """All the group member's user names"""
 
+def _group_entry(group: str) -> Optional[PacketGroupEntry]:
+    """Queries the given group. Returns None if the group doesn't exist."""
+    try:
+        gr = _user_db.getgrnam(group)
+    except KeyError:
+        try:
+            gr = _user_db.getgrgid(int(group))
+        except (KeyError, ValueError):
+            return None
+    return PacketGroupEntry(name=gr.gr_name, gid=i64(gr.gr_gid), members=gr.gr_mem)
+
 @Packet(type='request')
 class PacketQueryGroup(NamedTuple):
     """This packet is used to get information about a group via grp.getgr*."""
@@ -697,18 +2357,27 @@ class PacketQueryGroup(NamedTuple):
 
     def handle(self, conn: Connection) -> None:
         """Queries the requested group."""
-        try:
-            gr = getgrnam(self.group)
-        except KeyError:
-            try:
-                gid = int(self.group)
-                gr = getgrgid(gid)
-            except (KeyError, ValueError):
-                conn.write_packet(PacketInvalidField("group", "The group does not exist"))
-                return
+        entry = _group_entry(self.group)
+        if entry is None:
+            conn.write_packet(PacketInvalidField("group", "The group does not exist"))
+            return
+        conn.write_packet(entry)
 
-        # Send response
-        conn.write_packet(PacketGroupEntry(name=gr.gr_name, gid=i64(gr.gr_gid), members=gr.gr_mem))
+@Packet(type='response')
+class PacketGroupEntries(NamedTuple):
+    """This packet is used to return information about many groups."""
+    entries: list[Optional[PacketGroupEntry]]
+    """The groups in the same order as requested, None for each group that doesn't exist."""
+
+@Packet(type='request')
+class PacketQueryGroupMany(NamedTuple):
+    """This packet is used to get information about many groups at once. Responds with PacketGroupEntries."""
+    groups: list[str]
+    """Group names or decimal gids"""
+
+    def handle(self, conn: Connection) -> None:
+        """Queries the requested groups."""
+        conn.write_packet(PacketGroupEntries(entries=[_group_entry(g) for g in self.groups]))
 
 @Packet(type='response')
 class PacketEnvironVar(NamedTuple):
@@ -724,11 +2393,102 @@ class PacketGetenv(NamedTuple):
 
     def handle(self, conn: Connection) -> None:
         """Gets the requested environment variable."""
-        conn.write_packet(PacketEnvironVar(value=os.getenv(self.key)))
+        conn.write_packet(PacketEnvironVar(value=conn.session.getenv(self.key)))
+
+@Packet(type='response')
+class PacketEnvironVars(NamedTuple):
+    """This packet is used to return many environment variables."""
+    values: list[Optional[str]]
+    """The values of the environment variables in the same order as requested, None for each variable that was not set."""
+
+@Packet(type='request')
+class PacketGetenvMany(NamedTuple):
+    """This packet is used to get many environment variables in a single request."""
+    keys: list[str]
+    """The environment variables to retrieve"""
+
+    def handle(self, conn: Connection) -> None:
+        """Gets the requested environment variables."""
+        conn.write_packet(PacketEnvironVars(values=[conn.session.getenv(k) for k in self.keys]))
+
+def receive_frame(conn: Connection) -> tuple[u32, u32, Any]:
+    """
+    Receives the next packet together with its frame header from the given connection.
+    Error responses are returned as-is.
+
+    Parameters
+    ----------
+    conn
+        The connection
+
+    Returns
+    -------
+    tuple[u32, u32, Any]
+        The channel, the request id and the received packet
+
+    Raises
+    ------
+    IOError
+        When an issue on the connection occurs.
+    """
+    try:
+        if not conn.readinto(conn.header):
+            raise IOError("Unexpected EOF in data stream")
+        channel, request_id, packet_id = _struct_frame_packet.unpack(conn.header)
+        packet = _decode_packet(conn, packet_id)
+        if isinstance(packet, PacketCompressed):
+            if not compression_supported(packet.algorithm):
+                raise IOError(f"Received packet with unsupported compression '{packet.algorithm}'")
+            data = compression_algorithms[packet.algorithm][1](packet.data)
+            packet = _read_packet(Connection(io.BytesIO(data), io.BytesIO()))
+        _log(f"got packet {type(packet).__name__} [channel {channel}, request {request_id}]")
+        return (channel, request_id, packet)
+    except struct.error as e:
+        raise IOError("Unexpected EOF in data stream") from e
+
+def _read_packet(conn: Connection) -> Any:
+    """Reads the next packet id and the corresponding packet from the given connection."""
+    return _decode_packet(conn, cast(u32, _struct_u32.unpack(conn.read(4))[0]))
+
+def _decode_packet(conn: Connection, packet_id: u32) -> Any:
+    """Reads the packet with the given id from the given connection."""
+    decode = packet_deserializers.get(packet_id)
+    if decode is None:
+        raise IOError(f"Received invalid packet id '{packet_id}'")
+    return decode(conn)
+
+def check_response(packet: Any, request: Any = None) -> Any:
+    """
+    Raises the appropriate exception if the given packet is an error response.
+
+    Parameters
+    ----------
+    packet
+        The received packet
+    request
+        The corresponding request packet, if any.
+
+    Returns
+    -------
+    Any
+        The given packet, if it is not an error response.
+
+    Raises
+    ------
+    RemoteOSError
+        An OSError occurred on the remote host.
+    ValueError
+        When an PacketInvalidField is received as the response and a corresponding request packet was given.
+    """
+    if isinstance(packet, PacketOSError):
+        raise RemoteOSError(msg=packet.msg, errno=packet.errno, strerror=packet.strerror)
+    if isinstance(packet, PacketInvalidField):
+        raise ValueError(f"Invalid value '{getattr(request, packet.field)}' given for field '{packet.field}': {packet.error_message}")
+    return packet
 
 def receive_packet(conn: Connection, request: Any = None) -> Any:
     """
-    Receives the next packet from the given connection.
+    Receives the next packet from the given connection, regardless of its channel and request id.
 
     Parameters
     ----------
@@ -751,51 +2511,363 @@ def receive_packet(conn: Connection, request: Any = None) -> Any:
     ValueError
         When an PacketInvalidField is received as the response and a corresponding request packet was given.
     """
+    return check_response(receive_frame(conn)[2], request)
+
+def _handle_request(conn: Connection, packet: Any) -> None:
+    """Handles the given request packet and sends any OSError back as a response."""
+    _log(f"handling packet {type(packet).__name__} [channel {conn.channel}, request {conn.request_id}]")
     try:
-        packet_id = cast(u32, _deserialize(conn, u32))
-        if packet_id not in packet_deserializers:
-            raise IOError(f"Received invalid packet id '{packet_id}'")
+        packet.handle(conn)
+    except OSError as e:
+        conn.write_packet(PacketOSError(errno=i64(e.errno), strerror=e.strerror, msg=str(e)))
+
+class _Dispatcher:
+    """
+    Handles requests on a pool of worker threads. Requests on the same channel are
+    handled one after another in the order they were received, while different channels
+    are handled concurrently. Workers are only started when needed, so a session
+    that never uses more than one channel at a time only ever starts one worker.
+    """
+
+    max_queued: int = 32
+    """The maximum number of requests that may be queued. When exceeded, we stop reading
+    from the connection until a request was handled, so that e.g. upload chunks arriving
+    faster than they can be written exert backpressure on the client instead of piling up in memory."""
+
+    def __init__(self, conn: Connection, workers: int):
+        self.conn = conn
+        self.max_workers = workers
+        self.mutex = threading.Lock()
+        self.lock = threading.Condition(self.mutex)
+        """Signaled when a queued request was handled."""
+        self.work = threading.Condition(self.mutex)
+        """Signaled when a channel became ready or the dispatcher is shut down."""
+        self.queues: dict[u32, deque[tuple[u32, Any]]] = {}
+        self.queued = 0
+        self.ready: deque[u32] = deque()
+        self.workers: list[threading.Thread] = []
+        self.idle_workers = 0
+        self.is_shutdown = False
+
+    def submit(self, channel: u32, request_id: u32, packet: Any) -> None:
+        """Queues the given request on its channel and schedules the channel if it is idle.
+        A PacketProcessKill is handled right away, as it must not wait for a process that is stuck."""
+        if isinstance(packet, PacketProcessKill):
+            _handle_request(self.conn.for_request(channel, request_id), packet)
+            return
+        with self.lock:
+            while self.queued >= self.max_queued:
+                self.lock.wait()
+            self.queued += 1
+            queue = self.queues.get(channel)
+            if queue is not None:
+                queue.append((request_id, packet))
+                return
+            self.queues[channel] = deque([(request_id, packet)])
+            self.ready.append(channel)
+            # A notified worker counts as idle until it has taken a channel, so requests
+            # arriving in a burst must not all be left to the same idle worker.
+            if self.idle_workers >= len(self.ready):
+                self.work.notify()
+                return
+            if len(self.workers) >= self.max_workers:
+                return
+            worker = threading.Thread(target=self._run_worker, daemon=True)
+            self.workers.append(worker)
+        worker.start()
+
+    def _run_worker(self) -> None:
+        """Handles ready channels until the dispatcher is shut down."""
+        while True:
+            with self.work:
+                while len(self.ready) == 0 and not self.is_shutdown:
+                    self.idle_workers += 1
+                    self.work.wait()
+                    self.idle_workers -= 1
+                if len(self.ready) == 0:
+                    return
+                channel = self.ready.popleft()
+            self._run_channel(channel)
+
+    def _run_channel(self, channel: u32) -> None:
+        """Handles all queued requests of the given channel until its queue is empty."""
+        try:
+            while True:
+                with self.lock:
+                    queue = self.queues[channel]
+                    if len(queue) == 0:
+                        del self.queues[channel]
+                        return
+                    request_id, packet = queue.popleft()
+                _handle_request(self.conn.for_request(channel, request_id), packet)
+                with self.lock:
+                    self.queued -= 1
+                    self.lock.notify()
+        except Exception: # pylint: disable=broad-except
+            self.fail()
+
+    def fail(self) -> None:
+        """Called when handling a request raised an unexpected exception."""
+        # Mirror the behavior of an unhandled exception in the main thread.
+        traceback.print_exc()
+        os._exit(1) # pylint: disable=protected-access
+
+    def shutdown(self) -> None:
+        """Waits until all queued requests have been handled."""
+        with self.work:
+            self.is_shutdown = True
+            self.work.notify_all()
+            workers = list(self.workers)
+        for worker in workers:
+            worker.join()
+
+def _serve(conn: Connection, dispatcher: Optional[_Dispatcher] = None) -> None:
+    """Handles all incoming packets of a session in a loop until an invalid packet or a PacketExit is received.
+    The requests are handled by the given dispatcher, or by a new `_Dispatcher` if none is given."""
+    if dispatcher is None:
+        dispatcher = _Dispatcher(conn, max_workers)
 
+    try:
+        while not conn.should_close:
+            try:
+                _log("waiting for packet")
+                channel, request_id, packet = receive_frame(conn)
+            except IOError as e:
+                print(f"{str(e)}. Aborting.", file=sys.stderr, flush=True)
+                sys.exit(3)
+            _log(f"received packet {type(packet).__name__}")
+
+            if isinstance(packet, PacketExit):
+                # Finish all outstanding requests before exiting. PacketExit doesn't send a response
+                # and must be handled on the connection itself to signal the loop to stop.
+                dispatcher.shutdown()
+                _handle_request(conn, packet)
+            else:
+                dispatcher.submit(channel, request_id, packet)
+    finally:
+        _close_session(conn, dispatcher)
+
+def _close_session(conn: Connection, dispatcher: _Dispatcher) -> None:
+    """Waits for all outstanding requests of a session. Then discards unfinished uploads,
+    releases open downloads, kills streaming processes and persists the digest cache."""
+    dispatcher.shutdown()
+    conn.session.close()
+    if conn.session.digest_cache is not None:
         try:
-            packet_name = packets[packet_id].__name__
-        except KeyError:
-            packet_name = f"[unknown packet with id {packet_id}]"
-
-        _log(f"got packet header for: {packet_name}")
-        packet = packet_deserializers[packet_id](conn)
-        if isinstance(packet, PacketOSError):
-            raise RemoteOSError(msg=packet.msg, errno=packet.errno, strerror=packet.strerror)
-        if isinstance(packet, PacketInvalidField):
-            raise ValueError(f"Invalid value '{getattr(request, packet.field)}' given for field '{packet.field}': {packet.error_message}")
-        return packet
-    except struct.error as e:
-        raise IOError("Unexpected EOF in data stream") from e
+            conn.session.digest_cache.save()
+        except OSError as e:
+            # The cache is only an optimization
+            print(f"Could not save digest cache: {str(e)}", file=sys.stderr, flush=True)
+
+# Daemon mode
+# ----------------------------------------------------------------
+# With --daemon, the dispatcher keeps running in the background after a session ends and listens
+# on a per-user UNIX socket, so that later sessions keep its warm caches (user database, digest
+# cache, blob store) and skip the interpreter startup. Every started dispatcher just relays
+# stdin/stdout to the daemon, and starts the daemon first if none is running. The socket is
+# specific to the version of the dispatcher, so a changed dispatcher never attaches to an old daemon.
+# The daemon inherited the environment of the session that started it, so every relay first sends
+# its own environment, which is then used for the environment variables and processes of its session.
+
+class _DaemonDispatcher(_Dispatcher):
+    """A dispatcher for a session of the daemon, which only ends its own session on an unexpected
+    exception instead of exiting the process, as that would end all other sessions, too."""
+
+    def __init__(self, conn: Connection, workers: int, client: "socket.socket"):
+        super().__init__(conn, workers)
+        self.client = client
+
+    def fail(self) -> None:
+        traceback.print_exc()
+        # The session then receives EOF, and the client sees that the connection was closed
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def _encode_environ() -> bytes:
+    """Encodes the environment of this process for `_read_environ`, prefixed with its length."""
+    data = b"\0".join(k + b"=" + v for k, v in os.environb.items())
+    return _struct_u32.pack(len(data)) + data
+
+def _read_environ(buffer_in: IO[bytes]) -> dict[str, str]:
+    """Reads an environment that was encoded with `_encode_environ`."""
+    header = buffer_in.read(4)
+    if len(header) != 4:
+        raise IOError("Unexpected EOF in data stream")
+    size = _struct_u32.unpack(header)[0]
+    data = buffer_in.read(size)
+    if len(data) != size:
+        raise IOError("Unexpected EOF in data stream")
+    environ = {}
+    for entry in data.split(b"\0") if size > 0 else []:
+        k, _, v = entry.partition(b"=")
+        environ[os.fsdecode(k)] = os.fsdecode(v)
+    return environ
+
+def _daemon_socket_path(version: str) -> str:
+    """Returns the socket path of the daemon for the given dispatcher version, after ensuring that its directory is private."""
+    directory = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), f"fora-{os.getuid()}")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    s = os.lstat(directory)
+    if not stat.S_ISDIR(s.st_mode) or s.st_uid != os.getuid() or (s.st_mode & 0o077) != 0:
+        raise PermissionError(sys_errno.EPERM, "Daemon directory is not private", directory)
+    return os.path.join(directory, f"dispatcher-{version}.sock")
+
+def _connect_daemon(path: str) -> Optional["socket.socket"]:
+    """Connects to the daemon listening on the given path, or returns None if there is none."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def _run_daemon(listener: "socket.socket", path: str, idle_timeout: float) -> None:
+    """Serves sessions on the given listening socket until no session was active for the given time."""
+    lock = threading.Condition()
+    active = 0
+    last_active = time.monotonic()
+
+    def session(client: "socket.socket") -> None:
+        nonlocal active, last_active
+        try:
+            with client, client.makefile('rb') as buffer_in, client.makefile('wb') as buffer_out:
+                conn = Connection(buffer_in, buffer_out)
+                conn.session.environ = _read_environ(buffer_in)
+                _serve(conn, _DaemonDispatcher(conn, max_workers, client))
+        finally:
+            with lock:
+                active -= 1
+                last_active = time.monotonic()
+                lock.notify_all()
+
+    def start_session(client: "socket.socket") -> None:
+        nonlocal active
+        client.setblocking(True)
+        with lock:
+            active += 1
+        threading.Thread(target=session, args=(client,), daemon=True).start()
+
+    listener.settimeout(min(1.0, idle_timeout))
+    while True:
+        try:
+            client, _ = listener.accept()
+        except socket.timeout:
+            with lock:
+                if active == 0 and time.monotonic() - last_active >= idle_timeout:
+                    break
+            continue
+        start_session(client)
+
+    # Stop accepting new sessions, but still serve those that connected in the meantime
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener.setblocking(False)
+    while True:
+        try:
+            client, _ = listener.accept()
+        except BlockingIOError:
+            break
+        start_session(client)
+    listener.close()
+    with lock:
+        lock.wait_for(lambda: active == 0)
+
+def _start_daemon(path: str, idle_timeout: float, lock_file: IO[bytes]) -> None:
+    """Starts a detached daemon listening on the given path. Must be called while no other threads are running."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(16)
+
+    pid = os.fork()
+    if pid != 0:
+        listener.close()
+        os.waitpid(pid, 0)
+        return
+
+    # Detach from the session of the relay, and make sure the daemon doesn't
+    # hold on to the lock or the stdio of the relay, which belong to the client connection.
+    try:
+        lock_file.close()
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0) # pylint: disable=protected-access
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        _run_daemon(listener, path, idle_timeout)
+    finally:
+        os._exit(0) # pylint: disable=protected-access
+
+def _relay(sock: "socket.socket") -> None:
+    """Sends the environment of this process to the given socket. Then forwards stdin to it
+    and everything received from it to stdout, until the socket is closed."""
+    def forward_input() -> None:
+        try:
+            sock.sendall(_encode_environ())
+            while data := os.read(0, 1 << 16):
+                sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    threading.Thread(target=forward_input, daemon=True).start()
+    with sock:
+        while data := sock.recv(1 << 16):
+            view = memoryview(data)
+            while len(view) > 0:
+                view = view[os.write(1, view):]
+
+def _attach_daemon(version: str, idle_timeout: float) -> None:
+    """Relays this session to the daemon for the given version, starting it if necessary.
+    Falls back to serving the session in this process if the daemon cannot be used."""
+    try:
+        path = _daemon_socket_path(version)
+        sock = _connect_daemon(path)
+        if sock is None:
+            # Prevent concurrent sessions from starting multiple daemons
+            with open(path + ".lock", 'ab') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                sock = _connect_daemon(path)
+                if sock is None:
+                    _start_daemon(path, idle_timeout, lock_file)
+                    sock = _connect_daemon(path)
+    except OSError as e:
+        print(f"Could not start daemon: {str(e)}", file=sys.stderr, flush=True)
+        sock = None
+
+    if sock is None:
+        _serve(Connection(sys.stdin.buffer, sys.stdout.buffer))
+    else:
+        _relay(sock)
 
 def _main() -> None:
-    """Handles all incoming packets in a loop until an invalid packet or a PacketExit is received."""
+    """Serves a single session on stdin/stdout, or relays it to a daemon if started with --daemon <version> <idle_timeout>."""
     os.umask(0o077)
 
     # pylint: disable=global-statement
     global debug
     global is_server
-    debug = len(sys.argv) > 1 and sys.argv[1] == "--debug"
-    is_server = __name__ == "__main__"
-
-    conn = Connection(sys.stdin.buffer, sys.stdout.buffer)
-
-    while not conn.should_close:
-        try:
-            _log("waiting for packet")
-            packet = receive_packet(conn)
-        except IOError as e:
-            print(f"{str(e)}. Aborting.", file=sys.stderr, flush=True)
-            sys.exit(3)
-        _log(f"received packet {type(packet).__name__}")
-
-        try:
-            packet.handle(conn)
-        except OSError as e:
-            conn.write_packet(PacketOSError(errno=i64(e.errno), strerror=e.strerror, msg=str(e)))
+    args = sys.argv[1:]
+    debug = "--debug" in args
+    # The dispatcher may be imported from a cached copy on the remote host,
+    # so __name__ cannot be used to detect whether this is the server.
+    is_server = True
+
+    if "--daemon" in args:
+        i = args.index("--daemon")
+        _attach_daemon(args[i + 1], float(args[i + 2]))
+    else:
+        _serve(Connection(sys.stdin.buffer, sys.stdout.buffer))
 
 if __name__ == '__main__':
     _main()
@@ -168,6 +168,29 @@ class InventoryWrapper(ModuleWrapper):
     {% endtabs %}
     """
 
+    batch_size: Optional[Union[int, str]] = None
+    """
+    The default for `--batch-size`. If set, the script is rolled out in batches of
+    this many hosts, where each batch must finish before the next one is started.
+    Can be given as a number of hosts (`2`) or as a percentage of hosts (`"25%"`).
+    The default `None` runs all selected hosts in a single batch.
+    """
+
+    max_fail_percentage: float = 0.0
+    """
+    The default for `--max-fail-percentage`. When rolling out in batches, no further
+    hosts are started once the script has failed on more than this percentage of the
+    selected hosts, even in the middle of a batch. By default, the rollout is stopped
+    after the first failed host.
+    """
+
+    batch_by_group: bool = False
+    """
+    The default for `--batch-by-group`. If set, each batch only contains hosts of a single
+    group, and the batches are ordered by the topological order of the groups. A host belongs
+    to the group with the highest precedence of all of its groups.
+    """
+
     _is_initialized: bool = False
     """A flag to indicate whether or not the inventory is fully initialized."""
 
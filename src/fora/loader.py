@@ -3,18 +3,41 @@
 import inspect
 import os
 import subprocess
+from contextvars import ContextVar
 from types import ModuleType
 from typing import Union, Any, Optional
 
 import fora
 
-from fora import logger
+from fora import lockstep, logger
 from fora.inventory_wrapper import InventoryWrapper
 from fora.types import ScriptWrapper
-from fora.utils import FatalError, load_py_module, print_process_error
+from fora.utils import ContextStack, FatalError, load_py_module, print_process_error
 
-script_stack: list[tuple[ScriptWrapper, inspect.FrameInfo]] = []
-"""A stack of all currently executed scripts ((name, file), frame)."""
+script_stack: ContextStack[tuple[ScriptWrapper, inspect.FrameInfo]] = ContextStack("script_stack")
+"""A stack of all currently executed scripts ((name, file), frame). Local to the current context (see `fora.utils.ContextStack`)."""
+
+working_directory: ContextVar[Optional[str]] = ContextVar("working_directory", default=None)
+"""The directory of the script that is executed in the current context, or None if no script is executed."""
+
+def local_path(path: str) -> str:
+    """
+    Resolves a relative local path against the directory of the script that is executed in the
+    current context. Hosts that run in lockstep share the process-wide working directory, so
+    operations must use this instead of relying on the working directory to be the script's directory.
+
+    Parameters
+    ----------
+    path
+        The local path to resolve.
+
+    Returns
+    -------
+    str
+        The resolved path, or the given path if it is absolute or no script is executed.
+    """
+    directory = working_directory.get()
+    return path if directory is None else os.path.join(directory, path)
 
 class ImmediateInventory:
     """A temporary inventory just for a single run, without the ability to load host or group module files."""
@@ -114,12 +137,17 @@ def run_script(script: str,
         try:
             previous_script = fora.script
             previous_working_directory = os.getcwd()
-            canonical_script = os.path.realpath(script)
+            canonical_script = os.path.realpath(local_path(script))
 
             # Change into script's containing directory, so a script
             # can reliably use relative paths while it is executed.
+            # Hosts running in lockstep share the process, so then only
+            # the context's working directory is changed (see `local_path`).
             new_working_directory = os.path.dirname(canonical_script)
-            os.chdir(new_working_directory)
+            working_directory_token = working_directory.set(new_working_directory)
+            change_directory = not lockstep.active()
+            if change_directory:
+                os.chdir(new_working_directory)
 
             try:
                 fora.script = wrapper
@@ -131,7 +159,9 @@ def run_script(script: str,
                         setattr(module, '_params', params or {})
                     load_py_module(canonical_script, pre_exec=_pre_exec)
             finally:
-                os.chdir(previous_working_directory)
+                if change_directory:
+                    os.chdir(previous_working_directory)
+                working_directory.reset(working_directory_token)
                 fora.script = previous_script
         except Exception as e:
             if isinstance(e, subprocess.CalledProcessError) and not hasattr(e, "__fora_already_printed"):
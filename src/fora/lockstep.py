@@ -0,0 +1,185 @@
+"""
+Provides lockstep execution of a script on multiple hosts. Each host runs in its own thread,
+and the hosts wait for each other at synchronization points, which are placed by the
+`fora.operations.api.operation` wrapper: once after the current state was probed,
+and once after the changes were applied by each top-level operation.
+"""
+
+import contextvars
+import io
+import sys
+import threading
+from contextvars import ContextVar
+from typing import Any, Callable, Optional, TextIO
+
+from fora.logger import col
+
+class Barrier:
+    """
+    A reusable barrier for a shrinking group of threads. In contrast to `threading.Barrier`,
+    threads can leave the group, which releases the remaining threads if they were only
+    waiting for the threads that left.
+    """
+
+    def __init__(self, parties: int, action: Optional[Callable[[], None]] = None):
+        self.parties = parties
+        self.waiting = 0
+        self.generation = 0
+        self.action = action
+        self.cond = threading.Condition()
+
+    def _release(self) -> None:
+        """Releases all waiting threads. Must be called with the lock held."""
+        if self.action is not None:
+            self.action()
+        self.waiting = 0
+        self.generation += 1
+        self.cond.notify_all()
+
+    def wait(self) -> None:
+        """Waits until all remaining threads have called `wait` or `leave`."""
+        with self.cond:
+            generation = self.generation
+            self.waiting += 1
+            if self.waiting >= self.parties:
+                self._release()
+                return
+            while generation == self.generation:
+                self.cond.wait()
+
+    def leave(self) -> None:
+        """Removes the calling thread from the group, so that other threads don't wait for it anymore."""
+        with self.cond:
+            self.parties -= 1
+            if self.waiting > 0 and self.waiting >= self.parties:
+                self._release()
+
+class _RoutedOutput:
+    """
+    A text stream that writes to the output buffer of the host running in the
+    current context, or to the wrapped stream if there is none.
+    """
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+
+    def write(self, s: str) -> int:
+        """Writes the given string to the current buffer."""
+        buffer = _output.get()
+        if buffer is None:
+            return self.stream.write(s)
+        return buffer.write(s)
+
+    def flush(self) -> None:
+        """Flushes the wrapped stream. Buffered output is written at the next synchronization point."""
+        if _output.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.stream, attr)
+
+_output: ContextVar[Optional[io.StringIO]] = ContextVar("lockstep_output", default=None)
+"""The output buffer of the host running in the current context."""
+
+_current: ContextVar[Optional["Lockstep"]] = ContextVar("lockstep", default=None)
+"""The lockstep run the host in the current context belongs to."""
+
+class Lockstep:
+    """
+    Runs a function for multiple hosts at the same time, each in a separate thread.
+    Everything printed by a host is buffered and written at the next synchronization point,
+    with each line prefixed by the name of the host. This keeps the output of each step
+    together, and in the order of the hosts.
+    """
+
+    def __init__(self, hosts: list[str]):
+        self.hosts = hosts
+        self.buffers = {k: io.StringIO() for k in hosts}
+        self.barrier = Barrier(len(hosts), self.flush)
+        self.stream: TextIO = sys.stdout
+
+    def flush(self, final: bool = False) -> None:
+        """
+        Writes all complete lines from the output buffers to the output stream.
+
+        Parameters
+        ----------
+        final
+            Whether to also write incomplete lines.
+        """
+        width = max(len(k) for k in self.hosts)
+        for k in self.hosts:
+            data = self.buffers[k].getvalue()
+            end = len(data) if final else data.rfind("\n") + 1
+            if end == 0:
+                continue
+            lines = data[:end].split("\n")
+            if lines[-1] == "":
+                lines.pop()
+            for line in lines:
+                # Status lines are overwritten after returning to the beginning of the line
+                line = line.rsplit("\r", 1)[-1]
+                self.stream.write(f"{col('[32m')}{k:<{width}}{col('[m')} {col('[90m')}│{col('[m')} {line}\n")
+            # The buffer is still referenced by the context of the host
+            buffer = self.buffers[k]
+            buffer.seek(0)
+            buffer.truncate()
+            buffer.write(data[end:])
+        self.stream.flush()
+
+    def _run_host(self, host: str, function: Callable[[str], bool], failed: set[str]) -> None:
+        """Runs the given function for a host in the current thread."""
+        _output.set(self.buffers[host])
+        _current.set(self)
+        host_failed = True
+        try:
+            host_failed = function(host)
+        finally:
+            if host_failed:
+                failed.add(host)
+            self.barrier.leave()
+
+    def run(self, function: Callable[[str], bool]) -> set[str]:
+        """
+        Calls the given function for all hosts at the same time and waits for all of them to finish.
+        Each thread starts with a copy of the current context.
+
+        Parameters
+        ----------
+        function
+            The function to call with the name of each host. It must return whether it failed.
+
+        Returns
+        -------
+        set[str]
+            The hosts for which the function has failed.
+        """
+        failed: set[str] = set()
+        stdout, stderr = sys.stdout, sys.stderr
+        self.stream = stdout
+        sys.stdout = _RoutedOutput(stdout) # type: ignore[assignment]
+        sys.stderr = _RoutedOutput(stderr) # type: ignore[assignment]
+        try:
+            threads = [threading.Thread(target=contextvars.copy_context().run, args=(self._run_host, k, function, failed), name=f"lockstep-{k}")
+                       for k in self.hosts]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            self.flush(final=True)
+        return failed
+
+def active() -> bool:
+    """Returns whether the host in the current context runs in lockstep with other hosts."""
+    return _current.get() is not None
+
+def sync() -> None:
+    """
+    Waits until all other hosts have reached their next synchronization point, if the
+    host in the current context runs in lockstep with other hosts. Does nothing otherwise.
+    """
+    lockstep = _current.get()
+    if lockstep is not None:
+        lockstep.barrier.wait()
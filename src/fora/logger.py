@@ -5,7 +5,8 @@ Provides logging utilities.
 import argparse
 import difflib
 import os
-from dataclasses import dataclass
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
 import sys
 from types import TracebackType
 from typing import Any, Optional, Type, cast
@@ -16,8 +17,8 @@ import fora
 class State:
     """Global state for logging."""
 
-    indentation_level: int = 0
-    """The current global indentation level."""
+    indentation_level: ContextVar[int] = field(default_factory=lambda: ContextVar("indentation_level", default=0))
+    """The current indentation level. It is kept per context, so that hosts running in separate threads are indented independently."""
 
 state: State = State()
 """The global logger state."""
@@ -34,12 +35,17 @@ def col(color_code: str) -> str:
 
 class IndentationContext:
     """A context manager to modify the indentation level."""
+    def __init__(self) -> None:
+        self.token: Optional[Token[int]] = None
+
     def __enter__(self) -> None:
-        state.indentation_level += 1
+        self.token = state.indentation_level.set(state.indentation_level.get() + 1)
 
     def __exit__(self, exc_type: Optional[Type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
         _ = (exc_type, exc, traceback)
-        state.indentation_level -= 1
+        if self.token is not None:
+            state.indentation_level.reset(self.token)
+            self.token = None
 
 def ellipsis(s: str, width: int) -> str:
     """
@@ -67,10 +73,11 @@ def indent() -> IndentationContext:
 
 def indent_prefix() -> str:
     """Returns the indentation prefix for the current indentation level."""
+    indentation_level = state.indentation_level.get()
     if not use_color():
-        return "  " * state.indentation_level
+        return "  " * indentation_level
     ret = ""
-    for i in range(state.indentation_level):
+    for i in range(indentation_level):
         if i % 2 == 0:
             ret += "[90m│[m "
         else:
@@ -105,6 +112,11 @@ def connection_init(connector: Any) -> None:
     """Prints connection initialization information."""
     print_indented(f"{col('[1;34m')}host{col('[m')} {connector.host.name} via {col('[1;33m')}{connector.host.url}{col('[m')}", flush=True)
 
+def batch_init(index: int, count: int, hosts: list[str], group: Optional[str] = None) -> None:
+    """Prints which hosts are part of the next batch of a rolling deployment."""
+    group_info = f" {col('[90m')}(group {group}){col('[m')}" if group is not None else ""
+    print_indented(f"{col('[1;35m')}batch{col('[m')} {index}/{count}{group_info} {', '.join(hosts)}", flush=True)
+
 def connection_failed(error_msg: str) -> None:
     """Signals that an error has occurred while establishing the connection."""
     print(col("[1;31m") + "ERR" + col("[m"))
@@ -4,19 +4,27 @@ the CLI interface and main script dispatching.
 """
 
 import argparse
+import functools
 import inspect
+import math
+import multiprocessing
 import os
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
 from types import ModuleType
-from typing import Any, Callable, NoReturn, Optional, cast
+from typing import Any, Callable, NoReturn, Optional, Union, cast
 
 import fora
+from fora import logger
 from fora.connection import open_connection
 from fora.example_deploys import init_deploy_structure
 from fora.loader import load_inventory, run_script
+from fora.lockstep import Lockstep
 from fora.logger import col
 from fora.types import GroupWrapper, HostWrapper, ModuleWrapper, VariableActionSnapshot
-from fora.utils import FatalError, die_error, install_exception_hook, print_fullwith, print_table
+from fora.utils import FatalError, die_error, install_exception_hook, print_error, print_fullwith, print_table
 from fora.version import version
 
 def main_run(args: argparse.Namespace) -> None:
@@ -44,25 +52,376 @@ def main_run(args: argparse.Namespace) -> None:
             die_error(f"Unknown host '{host}'")
         selected_hosts.append(host)
 
-    # TODO: multiprocessing?
-    # - displaying must then be handled by ncurses which makes things a lot more complex.
-    # - would open the door to a more interactive experience, e.g. allow to select past operations
-    #   and view information about them, scroll through diffs, ...
-    # - we need to save some kind of log file as the output won't persist in the terminal
-    # - fatal errors must be delayed until all executions are fininshed.
+    batch_size = args.batch_size if args.batch_size is not None else fora.inventory.batch_size
+    batch_by_group = args.batch_by_group if args.batch_by_group is not None else fora.inventory.batch_by_group
+    if batch_size is not None or batch_by_group:
+        max_fail_percentage = args.max_fail_percentage if args.max_fail_percentage is not None else fora.inventory.max_fail_percentage
+        try:
+            batches = plan_batches(selected_hosts, batch_size, batch_by_group)
+        except ValueError as e:
+            die_error(str(e))
+        if not 0 <= max_fail_percentage <= 100:
+            die_error(f"Invalid maximum failure percentage '{max_fail_percentage}' (must be between 0 and 100)")
+        run_rolling(args.script, batches, args.parallel, max_fail_percentage, lockstep=args.lockstep)
+        return
+
+    if args.lockstep and len(selected_hosts) > 1:
+        failed = run_lockstep(args.script, selected_hosts)
+        if len(failed) > 0:
+            hosts = ", ".join(k for k in selected_hosts if k in failed)
+            die_error(f"script failed on {len(failed)} of {len(selected_hosts)} hosts: {hosts}")
+        return
+
+    if args.parallel > 1 and len(selected_hosts) > 1:
+        run_parallel(args.script, selected_hosts, args.parallel)
+        return
 
     # Instanciate (run) the given script for each selected host
     for k in selected_hosts:
-        host = fora.inventory.loaded_hosts[k]
-        with open_connection(host):
-            fora.host = host
-            run_script(args.script, inspect.getouterframes(inspect.currentframe())[0], name="cmdline")
-            fora.host = cast(HostWrapper, None)
-
-        if host.name != selected_hosts[-1]:
+        run_host(args.script, k)
+        if k != selected_hosts[-1]:
             # Separate hosts by a newline for better visibility
             print()
 
+def run_host(script: str, host_name: str) -> None:
+    """
+    Opens a connection to the given host and runs the given script on it.
+
+    Parameters
+    ----------
+    script
+        The script to run.
+    host_name
+        The name of the host in the loaded inventory.
+    """
+    host = fora.inventory.loaded_hosts[host_name]
+    with open_connection(host):
+        fora.host = host
+        run_script(script, inspect.getouterframes(inspect.currentframe())[0], name="cmdline")
+        fora.host = cast(HostWrapper, None)
+
+@dataclass
+class HostResult:
+    """The result of running a script on a single host in a worker process."""
+
+    host: str
+    """The name of the host."""
+    output: str
+    """Everything that was printed while running the script, including the output of subprocesses."""
+    failed: bool
+    """Whether the script raised an exception or exited with an error."""
+
+def run_host_buffered(script: str, host_name: str) -> HostResult:
+    """
+    Same as `run_host`, but buffers all output and catches all errors, so
+    that the host can be run in a worker process alongside other hosts.
+
+    Parameters
+    ----------
+    script
+        The script to run.
+    host_name
+        The name of the host in the loaded inventory.
+
+    Returns
+    -------
+    HostResult
+        The output and status of the run.
+    """
+    stdout, stderr = sys.stdout, sys.stderr
+    stdout.flush()
+    stderr.flush()
+    saved_fds = (os.dup(1), os.dup(2))
+    with tempfile.TemporaryFile() as buffer:
+        # Redirect the standard file descriptors too, as subprocesses (like the
+        # tunnel dispatcher) inherit them and write to them directly.
+        os.dup2(buffer.fileno(), 1)
+        os.dup2(buffer.fileno(), 2)
+        failed = False
+        try:
+            with open(1, 'w', encoding='utf-8', errors='replace', buffering=1, closefd=False) as out:
+                sys.stdout = sys.stderr = out
+                try:
+                    run_host(script, host_name)
+                except SystemExit as e:
+                    # The error has already been printed
+                    failed = e.code not in (None, 0)
+                except Exception: # pylint: disable=broad-except
+                    sys.excepthook(*sys.exc_info())
+                    failed = True
+        finally:
+            # Workers are reused for other hosts
+            sys.stdout, sys.stderr = stdout, stderr
+            for fd, saved_fd in zip((1, 2), saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+        buffer.seek(0)
+        return HostResult(host=host_name, output=buffer.read().decode('utf-8', errors='replace'), failed=failed)
+
+def run_host_checked(script: str, host_name: str) -> bool:
+    """
+    Same as `run_host`, but catches all errors, so that the remaining hosts can still be run.
+    Exceptions are reported via `sys.excepthook`.
+
+    Parameters
+    ----------
+    script
+        The script to run.
+    host_name
+        The name of the host in the loaded inventory.
+
+    Returns
+    -------
+    bool
+        Whether the script raised an exception or exited with an error.
+    """
+    try:
+        run_host(script, host_name)
+    except SystemExit as e:
+        # The error has already been printed
+        return e.code not in (None, 0)
+    except Exception: # pylint: disable=broad-except
+        sys.excepthook(*sys.exc_info())
+        return True
+    return False
+
+def run_pool(script: str, hosts: list[str], workers: int, max_failures: Optional[int] = None) -> tuple[set[str], list[str]]:
+    """
+    Runs the given script on all given hosts in a pool of worker processes. The workers are
+    forked, so they inherit the loaded inventory. The output of each host is buffered and printed
+    as a whole as soon as the host is finished, so that the output of different hosts is never
+    interleaved. Errors don't abort the other hosts.
+
+    Parameters
+    ----------
+    script
+        The script to run.
+    hosts
+        The names of the hosts in the loaded inventory.
+    workers
+        The maximum number of hosts to run concurrently.
+    max_failures
+        If given, hosts that haven't been started yet are skipped as soon as
+        the script has failed on more than this number of hosts.
+
+    Returns
+    -------
+    tuple[set[str], list[str]]
+        The hosts on which the script has failed, and the hosts that were skipped.
+    """
+    failed: set[str] = set()
+    skipped: set[str] = set()
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=min(workers, len(hosts)), mp_context=context) as pool:
+        futures = {pool.submit(run_host_buffered, script, k): k for k in hosts}
+        first = True
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            if not first:
+                # Separate hosts by a newline for better visibility
+                print()
+            first = False
+            try:
+                result = future.result()
+            except Exception as e: # pylint: disable=broad-except
+                # The worker process died
+                print_error(f"Could not run script on host '{futures[future]}': {str(e)}")
+                failed.add(futures[future])
+            else:
+                print(result.output, end="", flush=True)
+                if result.failed:
+                    failed.add(result.host)
+
+            if max_failures is not None and len(failed) > max_failures:
+                skipped.update(k for f, k in futures.items() if f.cancel())
+
+    return failed, [k for k in hosts if k in skipped]
+
+def run_parallel(script: str, selected_hosts: list[str], workers: int) -> None:
+    """
+    Runs the given script on all selected hosts in a pool of worker processes (see `run_pool`).
+    Errors don't abort the other hosts, but are reported after all hosts are finished.
+
+    Parameters
+    ----------
+    script
+        The script to run.
+    selected_hosts
+        The names of the hosts in the loaded inventory.
+    workers
+        The maximum number of hosts to run concurrently.
+    """
+    failed, _ = run_pool(script, selected_hosts, workers)
+    if len(failed) > 0:
+        hosts = ", ".join(k for k in selected_hosts if k in failed)
+        die_error(f"script failed on {len(failed)} of {len(selected_hosts)} hosts: {hosts}")
+
+def run_lockstep(script: str, selected_hosts: list[str]) -> set[str]:
+    """
+    Runs the given script on all selected hosts in lockstep (see `fora.lockstep`). Each host runs
+    in a separate thread, and each top-level operation is first probed on all hosts, then applied
+    on all hosts, before any host continues with the next operation. The output of all hosts is
+    shown together for each of these steps, with each line prefixed by the name of the host.
+    Errors don't abort the other hosts.
+
+    As all hosts share the working directory of this process, it is set to the directory of the
+    given script for the whole run. Scripts executed with `fora.operations.local.script` don't change it,
+    but relative paths passed to operations are still resolved against their directory (see `fora.loader.local_path`).
+
+    Parameters
+    ----------
+    script
+        The script to run.
+    selected_hosts
+        The names of the hosts in the loaded inventory.
+
+    Returns
+    -------
+    set[str]
+        The hosts on which the script has failed.
+    """
+    script = os.path.realpath(script)
+    previous_working_directory = os.getcwd()
+    os.chdir(os.path.dirname(script))
+    try:
+        return Lockstep(selected_hosts).run(functools.partial(run_host_checked, script))
+    finally:
+        os.chdir(previous_working_directory)
+
+def parse_batch_size(batch_size: Union[int, str], count: int) -> int:
+    """
+    Calculates the number of hosts per batch from a batch size specification.
+
+    Parameters
+    ----------
+    batch_size
+        Either a number of hosts (like `2` or `"2"`), or a percentage of the given host count (like `"25%"`).
+        Percentages are rounded up, so that each batch contains at least one host.
+    count
+        The number of hosts that should be divided into batches.
+
+    Returns
+    -------
+    int
+        The number of hosts per batch.
+
+    Raises
+    ------
+    ValueError
+        The batch size is invalid.
+    """
+    try:
+        if isinstance(batch_size, str) and batch_size.endswith("%"):
+            percentage = float(batch_size[:-1])
+            if 0 < percentage <= 100:
+                return max(1, math.ceil(count * percentage / 100))
+        elif int(batch_size) > 0:
+            return int(batch_size)
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid batch size '{batch_size}' (must be a positive number of hosts or a percentage like '25%')")
+
+def plan_batches(selected_hosts: list[str], batch_size: Optional[Union[int, str]], by_group: bool) -> list[tuple[Optional[str], list[str]]]:
+    """
+    Divides the selected hosts into batches for a rolling deployment.
+
+    Parameters
+    ----------
+    selected_hosts
+        The names of the hosts in the loaded inventory.
+    batch_size
+        The size of each batch (see `parse_batch_size`). If `None`, all hosts (of a group) are put into a single batch.
+    by_group
+        Whether to first divide the hosts by group. Each host belongs to the group with the highest precedence
+        of all of its groups. The groups are ordered by the topological order of the inventory and
+        batch sizes given as a percentage refer to the number of hosts in the group.
+
+    Returns
+    -------
+    list[tuple[Optional[str], list[str]]]
+        The batches in order, each together with the group it belongs to, or `None` if `by_group` is not set.
+
+    Raises
+    ------
+    ValueError
+        The batch size is invalid.
+    """
+    parts: dict[Optional[str], list[str]] = {}
+    if by_group:
+        order = fora.inventory._topological_order # pylint: disable=protected-access
+        for k in selected_hosts:
+            host_group = max(fora.inventory.loaded_hosts[k].groups, key=order.index)
+            parts.setdefault(host_group, []).append(k)
+        parts = {g: parts[g] for g in order if g in parts}
+    else:
+        parts[None] = selected_hosts
+
+    batches: list[tuple[Optional[str], list[str]]] = []
+    for group, hosts in parts.items():
+        size = len(hosts) if batch_size is None else parse_batch_size(batch_size, len(hosts))
+        batches.extend((group, hosts[i:i + size]) for i in range(0, len(hosts), size))
+    return batches
+
+def run_rolling(script: str, batches: list[tuple[Optional[str], list[str]]], workers: int, max_fail_percentage: float, lockstep: bool = False) -> None:
+    """
+    Runs the given script on one batch of hosts after another. The hosts in a batch are run
+    in lockstep if `lockstep` is set, concurrently in worker processes if `workers` is greater
+    than one, and sequentially otherwise.
+    Once the script has failed on more than `max_fail_percentage` percent of all hosts,
+    the remaining hosts are skipped. All failures are reported at the end.
+
+    Parameters
+    ----------
+    script
+        The script to run.
+    batches
+        The batches of host names, as returned by `plan_batches`.
+    workers
+        The maximum number of hosts to run concurrently within a batch.
+    max_fail_percentage
+        The percentage of hosts that may fail before the rollout is stopped.
+    lockstep
+        Whether to run the hosts of each batch in lockstep (see `run_lockstep`).
+    """
+    all_hosts = [k for _, hosts in batches for k in hosts]
+    max_failures = math.floor(len(all_hosts) * max_fail_percentage / 100)
+    failed: set[str] = set()
+    skipped: list[str] = []
+    for i, (group, hosts) in enumerate(batches):
+        if len(failed) > max_failures:
+            skipped.extend(hosts)
+            continue
+
+        if i > 0:
+            # Separate batches by a newline for better visibility
+            print()
+        logger.batch_init(i + 1, len(batches), hosts, group)
+        if lockstep and len(hosts) > 1:
+            failed.update(run_lockstep(script, hosts))
+            continue
+        if workers > 1 and len(hosts) > 1:
+            batch_failed, batch_skipped = run_pool(script, hosts, workers, max_failures - len(failed))
+            failed.update(batch_failed)
+            skipped.extend(batch_skipped)
+            continue
+
+        for j, k in enumerate(hosts):
+            if len(failed) > max_failures:
+                skipped.extend(hosts[j:])
+                break
+            if j > 0:
+                # Separate hosts by a newline for better visibility
+                print()
+            if run_host_checked(script, k):
+                failed.add(k)
+
+    if len(failed) > 0:
+        msg = f"script failed on {len(failed)} of {len(all_hosts)} hosts: {', '.join(k for k in all_hosts if k in failed)}"
+        if len(skipped) > 0:
+            msg += f"; rollout aborted after exceeding the failure limit of {max_fail_percentage}%, skipped {len(skipped)} hosts: {', '.join(skipped)}"
+        die_error(msg)
+
 def show_inventory(inventory: str) -> None:
     """
     Display a summary of the given inventory.
@@ -226,6 +585,16 @@ def main(argv: Optional[list[str]] = None) -> None:
             help="Display all available information about a specific inventory. This includes a summary as well as the specific variables available on each group or host.")
     parser.add_argument('-H', '--hosts', dest='hosts', default=None, type=str,
             help="Specifies a comma separated list of hosts to run on. By default all hosts are selected. Duplicates will be ignored.")
+    parser.add_argument('-j', '--parallel', dest='parallel', type=int, default=1, metavar='N',
+            help="Run the script on up to N hosts at the same time, each in a separate process. The output of each host is shown as a whole once the host is finished. Errors don't abort the other hosts, but are reported after all hosts are finished. By default, hosts are run one after another.")
+    parser.add_argument('--lockstep', dest='lockstep', action='store_true',
+            help="Run the script on all selected hosts at the same time, advancing operation by operation: each operation first examines the current state on all hosts, then applies its changes on all hosts, and only then the next operation is started. The output of each step is shown for all hosts together, prefixed by the host name. Errors don't abort the other hosts, but are reported after all hosts are finished. When combined with --batch-size, each batch is run in lockstep.")
+    parser.add_argument('--batch-size', dest='batch_size', type=str, default=None, metavar='N|X%',
+            help="Roll the script out in batches of N hosts, or X percent of the hosts, at a time. Each batch is finished before the next one is started. The hosts within a batch are run sequentially, or concurrently with -j. Defaults to the `batch_size` of the inventory, which runs all hosts in a single batch unless set.")
+    parser.add_argument('--max-fail-percentage', dest='max_fail_percentage', type=float, default=None, metavar='P',
+            help="When rolling out in batches, stop starting new hosts once the script has failed on more than P percent of the selected hosts. Defaults to the `max_fail_percentage` of the inventory, which is 0 unless set, so that the rollout stops after the first failure.")
+    parser.add_argument('--batch-by-group', dest='batch_by_group', action=argparse.BooleanOptionalAction, default=None,
+            help="Roll the script out in batches that each contain hosts of a single group, ordered by the topological order of the groups. Each host belongs to the group with the highest precedence of all of its groups. Can be combined with --batch-size to split groups further. Defaults to the `batch_by_group` of the inventory.")
     parser.add_argument('--dry', '--dry-run', '--pretend', dest='dry', action='store_true',
             help="Print what would be done instead of performing any actions. Probing commands will still be executed to determine the current state of the systems.")
     parser.add_argument('-v', '--verbose', dest='verbose', action='count', default=0,
@@ -234,6 +603,16 @@ def main(argv: Optional[list[str]] = None) -> None:
             help="Don't display changes for each operation in a short diff-like format.")
     parser.add_argument('--diff', dest='diff', action='store_true',
             help="Display an actual diff when an operation changes a file. Use with care, as this might print secrets!")
+    parser.add_argument('--compression', dest='compression', default="none", choices=["none", "zlib", "lzma"],
+            help="Compress large packets sent to and from the remote hosts with the given algorithm. Useful on slow links, but costs cpu time on both sides. Falls back to zlib if lzma is not available on a remote host.")
+    parser.add_argument('--digest-cache', dest='digest_cache', action='store_true',
+            help="Remember the sha512sums of remote files in a cache file in the home directory of the remote user (~/.cache/fora/digests), so that unchanged files don't have to be read again to check whether they are up to date.")
+    parser.add_argument('--blob-store-size', dest='blob_store_size', type=int, default=0, metavar='MIB',
+            help="Keep a copy of uploaded files in a content-addressed store of the given size (in MiB) in the home directory of the remote user (~/.cache/fora/blobs), so that the same content never needs to be transferred twice, e.g. when rolling back. The least recently used files are evicted first. Disabled by default.")
+    parser.add_argument('--no-dispatcher-cache', dest='dispatcher_cache', action='store_false',
+            help="Pass the tunnel dispatcher inline in the ssh command on every connection instead of starting a cached copy from the home directory of the remote user (~/.cache/fora), which is only transferred when it is missing or outdated.")
+    parser.add_argument('--remote-daemon', dest='remote_daemon', type=int, default=0, metavar='SECONDS',
+            help="Keep the remote dispatcher running in the background for the given idle time after a run, so that later runs attach to it and reuse its caches instead of starting a new interpreter. Intended for frequent small deploys. The daemon listens on a private per-user socket (in $XDG_RUNTIME_DIR or the temporary directory). Disabled by default.")
     parser.add_argument('--debug', dest='debug', action='store_true',
             help="Enable debugging output. Forces verbosity to max value.")
     parser.add_argument('--no-color', dest='no_color', action='store_true',
@@ -1,5 +1,6 @@
 """Provides API to define operations."""
 
+from contextvars import ContextVar
 from dataclasses import dataclass
 import subprocess
 import sys
@@ -9,7 +10,7 @@ from typing import Callable, TypeVar, cast, Any, Optional
 from types import TracebackType, FrameType
 
 import fora
-from fora import logger
+from fora import lockstep, logger
 from fora.types import RemoteDefaultsContext
 from fora.utils import check_host_active, print_process_error
 
@@ -44,6 +45,31 @@ class Operation:
         self.initial_state_dict: Optional[dict[str, Any]] = None
         self.final_state_dict: Optional[dict[str, Any]] = None
         self.diffs: list[tuple[str, Optional[bytes], Optional[bytes]]] = []
+        self.synchronized = False
+        self.probed = False
+
+    def synchronize(self, synchronized: bool) -> None:
+        """
+        Sets whether this operation is synchronized with the other hosts, when the script runs in
+        lockstep on multiple hosts (see `fora.lockstep`). This is the case for all top-level operations.
+        A synchronized operation waits for the other hosts once after the current state was probed
+        (which is when both the initial and final state are known), and once when it is finished.
+
+        Parameters
+        ----------
+        synchronized
+            Whether the operation is synchronized.
+        """
+        self.synchronized = synchronized
+
+    def probe_finished(self) -> None:
+        """
+        Signals that the current state was probed, and waits for the other hosts
+        to do the same if this operation is synchronized. Only the first call has an effect.
+        """
+        if self.synchronized and not self.probed:
+            self.probed = True
+            lockstep.sync()
 
     def nested(self, has_nested: bool) -> None:
         """
@@ -108,6 +134,8 @@ class Operation:
         if self.initial_state_dict is not None:
             raise OperationError("An operation's 'initial_state' can only be set once.")
         self.initial_state_dict = dict(kwargs)
+        if self.final_state_dict is not None:
+            self.probe_finished()
 
     def final_state(self, **kwargs: Any) -> None:
         """Sets the final state."""
@@ -116,6 +144,8 @@ class Operation:
         if self.final_state_dict is not None:
             raise OperationError("An operation's 'final_state' can only be set once.")
         self.final_state_dict = dict(kwargs)
+        if self.initial_state_dict is not None:
+            self.probe_finished()
 
     def unchanged(self, ignore_none: bool = False) -> bool:
         """
@@ -220,6 +250,9 @@ class Operation:
             logger.print_operation(self, result)
         return result
 
+_operation_depth: ContextVar[int] = ContextVar("operation_depth", default=0)
+"""The number of operations that are currently being executed in this context, including nested operations."""
+
 _TFunc = TypeVar("_TFunc", bound=Callable[..., Any])
 # This is untyped as the language server can then apparently
 # complete the wrapped function correctly, and ParamSpec
@@ -255,8 +288,10 @@ def operation(op_name: str): # type: ignore[no-untyped-def]
             check_host_active()
 
             op = Operation(op_name=op_name, name=kwargs.get("name", None))
+            op.synchronize(_operation_depth.get() == 0)
             check = kwargs.get("check", True)
 
+            depth_token = _operation_depth.set(_operation_depth.get() + 1)
             try:
                 ret = function(*args, **kwargs, op=op)
             except OperationError as e:
@@ -277,6 +312,11 @@ def operation(op_name: str): # type: ignore[no-untyped-def]
             except Exception as e:
                 ret = op.failure(str(e))
                 raise
+            finally:
+                _operation_depth.reset(depth_token)
+                if op.synchronized:
+                    op.probe_finished()
+                    lockstep.sync()
 
             if ret is None:
                 raise OperationError("The operation failed to return a status. THIS IS A BUG! Please report it to the package maintainer of the package which the operation belongs to.")
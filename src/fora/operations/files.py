@@ -1,6 +1,8 @@
 """Provides operations related to creating and modifying files and directories."""
 
+import hashlib
 import os
+import pathlib
 import re
 from datetime import datetime, timezone
 from os.path import join, relpath, normpath
@@ -11,6 +13,7 @@ from jinja2.exceptions import UndefinedError
 
 import fora
 from fora import logger
+from fora.loader import local_path
 from fora.operations.api import Operation, OperationResult, operation
 from fora.operations.utils import check_absolute_path, save_content
 
@@ -120,26 +123,27 @@ def directory(path: str,
 
         # Apply actions to reach desired state, but only if we are not doing a dry run
         if not fora.args.dry:
-            if present:
-                # Create directory if it doesn't exist
-                if op.changed("exists"):
-                    conn.run(["mkdir", "--", path])
-
-                # Set correct mode, if needed
-                if op.changed("mode"):
-                    conn.run(["chmod", attr.dir_mode, "--", path])
-
-                # Set correct owner and group, if needed
-                if op.changed("owner") or op.changed("group"):
-                    conn.run(["chown", f"{attr.owner}:{attr.group}", "--", path])
-
-                # Touch directory if requested
-                if not op.changed("exists") and op.changed("touched"):
-                    conn.run(["touch", "--", path])
-            else:
-                # Remove directory if it should not be present
-                if op.changed("exists"):
-                    conn.run(["rm", "-rf", "--", path])
+            with conn.pipeline():
+                if present:
+                    # Create directory if it doesn't exist
+                    if op.changed("exists"):
+                        conn.run(["mkdir", "--", path])
+
+                    # Set correct mode, if needed
+                    if op.changed("mode"):
+                        conn.run(["chmod", attr.dir_mode, "--", path])
+
+                    # Set correct owner and group, if needed
+                    if op.changed("owner") or op.changed("group"):
+                        conn.run(["chown", f"{attr.owner}:{attr.group}", "--", path])
+
+                    # Touch directory if requested
+                    if not op.changed("exists") and op.changed("touched"):
+                        conn.run(["touch", "--", path])
+                else:
+                    # Remove directory if it should not be present
+                    if op.changed("exists"):
+                        conn.run(["rm", "-rf", "--", path])
 
         return op.success()
 
@@ -209,23 +213,24 @@ def file(path: str,
 
         # Apply actions to reach desired state, but only if we are not doing a dry run
         if not fora.args.dry:
-            if present:
-                # Create file if it doesn't exist
-                # or touch file if requested
-                if op.changed("exists") or op.changed("touched"):
-                    conn.run(["touch", "--", path])
-
-                # Set correct mode, if needed
-                if op.changed("mode"):
-                    conn.run(["chmod", attr.file_mode, "--", path])
-
-                # Set correct owner and group, if needed
-                if op.changed("owner") or op.changed("group"):
-                    conn.run(["chown", f"{attr.owner}:{attr.group}", "--", path])
-            else:
-                # Remove file if it should not be present
-                if op.changed("exists"):
-                    conn.run(["rm", "--", path])
+            with conn.pipeline():
+                if present:
+                    # Create file if it doesn't exist
+                    # or touch file if requested
+                    if op.changed("exists") or op.changed("touched"):
+                        conn.run(["touch", "--", path])
+
+                    # Set correct mode, if needed
+                    if op.changed("mode"):
+                        conn.run(["chmod", attr.file_mode, "--", path])
+
+                    # Set correct owner and group, if needed
+                    if op.changed("owner") or op.changed("group"):
+                        conn.run(["chown", f"{attr.owner}:{attr.group}", "--", path])
+                else:
+                    # Remove file if it should not be present
+                    if op.changed("exists"):
+                        conn.run(["rm", "--", path])
 
         return op.success()
 
@@ -299,22 +304,23 @@ def link(path: str,
 
         # Apply actions to reach desired state, but only if we are not doing a dry run
         if not fora.args.dry:
-            if present:
-                # Create link if it doesn't exist
-                if op.changed("target"):
-                    conn.run(["ln", "-sf", "--", target, path])
-
-                # Set correct owner and group, if needed
-                if op.changed("owner") or op.changed("group"):
-                    conn.run(["chown", "--no-dereference", f"{attr.owner}:{attr.group}", "--", path])
-
-                # Touch link if requested
-                if not op.changed("exists") and op.changed("touched"):
-                    conn.run(["touch", "--no-dereference", "--", path])
-            else:
-                # Remove file if it should not be present
-                if op.changed("exists"):
-                    conn.run(["rm", "--", path])
+            with conn.pipeline():
+                if present:
+                    # Create link if it doesn't exist
+                    if op.changed("target"):
+                        conn.run(["ln", "-sf", "--", target, path])
+
+                    # Set correct owner and group, if needed
+                    if op.changed("owner") or op.changed("group"):
+                        conn.run(["chown", "--no-dereference", f"{attr.owner}:{attr.group}", "--", path])
+
+                    # Touch link if requested
+                    if not op.changed("exists") and op.changed("touched"):
+                        conn.run(["touch", "--no-dereference", "--", path])
+                else:
+                    # Remove file if it should not be present
+                    if op.changed("exists"):
+                        conn.run(["rm", "--", path])
 
         return op.success()
 
@@ -394,8 +400,7 @@ def upload(src: str,
     if dest.endswith("/"):
         dest = os.path.join(dest, os.path.basename(src))
     op.desc(dest)
-    with open(src, 'rb') as f:
-        return save_content(op, f.read(), dest, mode, owner, group)
+    return save_content(op, pathlib.Path(local_path(src)), dest, mode, owner, group)
 
 @operation("upload_dir")
 def upload_dir(src: str,
@@ -462,7 +467,7 @@ def upload_dir(src: str,
     op.nested(True)
 
     check_absolute_path(dest, f"{dest=}")
-    if not os.path.isdir(src):
+    if not os.path.isdir(local_path(src)):
         raise ValueError(f"{src=} must be a directory")
 
     # If the destination denotes a directory, the actual directory is a
@@ -476,23 +481,92 @@ def upload_dir(src: str,
         # together with their source counterpart
         dirs: list[str] = [dest]
         files: list[tuple[str, str]] = []
-        for root, subdirs, subfiles in os.walk(src):
-            root = relpath(root, start=src)
-            sroot = normpath(join(src, root))
+        local_src = local_path(src)
+        for root, subdirs, subfiles in os.walk(local_src):
+            root = relpath(root, start=local_src)
+            sroot = normpath(join(local_src, root))
             droot = normpath(join(dest, root))
             for d in subdirs:
                 dirs.append(join(droot, d))
             for f in subfiles:
                 files.append((join(sroot, f), join(droot, f)))
 
-        for d in dirs:
-            op.add_nested_result(d, directory(path=d, mode=dir_mode, owner=owner, group=group))
-        for sf,df in files:
-            if os.path.isfile(sf):
+        files = [(sf, df) for sf, df in files if os.path.isfile(sf)]
+
+        # Query the state of all destinations upfront, instead of one round trip per entry
+        conn = fora.host.connection
+        with conn.prefetch_stat(dirs), conn.prefetch_stat([df for _, df in files], sha512sum=True):
+            for d in dirs:
+                op.add_nested_result(d, directory(path=d, mode=dir_mode, owner=owner, group=group))
+            for sf,df in files:
                 op.add_nested_result(df, upload(src=sf, dest=df, mode=file_mode, owner=owner, group=group))
 
     return op.success()
 
+@operation("fetch")
+def fetch(src: str,
+          dest: str,
+          name: Optional[str] = None,
+          check: bool = True,
+          op: Operation = Operation.internal_use_only) -> OperationResult:
+    """
+    Downloads the given file from the remote host and saves it locally. The file is transferred
+    in chunks, so arbitrarily large files can be fetched with bounded memory usage. The local file
+    is only replaced after the download has completed, and only if its content differs.
+    When running against multiple hosts, make sure to use a distinct destination for each host,
+    for example by including `fora.host.name` in the path.
+
+    Parameters
+    ----------
+    src
+        The remote file to download.
+    dest
+        The local destination path. If this ends in a slash, the basename of the source file is automatically appended.
+    name
+        The name for the operation.
+    check
+        If True, returning `op.failure()` will raise an OperationError. All manually raised
+        OperationErrors will be propagated. When False, any manually raised OperationError will
+        be caught and `op.failure()` will be returned with the given message while continuing execution.
+    op
+        The operation wrapper. Must not be supplied by the user.
+    """
+    _ = (name, check) # Processed automatically.
+    check_absolute_path(src, f"{src=}")
+    if dest.endswith("/"):
+        dest = os.path.join(dest, os.path.basename(src))
+    op.desc(f"{src} -> {dest}")
+
+    conn = fora.host.connection
+    stat = conn.stat(src, follow_links=True, sha512sum=True)
+    if stat is None:
+        return op.failure(f"path '{src}' doesn't exist")
+    if stat.type != "file":
+        return op.failure(f"path '{src}' exists but is not a file!")
+    op.final_state(exists=True, sha512=stat.sha512sum)
+
+    # Examine current local state
+    local_dest = local_path(dest)
+    if os.path.isfile(local_dest):
+        sha512 = hashlib.sha512()
+        with open(local_dest, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha512.update(chunk)
+        op.initial_state(exists=True, sha512=sha512.digest())
+    else:
+        op.initial_state(exists=False, sha512=None)
+
+    # Return success if nothing needs to be changed
+    if op.unchanged():
+        return op.success()
+
+    # Download the file, but only if we are not doing a dry run
+    if not fora.args.dry:
+        os.makedirs(os.path.dirname(os.path.abspath(local_dest)), exist_ok=True)
+        conn.download_to(src, local_dest)
+
+    return op.success()
+
 @operation("template_content")
 def template_content(content: str,
                      dest: str,
@@ -591,7 +665,7 @@ def template(src: str,
         dest = os.path.join(dest, os.path.basename(src))
     op.desc(dest)
 
-    with open(src, "r", encoding="utf-8") as f:
+    with open(local_path(src), "r", encoding="utf-8") as f:
         content = f.read()
 
     try:
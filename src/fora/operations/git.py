@@ -62,13 +62,12 @@ def repo(url: str,
 
     conn = fora.host.connection
 
-    stat_path = conn.stat(path)
+    stat_path, stat_git = conn.stat_many([path, os.path.join(path, ".git")])
     if stat_path is None:
         op.initial_state(initialized=False, commit=None)
         cur_commit = None
     elif stat_path.type == "dir":
         # Assert that it is a git directory
-        stat_git = conn.stat(os.path.join(path, ".git"))
         if stat_git is None:
             return op.failure(f"directory '{path}' already exists but is not a git repository")
 
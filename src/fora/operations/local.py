@@ -4,7 +4,7 @@ import inspect
 import os
 from typing import Any, Optional
 
-from fora.loader import script_stack, run_script
+from fora.loader import local_path, script_stack, run_script
 from fora.utils import check_host_active
 
 def script(script: str, # pylint: disable=redefined-outer-name
@@ -33,7 +33,7 @@ def script(script: str, # pylint: disable=redefined-outer-name
     Parameters
     ----------
     script
-        The local path to the script to execute.
+        The local path to the script to execute, relative to the directory of the calling script.
     recursive
         Whether recursive calls should be allowed.
     params
@@ -47,7 +47,7 @@ def script(script: str, # pylint: disable=redefined-outer-name
     if not recursive:
         for wrapper, _ in script_stack:
             # pylint: disable=protected-access
-            if os.path.samefile(script, wrapper.definition_file()):
+            if os.path.samefile(local_path(script), wrapper.definition_file()):
                 raise ValueError(f"Invalid recursive call to script '{script}'. Use recursive=True to allow this.")
 
     outer_frame = inspect.getouterframes(inspect.currentframe())[1]
@@ -3,7 +3,8 @@ Provides utiliy functions for operations.
 """
 
 import hashlib
-from typing import Any, Callable, Optional, Union
+import os
+from typing import Any, BinaryIO, Callable, Optional, Union
 from fora.connection import Connection
 import fora
 
@@ -105,7 +106,7 @@ def generic_package(op: Operation,
     return op.success()
 
 def save_content(op: Operation,
-                 content: Union[bytes, str],
+                 content: Union[bytes, str, os.PathLike, BinaryIO],
                  dest: str,
                  mode: Optional[str] = None,
                  owner: Optional[str] = None,
@@ -119,7 +120,10 @@ def save_content(op: Operation,
     op
         The operation wrapper.
     content
-        The file content.
+        The file content. A binary file object will be read in chunks, so the content never needs to be
+        held in memory at once (unless a diff is requested). It must be seekable. A path-like object
+        denotes a local file, which is read in chunks just like a file object, but may also be copied
+        directly by connectors that share the local filesystem (see `fora.connection.Connection.upload`).
     dest
         The remote destination path.
     mode
@@ -129,12 +133,28 @@ def save_content(op: Operation,
     group
         The file group. Uses the remote execution defaults if None.
     """
+    # pylint: disable=too-many-branches,too-many-statements
     if isinstance(content, str):
         content = content.encode('utf-8')
 
     conn = fora.host.connection
     with op.defaults(file_mode=mode, owner=owner, group=group) as attr:
-        final_sha512sum = hashlib.sha512(content).digest()
+        if isinstance(content, bytes):
+            final_sha512sum = hashlib.sha512(content).digest()
+        elif isinstance(content, os.PathLike):
+            sha512 = hashlib.sha512()
+            with open(content, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha512.update(chunk)
+            final_sha512sum = sha512.digest()
+        else:
+            stream: BinaryIO = content
+            start = stream.tell()
+            sha512 = hashlib.sha512()
+            for chunk in iter(lambda: stream.read(1 << 20), b""):
+                sha512.update(chunk)
+            stream.seek(start)
+            final_sha512sum = sha512.digest()
         op.final_state(exists=True, mode=attr.file_mode, owner=attr.owner, group=attr.group, sha512=final_sha512sum)
 
         # Examine current state
@@ -155,26 +175,57 @@ def save_content(op: Operation,
 
         # Add diff if desired
         if fora.args.diff:
-            op.diff(dest, conn.download_or(dest), content)
+            if isinstance(content, bytes):
+                op.diff(dest, conn.download_or(dest), content)
+            elif isinstance(content, os.PathLike):
+                with open(content, 'rb') as f:
+                    op.diff(dest, conn.download_or(dest), f.read())
+            else:
+                op.diff(dest, conn.download_or(dest), content.read())
+                content.seek(start)
 
         # Apply actions to reach desired state, but only if we are not doing a dry run
         if not fora.args.dry:
-            # Create directory if it doesn't exist
-            if op.changed("exists") or op.changed("sha512"):
-                conn.upload(
-                        file=dest,
-                        content=content,
-                        mode=attr.file_mode,
-                        owner=attr.owner,
-                        group=attr.group)
-            else:
-                # Set correct mode, if needed
-                if op.changed("mode"):
-                    conn.run(["chmod", attr.file_mode, "--", dest])
+            upload = op.changed("exists") or op.changed("sha512")
+            # Content that the remote host has seen before doesn't need to be transferred again
+            if upload and conn.query_blobs([final_sha512sum])[0]:
+                try:
+                    conn.place_blob(
+                            file=dest,
+                            sha512sum=final_sha512sum,
+                            mode=attr.file_mode,
+                            owner=attr.owner,
+                            group=attr.group)
+                    return op.success()
+                except ValueError:
+                    # The blob may have been evicted since it was queried, so the content is uploaded instead.
+                    # Any other invalid value will be reported by the upload again.
+                    pass
+
+            with conn.pipeline():
+                if upload and stat is not None:
+                    # Only send the changed parts of large files
+                    conn.upload_delta(
+                            file=dest,
+                            content=content,
+                            mode=attr.file_mode,
+                            owner=attr.owner,
+                            group=attr.group)
+                elif upload:
+                    conn.upload(
+                            file=dest,
+                            content=content,
+                            mode=attr.file_mode,
+                            owner=attr.owner,
+                            group=attr.group)
+                else:
+                    # Set correct mode, if needed
+                    if op.changed("mode"):
+                        conn.run(["chmod", attr.file_mode, "--", dest])
 
-                # Set correct owner and group, if needed
-                if op.changed("owner") or op.changed("group"):
-                    conn.run(["chown", f"{attr.owner}:{attr.group}", "--", dest])
+                    # Set correct owner and group, if needed
+                    if op.changed("owner") or op.changed("group"):
+                        conn.run(["chown", f"{attr.owner}:{attr.group}", "--", dest])
 
         return op.success()
 
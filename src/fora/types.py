@@ -17,6 +17,7 @@ from types import ModuleType, TracebackType
 from typing import TYPE_CHECKING, Any, Callable, Literal, Optional, Type, TypeVar, cast
 
 from fora.remote_settings import RemoteSettings, ResolvedRemoteSettings
+from fora.utils import ContextStack
 
 if TYPE_CHECKING:
     from fora.connection import Connection
@@ -25,6 +26,14 @@ if TYPE_CHECKING:
 
 T = TypeVar('T')
 
+_defaults_stack: ContextStack[tuple[ScriptWrapper, RemoteSettings]] = ContextStack("defaults_stack")
+"""
+The stack of remote execution defaults of all scripts that are executed in the current context,
+each together with the script it belongs to. Local to the current context (see `fora.utils.ContextStack`),
+so that concurrent executions don't see each other's defaults. The stack must only be changed by using
+the context manager returned in `fora.script.defaults`.
+"""
+
 class RemoteDefaultsContext:
     """A context manager to overlay remote defaults on a stack of defaults."""
     def __init__(self, obj: ScriptWrapper, new_defaults: RemoteSettings):
@@ -35,12 +44,12 @@ class RemoteDefaultsContext:
         # pylint: disable=import-outside-toplevel,cyclic-import
         import fora
         self.new_defaults = fora.host.connection.resolve_defaults(self.new_defaults)
-        self.obj._defaults_stack.append(self.new_defaults)
+        _defaults_stack.append((self.obj, self.new_defaults))
         return cast(ResolvedRemoteSettings, fora.host.connection.base_settings.overlay(self.new_defaults))
 
     def __exit__(self, exc_type: Optional[Type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
         _ = (exc_type, exc, traceback)
-        self.obj._defaults_stack.pop()
+        _defaults_stack.pop()
 
 @dataclass
 class VariableActionSnapshot:
@@ -240,6 +249,17 @@ class HostWrapper(ModuleWrapper):
     connector: Optional[Callable[[Optional[str], HostWrapper], Connector]] = None
     """The connector class to use. If `None`, the connector will be determined by the schema in the `url` when needed."""
 
+    ssh_control_persist: Optional[int] = 600
+    """
+    The time in seconds for which a shared ssh master connection to this host is kept alive
+    after its last connection was closed, so that it can be reused by later connections and
+    later invocations of fora. 0 shares the master only while the connection that started it
+    is open. `None` disables connection sharing.
+    """
+
+    ssh_control_dir: Optional[str] = None
+    """The private directory for the control sockets of shared ssh connections. `None` uses `fora-ssh-<uid>` in `$XDG_RUNTIME_DIR` or the temporary directory."""
+
     # Cast to ease typechecking in user code.
     connection: Connection = cast("Connection", None)
     """The active connection to this host, if one is opened."""
@@ -367,12 +387,6 @@ class ScriptWrapper(ModuleWrapper):
     name: str
     """The name of the script. Must not be changed."""
 
-    _defaults_stack: list[RemoteSettings] = field(default_factory=lambda: [RemoteSettings()])
-    """
-    The stack of remote execution defaults. The stack must only be changed by using
-    the context manager returned in `fora.script.defaults`.
-    """
-
     def defaults(self,
                  as_user: Optional[str] = None,
                  as_group: Optional[str] = None,
@@ -431,7 +445,10 @@ class ScriptWrapper(ModuleWrapper):
         RemoteSettings
             The currently active remote defaults.
         """
-        return self._defaults_stack[-1]
+        for wrapper, defaults in reversed(_defaults_stack.copy()):
+            if wrapper is self:
+                return defaults
+        return RemoteSettings()
 
     def Params(self, params_cls: Type[T]) -> Type[T]:
         """
@@ -13,10 +13,12 @@ import pkgutil
 import shutil
 import subprocess
 import sys
+import threading
 import traceback
 import uuid
+from contextvars import ContextVar
 from types import ModuleType, TracebackType
-from typing import Any, Collection, NoReturn, Type, TypeVar, Callable, Iterable, Optional, Union
+from typing import Any, Collection, Generic, Iterator, NoReturn, Type, TypeVar, Callable, Iterable, Optional, Union
 
 import fora
 from fora.logger import col
@@ -29,6 +31,69 @@ class FatalError(Exception):
 
 T = TypeVar('T')
 
+def is_main_context() -> bool:
+    """
+    Returns whether the current context is the one of the main thread, outside of any asyncio task.
+    Context-local state that is set in this context is also the process-wide fallback for contexts
+    in which it was never set (see `ContextStack`).
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return False
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is None:
+        return True
+    try:
+        return asyncio.current_task() is None
+    except RuntimeError:
+        # No event loop is running
+        return True
+
+class ContextStack(Generic[T]):
+    """
+    A stack that is local to the current context (see `contextvars`), so that concurrent threads
+    and asyncio tasks each see only their own entries. A copied context (e.g. of a new asyncio task,
+    or of a thread started with `contextvars.copy_context().run`) starts with the entries of the
+    original context. Contexts in which the stack was never changed, such as the initially empty
+    context of a plain new thread, see the entries of the main context (see `is_main_context`),
+    just like a plain list. Changes in other contexts are never visible outside of them.
+    Like a `ContextVar`, a stack must only be created at module level.
+    """
+
+    def __init__(self, name: str, initial: tuple[T, ...] = ()):
+        self.var: ContextVar[tuple[T, ...]] = ContextVar(name)
+        self.main_entries = initial
+
+    def _entries(self) -> tuple[T, ...]:
+        return self.var.get(self.main_entries)
+
+    def _set(self, entries: tuple[T, ...]) -> None:
+        self.var.set(entries)
+        if is_main_context():
+            self.main_entries = entries
+
+    def append(self, entry: T) -> None:
+        """Pushes the given entry."""
+        self._set(self._entries() + (entry,))
+
+    def pop(self) -> T:
+        """Removes and returns the topmost entry."""
+        entries = self._entries()
+        self._set(entries[:-1])
+        return entries[-1]
+
+    def copy(self) -> list[T]:
+        """Returns the current entries as a list, starting with the bottommost one."""
+        return list(self._entries())
+
+    def __getitem__(self, index: int) -> T:
+        return self._entries()[index]
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self._entries())
+
+    def __len__(self) -> int:
+        return len(self._entries())
+
 # A set of all modules names that are dynamically loaded modules.
 # These are guaranteed to be unique across all possible modules,
 # as a random uuid will be generated at load-time for each module.
@@ -0,0 +1,19 @@
+import pytest
+
+import fora
+
+@pytest.fixture
+def deploy(request, tmp_path, monkeypatch):
+    """
+    Writes the INVENTORY and DEPLOY of the requesting test module as inventory.py and deploy.py
+    to a temporary directory and changes into it. The scripts can write to the directory in the
+    FORA_TEST_DIR environment variable, which is returned.
+    """
+    (tmp_path / "inventory.py").write_text(request.module.INVENTORY)
+    (tmp_path / "deploy.py").write_text(request.module.DEPLOY)
+    (tmp_path / "out").mkdir()
+    monkeypatch.setenv("FORA_TEST_DIR", str(tmp_path / "out"))
+    monkeypatch.chdir(tmp_path)
+    old_args, old_host = fora.args, fora.host
+    yield tmp_path / "out"
+    fora.args, fora.host = old_args, old_host
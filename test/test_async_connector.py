@@ -0,0 +1,152 @@
+import asyncio
+import io
+import os
+import subprocess
+import time
+from types import SimpleNamespace
+from typing import Any, cast
+
+import pytest
+
+import fora
+import fora.connectors.tunnel_dispatcher as td
+import fora.loader
+from fora.connection import AsyncConnection
+from fora.connectors.async_tunnel_connector import AsyncTunnelConnector, FrameDecoder
+from fora.connectors.local import LocalConnector
+from test_ssh_bootstrap import LocalBootstrapConnector
+
+@pytest.fixture(autouse=True)
+def args():
+    old_args = fora.args
+    fora.args = SimpleNamespace(debug=False, dispatcher_cache=True)
+    yield
+    fora.args = old_args
+
+def local_connector() -> AsyncTunnelConnector:
+    return AsyncTunnelConnector(LocalConnector(None, cast(Any, SimpleNamespace(name="localhost", url="local:localhost"))))
+
+def test_frame_decoder():
+    packets = [td.PacketOk(), td.PacketDownloadResult(content=os.urandom(5000)), td.PacketResolveResult(value="root")]
+    out = io.BytesIO()
+    conn = td.Connection(io.BytesIO(), out)
+    for i, packet in enumerate(packets):
+        conn.for_request(td.u32(1), td.u32(i)).write_packet(packet)
+    # Compressed packets are decoded as well
+    conn.compressor.algorithm = "zlib"
+    conn.for_request(td.u32(2), td.u32(3)).write_packet(td.PacketDownloadResult(content=b"a" * 10000))
+    packets.append(td.PacketDownloadResult(content=b"a" * 10000))
+
+    data = out.getvalue()
+    for chunk_size in [1, 7, 4096, len(data)]:
+        decoder = FrameDecoder()
+        frames = []
+        for i in range(0, len(data), chunk_size):
+            frames.extend(decoder.feed(data[i:i + chunk_size]))
+        assert [packet for _, _, packet in frames] == packets
+        assert [request_id for _, request_id, _ in frames] == [0, 1, 2, 3]
+        assert len(decoder.data) == 0
+
+def test_requests(tmp_path):
+    async def run() -> None:
+        async with local_connector() as conn:
+            result = await conn.run(["cat"], input=b"hello")
+            assert result.stdout == b"hello"
+            with pytest.raises(subprocess.CalledProcessError):
+                await conn.run(["false"])
+            assert (await conn.run(["false"], check=False)).returncode == 1
+
+            assert await conn.stat(str(tmp_path / "missing")) is None
+            stat = await conn.stat(str(tmp_path))
+            assert stat is not None and stat.type == "dir"
+            assert await conn.getenv("FORA_TEST_UNSET") is None
+            assert (await conn.query_user("root")).uid == 0
+            assert (await conn.query_group("root")).gid == 0
+            assert await conn.resolve_user("root") == "root"
+
+            # Large content is uploaded in chunks
+            conn.connector.chunk_size = 4096
+            content = os.urandom(100000)
+            await conn.upload(str(tmp_path / "large"), content, mode="640")
+            assert (tmp_path / "large").read_bytes() == content
+            assert await conn.download(str(tmp_path / "large")) == content
+            await conn.upload(str(tmp_path / "small"), b"small")
+            assert (tmp_path / "small").read_bytes() == b"small"
+    asyncio.run(run())
+
+def test_concurrent_requests():
+    async def run() -> list[bytes]:
+        async with local_connector() as conn:
+            results = await asyncio.gather(*(conn.run(["sh", "-c", f"sleep 0.5; echo {i}"]) for i in range(8)))
+            return [r.stdout for r in results]
+
+    start = time.monotonic()
+    assert asyncio.run(run()) == [f"{i}\n".encode() for i in range(8)]
+    # The requests are handled concurrently by the dispatcher
+    assert time.monotonic() - start < 3
+
+def test_many_connectors():
+    async def session(conn: AsyncTunnelConnector) -> int:
+        async with conn:
+            result = await conn.run(["sh", "-c", "echo $PPID"])
+            return int(result.stdout)
+
+    async def run() -> list[int]:
+        return await asyncio.gather(*(session(local_connector()) for _ in range(10)))
+
+    # Every connector has its own dispatcher
+    assert len(set(asyncio.run(run()))) == 10
+
+def test_bootstrap(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    async def run() -> None:
+        connector = LocalBootstrapConnector("ssh://localhost", cast(Any, SimpleNamespace(name="localhost", url="ssh://localhost")))
+        async with AsyncTunnelConnector(connector) as conn:
+            assert (await conn.query_user("root")).uid == 0
+    # Uploads the dispatcher first, then uses the cached copy
+    asyncio.run(run())
+    asyncio.run(run())
+    assert any((tmp_path / "fora").iterdir())
+
+def test_connection_lost():
+    async def run() -> None:
+        conn = local_connector()
+        await conn.open()
+        try:
+            request = asyncio.create_task(conn.run(["sleep", "10"]))
+            await asyncio.sleep(0.2)
+            cast(asyncio.subprocess.Process, conn.process).kill()
+            with pytest.raises(IOError):
+                await request
+            with pytest.raises(IOError):
+                await conn.run(["true"])
+        finally:
+            await conn.close()
+    asyncio.run(run())
+
+def test_async_connection(tmp_path):
+    fora.loader.load_inventory("local:")
+    host = fora.inventory.loaded_hosts["localhost"]
+    async def run() -> None:
+        async with AsyncConnection(host) as conn:
+            # Without a running script, the base settings of the inventory are used
+            assert conn.base_settings.as_user == "root"
+            result = await conn.run(["sh", "-c", "pwd; umask"], cwd=str(tmp_path))
+            assert result.stdout == f"{tmp_path}\n0077\n".encode()
+            await conn.upload(str(tmp_path / "file"), b"content")
+            assert await conn.download(str(tmp_path / "file")) == b"content"
+            assert await conn.download_or(str(tmp_path / "missing")) is None
+            assert await conn.query_user("missing-user") is None
+            assert await conn.getenv("FORA_TEST_UNSET", "default") == "default"
+            assert await conn.home_dir() == "/root"
+    old_script = fora.script
+    fora.script = None
+    try:
+        asyncio.run(run())
+    finally:
+        fora.script = old_script
+
+def test_async_connection_inproc():
+    fora.loader.load_inventory("inproc:")
+    with pytest.raises(ValueError, match="cannot be used asynchronously"):
+        AsyncConnection(fora.inventory.loaded_hosts["localhost"])
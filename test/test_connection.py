@@ -1,15 +1,22 @@
 import grp
 import hashlib
+import io
 import os
+import pathlib
 import pwd
 import pytest
 import subprocess
+import threading
+import time
+from types import SimpleNamespace
 from typing import cast
 
 import fora
 import fora.loader
 from fora.connection import Connection
+import fora.connectors.tunnel_dispatcher as td
 from fora.connectors.tunnel_dispatcher import RemoteOSError
+from fora.operations import files
 from fora.types import HostWrapper, ScriptWrapper
 
 host: HostWrapper = cast(HostWrapper, None)
@@ -172,10 +179,487 @@ def test_upload_owner_group():
     assert stat.sha512sum == hashlib.sha512(content).digest()
     os.remove("/tmp/__pytest_fora_upload")
 
+def test_upload_stream():
+    content = os.urandom(100000)
+    with open("/tmp/__pytest_fora_upload_src", "wb") as f:
+        f.write(content)
+
+    old_chunk_size = connection.connector.chunk_size
+    connection.connector.chunk_size = 4096
+    try:
+        for source in [pathlib.Path("/tmp/__pytest_fora_upload_src"), io.BytesIO(content), content]:
+            if os.path.exists("/tmp/__pytest_fora_upload"):
+                os.remove("/tmp/__pytest_fora_upload")
+            connection.upload("/tmp/__pytest_fora_upload", content=source, mode="640")
+            assert connection.download("/tmp/__pytest_fora_upload") == content
+            assert oct(os.stat("/tmp/__pytest_fora_upload").st_mode & 0o777) == oct(0o640)
+    finally:
+        connection.connector.chunk_size = old_chunk_size
+    os.remove("/tmp/__pytest_fora_upload_src")
+
+    # The mode of an existing file is kept
+    connection.upload("/tmp/__pytest_fora_upload", content=io.BytesIO(b"1234"))
+    assert oct(os.stat("/tmp/__pytest_fora_upload").st_mode & 0o777) == oct(0o640)
+    assert connection.download("/tmp/__pytest_fora_upload") == b"1234"
+    os.remove("/tmp/__pytest_fora_upload")
+    assert not [f for f in os.listdir("/tmp") if f.startswith(".__pytest_fora_upload")]
+
+def test_upload_hard_links():
+    with open("/tmp/__pytest_fora_upload", "wb") as f:
+        f.write(b"old")
+    os.link("/tmp/__pytest_fora_upload", "/tmp/__pytest_fora_upload_link1")
+    os.link("/tmp/__pytest_fora_upload", "/tmp/__pytest_fora_upload_link2")
+    ino = os.stat("/tmp/__pytest_fora_upload").st_ino
+    try:
+        # The file is written in-place, so all links see the new content
+        for content in [b"new", io.BytesIO(b"streamed")]:
+            connection.upload("/tmp/__pytest_fora_upload", content=content)
+            expected = content if isinstance(content, bytes) else content.getvalue()
+            for link in ["/tmp/__pytest_fora_upload_link1", "/tmp/__pytest_fora_upload_link2"]:
+                with open(link, "rb") as f:
+                    assert f.read() == expected
+        st = os.stat("/tmp/__pytest_fora_upload")
+        assert st.st_ino == ino
+        assert st.st_nlink == 3
+    finally:
+        for f in ["/tmp/__pytest_fora_upload", "/tmp/__pytest_fora_upload_link1", "/tmp/__pytest_fora_upload_link2"]:
+            os.remove(f)
+
+def test_upload_stream_invalid_owner():
+    with pytest.raises(ValueError, match=r"Invalid value.*given for field 'owner'"):
+        connection.upload("/tmp/__pytest_fora_upload", content=io.BytesIO(b"1234"), owner="_invalid_")
+    assert not os.path.exists("/tmp/__pytest_fora_upload")
+
+def test_upload_stream_digest_mismatch():
+    connector = connection.connector
+    with connector.pipeline():
+        connector._request_deferred(td.PacketUploadBegin(stream=9999, file="/tmp/__pytest_fora_upload"), lambda _: None)
+        connector._send(td.PacketUploadChunk(stream=9999, data=b"1234"), connector._channel())
+        with pytest.raises(ValueError, match=r"given for field 'sha512sum'"):
+            connector._request(td.PacketUploadEnd(stream=9999, sha512sum=hashlib.sha512(b"4321").digest()))
+    assert not os.path.exists("/tmp/__pytest_fora_upload")
+    assert not [f for f in os.listdir("/tmp") if f.startswith(".__pytest_fora_upload")]
+
+def test_upload_stream_aborted():
+    class FailingStream(io.RawIOBase):
+        def read(self, size=-1):
+            raise KeyError()
+
+    with pytest.raises(KeyError):
+        connection.upload("/tmp/__pytest_fora_upload", content=FailingStream())
+    assert connection.run(["true"]).returncode == 0
+    assert not os.path.exists("/tmp/__pytest_fora_upload")
+    assert not [f for f in os.listdir("/tmp") if f.startswith(".__pytest_fora_upload")]
+
+def test_upload_path(monkeypatch):
+    content = os.urandom(100000)
+    with open("/tmp/__pytest_fora_upload_src", "wb") as f:
+        f.write(content)
+
+    connector = connection.connector
+    assert connector.same_machine
+    with monkeypatch.context() as m:
+        # The dispatcher copies the file itself
+        m.setattr(connector, "upload_stream", None)
+        m.setattr(connector, "upload_delta", None)
+        connection.upload("/tmp/__pytest_fora_upload", content=pathlib.Path("/tmp/__pytest_fora_upload_src"), mode="640")
+        assert connection.download("/tmp/__pytest_fora_upload") == content
+        assert oct(os.stat("/tmp/__pytest_fora_upload").st_mode & 0o777) == oct(0o640)
+        connection.upload_delta("/tmp/__pytest_fora_upload", content=pathlib.Path("/tmp/__pytest_fora_upload_src"))
+        assert connection.download("/tmp/__pytest_fora_upload") == content
+
+    # A source that is not the file the client sees is rejected
+    s = os.stat("/tmp/__pytest_fora_upload_src")
+    with pytest.raises(ValueError, match=r"given for field 'source'"):
+        connector._request(td.PacketUploadPath(file="/tmp/__pytest_fora_upload", source="/tmp/__pytest_fora_upload_src",
+                                               dev=s.st_dev, ino=s.st_ino, size=s.st_size, mtime_ns=s.st_mtime_ns + 1))
+
+    # Without a shared filesystem, the content is uploaded instead
+    monkeypatch.setattr(connector, "same_machine", False)
+    os.remove("/tmp/__pytest_fora_upload")
+    connection.upload("/tmp/__pytest_fora_upload", content=pathlib.Path("/tmp/__pytest_fora_upload_src"))
+    assert connection.download("/tmp/__pytest_fora_upload") == content
+    os.remove("/tmp/__pytest_fora_upload")
+    os.remove("/tmp/__pytest_fora_upload_src")
+
+def test_upload_str():
+    # A str is the content itself, not a local path
+    connection.upload("/tmp/__pytest_fora_upload", content="hello")
+    assert connection.download("/tmp/__pytest_fora_upload") == b"hello"
+    connection.upload_delta("/tmp/__pytest_fora_upload", content="hällo")
+    assert connection.download("/tmp/__pytest_fora_upload") == "hällo".encode("utf-8")
+    os.remove("/tmp/__pytest_fora_upload")
+
 def test_stat_nonexistent():
     stat = connection.stat("/tmp/__nonexistent")
     assert stat is None
 
+def test_stat_many():
+    stats = connection.stat_many(["/tmp", "/tmp/__nonexistent", "/etc/hostname/__below_file"])
+    assert len(stats) == 3
+    assert stats[0] is not None and stats[0].type == "dir"
+    assert stats[1] is None
+    assert stats[2] is None
+    assert connection.stat_many([]) == []
+
+def test_prefetch_stat():
+    with connection.prefetch_stat(["/tmp", "/tmp/__nonexistent"]):
+        assert connection._prefetched_stats
+        assert connection.stat("/tmp/__nonexistent") is None
+        assert connection.stat("/tmp") is not None
+        assert not connection._prefetched_stats
+    assert not connection._prefetched_stats
+
+def test_resolve_many():
+    current_user = current_test_user()
+    current_group = current_test_group()
+    assert connection.resolve_user_many([None, str(os.getuid()), "__nonexistent"]) == [current_user, current_user, None]
+    assert connection.resolve_group_many([None, str(os.getgid()), "__nonexistent"]) == [current_group, current_group, None]
+
+def test_getenv_many():
+    assert connection.getenv_many(["HOME", "_nonexistent", "PATH"]) == [os.getenv("HOME"), None, os.getenv("PATH")]
+
+def test_pipeline():
+    if os.path.exists("/tmp/__pytest_fora_pipeline"):
+        os.remove("/tmp/__pytest_fora_pipeline")
+    with connection.pipeline():
+        connection.upload("/tmp/__pytest_fora_pipeline", content=b"1234", mode="600")
+        connection.run(["chmod", "644", "--", "/tmp/__pytest_fora_pipeline"])
+        ret = connection.run(["cat", "/tmp/__pytest_fora_pipeline"])
+        assert len(connection.connector.pending) == 3
+        # A read-type request completes all pending requests first
+        stat = connection.stat("/tmp/__pytest_fora_pipeline")
+        assert len(connection.connector.pending) == 0
+        assert stat is not None
+        assert stat.mode == "644"
+        assert ret.stdout == b"1234"
+        ret = connection.run(["true"])
+    assert ret.returncode == 0
+    os.remove("/tmp/__pytest_fora_pipeline")
+
+def test_pipeline_deferred_errors():
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        with connection.pipeline():
+            ret = connection.run(["false"])
+            connection.run(["_invalid_"])
+            connection.upload("/invalid", content=b"", mode="_invalid_")
+            ret2 = connection.run(["echo", "ok"])
+    assert e.value.cmd == ["false"]
+    assert ret2.stdout == b"ok\n"
+    with pytest.raises(RuntimeError, match=r"failed and has no result"):
+        ret.returncode
+    assert len(connection.connector.pending) == 0
+    assert connection.run(["true"]).returncode == 0
+
+def test_pipeline_exception_in_block():
+    with pytest.raises(KeyError):
+        with connection.pipeline():
+            connection.run(["false"])
+            raise KeyError()
+    assert len(connection.connector.pending) == 0
+    assert connection.run(["true"]).returncode == 0
+
+def test_concurrent_requests():
+    def slow_command():
+        connection.run(["sleep", "0.5"])
+
+    thread = threading.Thread(target=slow_command)
+    t0 = time.monotonic()
+    thread.start()
+    time.sleep(0.05)
+    # Requests from another thread are handled while the slow command is still running
+    assert connection.stat("/tmp") is not None
+    assert connection.getenv("HOME") == os.getenv("HOME")
+    assert time.monotonic() - t0 < 0.4
+    thread.join()
+
+def test_concurrent_commands():
+    results = {}
+    def command(i):
+        results[i] = connection.run(["sh", "-c", f"sleep 0.3; echo {i}"]).stdout
+
+    threads = [threading.Thread(target=command, args=(i,)) for i in range(4)]
+    t0 = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert time.monotonic() - t0 < 1.0
+    assert results == {i: f"{i}\n".encode() for i in range(4)}
+
+def test_download_stream():
+    content = os.urandom(100000)
+    with open("/tmp/__pytest_fora_download", "wb") as f:
+        f.write(content)
+
+    old_chunk_size = connection.connector.chunk_size
+    connection.connector.chunk_size = 4096
+    try:
+        chunks = list(connection.download_stream("/tmp/__pytest_fora_download"))
+        assert all(len(c) <= 4096 for c in chunks)
+        assert b"".join(chunks) == content
+
+        # Closing the stream early keeps the connection usable
+        stream = connection.download_stream("/tmp/__pytest_fora_download")
+        assert next(stream) == content[:4096]
+        stream.close()
+        assert connection.run(["true"]).returncode == 0
+
+        connection.download_to("/tmp/__pytest_fora_download", "/tmp/__pytest_fora_download_dest")
+        with open("/tmp/__pytest_fora_download_dest", "rb") as f:
+            assert f.read() == content
+        # A new file gets the default mode, an existing file keeps its mode
+        umask = os.umask(0o077)
+        os.umask(umask)
+        assert os.stat("/tmp/__pytest_fora_download_dest").st_mode & 0o777 == 0o666 & ~umask
+        os.chmod("/tmp/__pytest_fora_download_dest", 0o640)
+        connection.download_to("/tmp/__pytest_fora_download", "/tmp/__pytest_fora_download_dest")
+        assert os.stat("/tmp/__pytest_fora_download_dest").st_mode & 0o777 == 0o640
+        out = io.BytesIO()
+        connection.download_to("/tmp/__pytest_fora_download", out)
+        assert out.getvalue() == content
+    finally:
+        connection.connector.chunk_size = old_chunk_size
+    os.remove("/tmp/__pytest_fora_download")
+    os.remove("/tmp/__pytest_fora_download_dest")
+
+    # An exactly chunk-sized and an empty file
+    for n in [0, 4096]:
+        with open("/tmp/__pytest_fora_download", "wb") as f:
+            f.write(content[:n])
+        connection.connector.chunk_size = 4096
+        try:
+            assert b"".join(connection.download_stream("/tmp/__pytest_fora_download")) == content[:n]
+        finally:
+            connection.connector.chunk_size = old_chunk_size
+        os.remove("/tmp/__pytest_fora_download")
+
+def test_download_stream_nonexistent():
+    with pytest.raises(ValueError):
+        list(connection.download_stream("/tmp/__nonexistent"))
+    with pytest.raises(ValueError):
+        connection.download_to("/tmp/__nonexistent", "/tmp/__pytest_fora_download_dest")
+    assert not os.path.exists("/tmp/__pytest_fora_download_dest")
+
+def test_download_to_umask(monkeypatch):
+    with open("/tmp/__pytest_fora_download", "wb") as f:
+        f.write(b"content")
+    old_umask = os.umask(0o027)
+    try:
+        # The umask is shared by all threads, so it must not even be changed briefly
+        with monkeypatch.context() as m:
+            m.setattr(os, "umask", None)
+            connection.download_to("/tmp/__pytest_fora_download", "/tmp/__pytest_fora_download_dest")
+        assert os.stat("/tmp/__pytest_fora_download_dest").st_mode & 0o777 == 0o640
+    finally:
+        os.umask(old_umask)
+        os.remove("/tmp/__pytest_fora_download")
+        os.remove("/tmp/__pytest_fora_download_dest")
+
+def test_run_stream():
+    # The output arrives while the command is still waiting for more input
+    first_line = threading.Event()
+    def lines():
+        yield b"first\n"
+        assert first_line.wait(timeout=10)
+        yield b"second\n"
+
+    chunks = []
+    for fd, data in connection.run_stream(["sh", "-c", "read a; echo $a; read b; echo $b >&2"], input=lines()):
+        chunks.append((fd, data))
+        if data == b"first\n":
+            first_line.set()
+    assert chunks == [(1, b"first\n"), (2, b"second\n")]
+
+def test_run_on_output():
+    received = []
+    ret = connection.run(["head", "-c", "1000000", "/dev/zero"], on_output=lambda fd, data: received.append((fd, len(data))))
+    assert ret.returncode == 0
+    assert ret.stdout is None
+    assert len(received) > 1
+    assert all(fd == 1 for fd, _ in received)
+    assert sum(n for _, n in received) == 1000000
+
+    content = os.urandom(100000)
+    out = []
+    assert connection.run(["cat"], input=content, on_output=lambda _, data: out.append(data)).returncode == 0
+    assert b"".join(out) == content
+
+def test_run_on_output_false():
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        connection.run(["false"], on_output=lambda fd, data: None)
+    assert 1 == e.value.returncode
+    assert connection.run(["sh", "-c", "exit 3"], check=False, on_output=lambda fd, data: None).returncode == 3
+
+def test_run_stream_closed_early():
+    stream = connection.run_stream(["yes"])
+    assert next(stream)[0] == 1
+    stream.close()
+    assert connection.run(["true"]).returncode == 0
+
+def test_run_stream_unread_input():
+    # The process never reads its input, which exceeds the pipe buffer and the dispatcher's request queue
+    old_chunk_size = connection.connector.chunk_size
+    connection.connector.chunk_size = 4096
+    def run():
+        stream = connection.run_stream(["sh", "-c", "echo started; exec sleep 60"], input=os.urandom(1 << 20))
+        assert next(stream) == (1, b"started\n")
+        # Give the input time to pile up, then close the stream, which kills the process without waiting for the input
+        time.sleep(1)
+        stream.close()
+        assert connection.run(["true"]).returncode == 0
+    try:
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout=20)
+        assert not thread.is_alive()
+    finally:
+        connection.connector.chunk_size = old_chunk_size
+
+def test_run_stream_invalid():
+    with pytest.raises(ValueError, match="user"):
+        list(connection.run_stream(["true"], user="_invalid_"))
+    with pytest.raises(RemoteOSError):
+        list(connection.run_stream(["echo test"]))
+
+@pytest.mark.parametrize("compression", ["zlib", "lzma"])
+def test_compression(compression):
+    fora.args.compression = compression
+    try:
+        with Connection(host) as conn:
+            assert conn.connector.conn.compressor.algorithm == compression
+            content = b"some = config\n" * 10000
+            conn.upload("/tmp/__pytest_fora_compressed", content=content)
+            assert conn.download("/tmp/__pytest_fora_compressed") == content
+            assert conn.run(["cat", "/tmp/__pytest_fora_compressed"]).stdout == content
+    finally:
+        del fora.args.compression
+        fora.host = host
+        host.connection = connection
+    os.remove("/tmp/__pytest_fora_compressed")
+
+def test_blob_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    fora.args.blob_store_size = 1
+    content = os.urandom(100000)
+    sha512sum = hashlib.sha512(content).digest()
+    try:
+        with Connection(host) as conn:
+            assert conn.query_blobs([sha512sum]) == [False]
+            with pytest.raises(ValueError, match="not in the store"):
+                conn.place_blob(str(tmp_path / "placed"), sha512sum=sha512sum)
+
+            conn.upload(str(tmp_path / "uploaded"), content=content)
+            assert conn.query_blobs([sha512sum, hashlib.sha512(b"").digest()]) == [True, False]
+            conn.place_blob(str(tmp_path / "placed"), sha512sum=sha512sum, mode="640")
+            assert (tmp_path / "placed").read_bytes() == content
+            assert conn.stat(str(tmp_path / "placed")).mode == "640"
+
+            # The least recently used blobs are evicted when the store exceeds its size
+            for _ in range(12):
+                conn.upload(str(tmp_path / "uploaded"), content=os.urandom(100000))
+            assert conn.query_blobs([sha512sum]) == [False]
+            assert sum(f.stat().st_size for f in (tmp_path / "fora" / "blobs").iterdir()) <= 1 << 20
+    finally:
+        del fora.args.blob_store_size
+        fora.host = host
+        host.connection = connection
+
+def test_blob_store_only_replaced_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    fora.args.blob_store_size = 1
+    content = os.urandom(1000)
+    (tmp_path / "linked").write_bytes(b"")
+    os.link(tmp_path / "linked", tmp_path / "link")
+    try:
+        with Connection(host) as conn:
+            # Files written in-place may be special or shared, so their content is not stored
+            conn.upload(str(tmp_path / "linked"), content=content)
+            conn.upload("/dev/null", content=content)
+            assert conn.query_blobs([hashlib.sha512(content).digest()]) == [False]
+    finally:
+        del fora.args.blob_store_size
+        fora.host = host
+        host.connection = connection
+
+def test_save_content_blob_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(fora, "args", SimpleNamespace(debug=False, diff=False, dry=False, changes=False, verbose=0))
+    # The blob is reported to be in the store, but was evicted before it is placed
+    monkeypatch.setattr(connection, "query_blobs", lambda sha512sums: [True] * len(sha512sums))
+    content = os.urandom(1000)
+    files.upload_content(content=content, dest=str(tmp_path / "file"))
+    assert (tmp_path / "file").read_bytes() == content
+
+def test_upload_delta():
+    basis = os.urandom(1 << 20)
+    connection.upload("/tmp/__pytest_fora_delta", content=basis, mode="640")
+    content = basis[:1000] + b"inserted" + basis[1000:500000] + os.urandom(1000) + basis[501000:]
+
+    old_threshold = connection.connector.delta_threshold
+    connection.connector.delta_threshold = 1 << 16
+    try:
+        connection.upload_delta("/tmp/__pytest_fora_delta", content=content)
+        assert connection.download("/tmp/__pytest_fora_delta") == content
+        assert connection.stat("/tmp/__pytest_fora_delta").mode == "640"
+
+        # Nonexistent files and small content are uploaded as a whole
+        connection.upload_delta("/tmp/__pytest_fora_delta_new", content=content)
+        assert connection.download("/tmp/__pytest_fora_delta_new") == content
+        connection.upload_delta("/tmp/__pytest_fora_delta", content=io.BytesIO(b"small"))
+        assert connection.download("/tmp/__pytest_fora_delta") == b"small"
+    finally:
+        connection.connector.delta_threshold = old_threshold
+        os.remove("/tmp/__pytest_fora_delta")
+        os.remove("/tmp/__pytest_fora_delta_new")
+
+def test_upload_delta_hard_links(monkeypatch):
+    basis = os.urandom(1 << 18)
+    with open("/tmp/__pytest_fora_delta", "wb") as f:
+        f.write(basis)
+    os.link("/tmp/__pytest_fora_delta", "/tmp/__pytest_fora_delta_link")
+    ino = os.stat("/tmp/__pytest_fora_delta").st_ino
+    content = basis[:1000] + b"inserted" + basis[1000:]
+    monkeypatch.setattr(connection.connector, "delta_threshold", 1 << 16)
+    try:
+        # A file that is written in-place is still the basis of the delta, so nothing is sent again as a whole
+        def upload_stream(**kwargs):
+            raise AssertionError(f"unexpected full upload {kwargs['file']}")
+        with monkeypatch.context() as m:
+            m.setattr(connection.connector, "upload_stream", upload_stream)
+            connection.upload_delta("/tmp/__pytest_fora_delta", content=content)
+        with open("/tmp/__pytest_fora_delta_link", "rb") as f:
+            assert f.read() == content
+        assert os.stat("/tmp/__pytest_fora_delta").st_ino == ino
+
+        # A failed upload leaves the file intact
+        connector = connection.connector
+        with connector.pipeline():
+            connector._request_deferred(td.PacketUploadBegin(stream=9999, file="/tmp/__pytest_fora_delta"), lambda _: None)
+            connector._send(td.PacketUploadChunk(stream=9999, data=b"1234"), connector._channel())
+            with pytest.raises(ValueError, match=r"given for field 'sha512sum'"):
+                connector._request(td.PacketUploadEnd(stream=9999, sha512sum=hashlib.sha512(b"4321").digest()))
+        with open("/tmp/__pytest_fora_delta_link", "rb") as f:
+            assert f.read() == content
+    finally:
+        os.remove("/tmp/__pytest_fora_delta")
+        os.remove("/tmp/__pytest_fora_delta_link")
+
+def test_upload_delta_deferred_errors():
+    basis = os.urandom(1 << 18)
+    connection.upload("/tmp/__pytest_fora_delta", content=basis)
+    old_threshold = connection.connector.delta_threshold
+    connection.connector.delta_threshold = 1 << 16
+    try:
+        # An error of an earlier pipelined request is not mistaken for a failed delta
+        with pytest.raises(ValueError, match="_invalid_"):
+            with connection.pipeline():
+                connection.upload("/tmp/__pytest_fora_delta_other", content=b"", owner="_invalid_")
+                connection.upload_delta("/tmp/__pytest_fora_delta", content=basis[:1000] + b"changed" + basis[1000:])
+        assert connection.download("/tmp/__pytest_fora_delta") == basis
+    finally:
+        connection.connector.delta_threshold = old_threshold
+        os.remove("/tmp/__pytest_fora_delta")
+
 def test_download_nonexistent():
     assert connection.download_or("/tmp/__nonexistent") == None
     with pytest.raises(ValueError):
@@ -246,6 +730,17 @@ def test_query_user():
     assert entry is not None
     assert entry.name == "nobody"
 
+def test_query_many():
+    users = connection.query_user_many([current_test_user(), "0", "__nonexistent"])
+    assert users[0] == connection.query_user(current_test_user())
+    assert users[1] is not None and users[1].name == "root"
+    assert users[2] is None
+
+    groups = connection.query_group_many([current_test_group(), "0", "__nonexistent"])
+    assert groups[0] == connection.query_group(current_test_group())
+    assert groups[1] is not None and groups[1].gid == 0
+    assert groups[2] is None
+
 def test_home_dir():
     assert connection.home_dir() == pwd.getpwuid(os.getuid()).pw_dir
 
@@ -0,0 +1,23 @@
+# Runs the whole connection test suite against the in-process connector.
+# The imported tests operate on the globals of test_connection, so only test_init is replaced.
+# pylint: disable=wildcard-import,unused-wildcard-import
+from test_connection import *
+import test_connection
+from fora.connectors.inproc import InprocConnector
+
+def test_init():
+    class DefaultArgs:
+        debug = False
+        diff = False
+    fora.args = DefaultArgs()
+    fora.loader.load_inventory("inproc:")
+
+    test_connection.host = fora.inventory.loaded_hosts["localhost"]
+    fora.host = test_connection.host
+    fora.script = ScriptWrapper("__internal_test")
+    class Empty:
+        pass
+    fora.script.wrap(Empty())
+
+def test_connector_type():
+    assert isinstance(test_connection.host.create_connector(), InprocConnector)
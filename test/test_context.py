@@ -0,0 +1,179 @@
+import asyncio
+import contextvars
+import os
+import threading
+
+import fora
+import fora.loader
+from fora.main import run_host
+from fora.utils import ContextStack
+
+_stack: ContextStack[int] = ContextStack("test", (0,))
+_fresh_stack: ContextStack[str] = ContextStack("test_fresh")
+
+SCRIPT = """
+import os
+import time
+import fora
+from fora import host
+
+mode = "640" if host.name == "a" else "604"
+with defaults(file_mode=mode):
+    time.sleep(0.2)
+    # The other host runs concurrently, but this thread still sees its own state
+    assert fora.host is host
+    assert fora.script.current_defaults().file_mode == mode
+    with open(os.path.join(os.environ["FORA_TEST_DIR"], host.name), "w") as f:
+        f.write(fora.script.name)
+"""
+
+def test_attributes_in_threads():
+    old_host = fora.host
+    fora.host = "main"
+    try:
+        seen = {}
+        def run(i):
+            seen[(i, "before")] = fora.host
+            fora.host = i
+            threading.Event().wait(0.05)
+            seen[(i, "after")] = fora.host
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        threads.append(threading.Thread(target=contextvars.copy_context().run, args=(run, 4)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # A new thread sees the value of the main thread, and its own assignments afterwards
+        for i in range(5):
+            assert seen[(i, "before")] == "main"
+            assert seen[(i, "after")] == i
+        assert fora.host == "main"
+        # Assignments in other threads are never visible to threads started later
+        seen.clear()
+        thread = threading.Thread(target=run, args=(5,))
+        thread.start()
+        thread.join()
+        assert seen[(5, "before")] == "main"
+    finally:
+        fora.host = old_host
+
+def test_attributes_in_tasks():
+    old_script = fora.script
+    fora.script = "main"
+    async def run(i):
+        assert fora.script == "main"
+        fora.script = i
+        await asyncio.sleep(0.01)
+        return fora.script
+    async def run_all():
+        return await asyncio.gather(*(run(i) for i in range(4)))
+    try:
+        assert asyncio.run(run_all()) == [0, 1, 2, 3]
+        assert fora.script == "main"
+    finally:
+        fora.script = old_script
+
+def test_context_stack():
+    _stack.append(1)
+    async def run(i):
+        _stack.append(i)
+        await asyncio.sleep(0.01)
+        return _stack.copy()
+    async def run_all():
+        return await asyncio.gather(run(2), run(3))
+    assert asyncio.run(run_all()) == [[0, 1, 2], [0, 1, 3]]
+    assert list(_stack) == [0, 1]
+    assert _stack.pop() == 1
+    assert len(_stack) == 1 and _stack[-1] == 0
+
+def test_context_stack_fresh():
+    async def run(entry):
+        _fresh_stack.append(entry)
+        await asyncio.sleep(0.01)
+        return _fresh_stack.copy()
+    async def run_all():
+        return await asyncio.gather(run("a"), run("b"))
+    # Tasks never see each other's entries, even if the stack was never changed before
+    assert asyncio.run(run_all()) == [["a"], ["b"]]
+    assert len(_fresh_stack) == 0
+    # Threads see the entries of the main thread, but never those of other threads
+    seen = []
+    def run_thread():
+        seen.append(_fresh_stack.copy())
+        _fresh_stack.append("thread")
+    _fresh_stack.append("main")
+    for _ in range(2):
+        thread = threading.Thread(target=run_thread)
+        thread.start()
+        thread.join()
+    assert seen == [["main"], ["main"]]
+    assert _fresh_stack.pop() == "main"
+
+THREADS_SCRIPT = """
+import os
+from concurrent.futures import ThreadPoolExecutor
+import fora
+from fora import host
+from fora.utils import check_host_active
+
+def work(i):
+    check_host_active()
+    assert fora.host is host
+    return fora.script.current_defaults().file_mode
+
+# Threads started by a script see the current host, script and defaults, just like plain globals
+with defaults(file_mode="640"):
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        modes = list(pool.map(work, range(4)))
+with open(os.path.join(os.environ["FORA_TEST_DIR"], host.name), "w") as f:
+    f.write(",".join(modes))
+"""
+
+def test_threads_in_script(tmp_path, monkeypatch):
+    class DefaultArgs:
+        debug = False
+        diff = False
+        dry = False
+        changes = False
+        verbose = 0
+    old_args, old_host, old_script = fora.args, fora.host, fora.script
+    fora.args = DefaultArgs()
+    monkeypatch.setenv("FORA_TEST_DIR", str(tmp_path))
+    (tmp_path / "deploy.py").write_text(THREADS_SCRIPT)
+    (tmp_path / "inventory.py").write_text('hosts = ["inproc:a"]')
+    try:
+        fora.loader.load_inventory(str(tmp_path / "inventory.py"))
+        run_host(str(tmp_path / "deploy.py"), "a")
+        assert (tmp_path / "a").read_text() == "640,640,640,640"
+    finally:
+        fora.args, fora.host, fora.script = old_args, old_host, old_script
+
+def test_hosts_in_threads(tmp_path, monkeypatch):
+    class DefaultArgs:
+        debug = False
+        diff = False
+        dry = False
+        changes = False
+        verbose = 0
+    old_args, old_host, old_script = fora.args, fora.host, fora.script
+    fora.args = DefaultArgs()
+    monkeypatch.setenv("FORA_TEST_DIR", str(tmp_path))
+    (tmp_path / "deploy.py").write_text(SCRIPT)
+    (tmp_path / "inventory.py").write_text('hosts = ["inproc:a", "inproc:b"]')
+    try:
+        fora.loader.load_inventory(str(tmp_path / "inventory.py"))
+        errors = []
+        def run(name):
+            try:
+                run_host(str(tmp_path / "deploy.py"), name)
+            except Exception as e: # pylint: disable=broad-except
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(name,)) for name in fora.inventory.loaded_hosts]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert (tmp_path / "a").read_text() == (tmp_path / "b").read_text() == "cmdline"
+    finally:
+        fora.args, fora.host, fora.script = old_args, old_host, old_script
@@ -0,0 +1,108 @@
+import contextlib
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, cast
+
+import pytest
+
+import fora
+from fora.connectors.local import LocalConnector
+from fora.connectors.tunnel_connector import dispatcher_version
+
+def connect(remote_daemon: int) -> LocalConnector:
+    fora.args = SimpleNamespace(debug=False, remote_daemon=remote_daemon)
+    connector = LocalConnector("local:", cast(Any, SimpleNamespace(name="localhost", url="local:")))
+    connector.open()
+    return connector
+
+def dispatcher_pid(remote_daemon: int) -> int:
+    connector = connect(remote_daemon)
+    try:
+        # The parent of a process started by the dispatcher is the dispatcher itself
+        return int(connector.run(["sh", "-c", "echo $PPID"]).stdout or b"")
+    finally:
+        connector.close()
+
+def wait_for(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def test_daemon_reused(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    socket = tmp_path / f"fora-{os.getuid()}" / f"dispatcher-{dispatcher_version()}.sock"
+
+    pid = dispatcher_pid(2)
+    assert socket.exists()
+    assert dispatcher_pid(2) == pid
+
+    # Concurrent sessions are served by the same daemon
+    pids = []
+    threads = [threading.Thread(target=lambda: pids.append(dispatcher_pid(2))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert pids == [pid] * 4
+
+    # The daemon exits after the idle timeout and a new one is started afterwards
+    assert wait_for(lambda: not socket.exists())
+    assert dispatcher_pid(2) != pid
+    assert wait_for(lambda: not socket.exists())
+
+def test_daemon_disabled(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    assert dispatcher_pid(0) != dispatcher_pid(0)
+    assert not (tmp_path / f"fora-{os.getuid()}").exists()
+
+def test_daemon_directory_not_private(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    directory = tmp_path / f"fora-{os.getuid()}"
+    directory.mkdir(mode=0o755)
+    directory.chmod(0o755)
+    # The session is served without a daemon
+    assert dispatcher_pid(2) != dispatcher_pid(2)
+    assert not any(directory.iterdir())
+
+def test_daemon_crash(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    other = connect(2)
+    try:
+        pid = int(other.run(["sh", "-c", "echo $PPID"]).stdout or b"")
+        # An unexpected exception in a handler only ends the session in which it occurred
+        failing = connect(2)
+        with pytest.raises(IOError):
+            failing.run(["echo", "embedded\0null"])
+        # The relay may already have exited, so telling it to exit can fail
+        with contextlib.suppress(OSError):
+            failing.close()
+        assert other.run(["echo", "ok"]).stdout == b"ok\n"
+        assert dispatcher_pid(2) == pid
+    finally:
+        other.close()
+
+def test_daemon_environ(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    monkeypatch.setenv("FORA_TEST_VAR", "first")
+    first = connect(2)
+    try:
+        # The daemon was started by the first session, but each session sees its own environment
+        monkeypatch.setenv("FORA_TEST_VAR", "second")
+        monkeypatch.delenv("HOME")
+        second = connect(2)
+        try:
+            assert first.run(["sh", "-c", "echo $PPID"]).stdout == second.run(["sh", "-c", "echo $PPID"]).stdout
+            assert first.getenv("FORA_TEST_VAR") == "first"
+            assert second.getenv("FORA_TEST_VAR") == "second"
+            assert second.getenv_many(["FORA_TEST_VAR", "HOME"]) == ["second", None]
+            assert second.run(["sh", "-c", "echo $FORA_TEST_VAR"]).stdout == b"second\n"
+            assert first.run(["sh", "-c", "echo $FORA_TEST_VAR"]).stdout == b"first\n"
+        finally:
+            second.close()
+    finally:
+        first.close()
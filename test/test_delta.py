@@ -0,0 +1,80 @@
+import io
+import os
+import random
+
+import pytest
+
+import fora
+import fora.connectors.tunnel_dispatcher as td
+from fora.connectors import delta
+
+def test_init():
+    class DefaultArgs:
+        debug = False
+    fora.args = DefaultArgs()
+
+def remote_checksums(tmp_path, basis: bytes, block_size: int) -> td.PacketBlockChecksums:
+    path = tmp_path / "basis"
+    path.write_bytes(basis)
+    out = io.BytesIO()
+    td.PacketChecksumBlocks(file=str(path), block_size=td.u32(block_size)).handle(td.Connection(io.BytesIO(), out))
+    return td.receive_packet(td.Connection(io.BytesIO(out.getvalue()), io.BytesIO()))
+
+def apply_delta(tmp_path, basis: bytes, data: bytes, block_size: int) -> tuple[bytes, int]:
+    checksums = remote_checksums(tmp_path, basis, block_size)
+    assert checksums.size == len(basis)
+    result = bytearray()
+    literal = 0
+    for op in delta.compute_delta(data, checksums.size, block_size, checksums.weak, checksums.strong):
+        if isinstance(op, delta.DeltaCopy):
+            result += basis[op.offset:op.offset + op.length]
+        else:
+            result += data[op.start:op.end]
+            literal += op.end - op.start
+    return (bytes(result), literal)
+
+def edit(content: bytes, seed: int) -> bytes:
+    rng = random.Random(seed)
+    data = bytearray(content)
+    for _ in range(5):
+        pos = rng.randrange(len(data))
+        data[pos:pos + 100] = os.urandom(100)
+    pos = rng.randrange(len(data))
+    data[pos:pos] = os.urandom(3000)
+    pos = rng.randrange(len(data))
+    del data[pos:pos + 5000]
+    return bytes(data)
+
+@pytest.mark.parametrize("case", ["identical", "edited", "appended", "truncated", "unrelated", "empty", "short"])
+def test_compute_delta(tmp_path, case):
+    block_size = 2048
+    basis = os.urandom(1 << 20)
+    data = {
+        "identical": basis,
+        "edited": edit(basis, 1),
+        "appended": basis + os.urandom(1000),
+        "truncated": basis[:-1000],
+        "unrelated": os.urandom(1 << 20),
+        "empty": b"",
+        "short": basis[:1000],
+    }[case]
+
+    result, literal = apply_delta(tmp_path, basis, data, block_size)
+    assert result == data
+    if case == "identical":
+        assert literal == 0
+    if case == "truncated":
+        assert literal < block_size
+    if case == "edited":
+        assert literal < 20 * block_size
+    if case == "appended":
+        assert literal == 1000
+
+def test_compute_delta_empty_basis(tmp_path):
+    data = os.urandom(10000)
+    assert apply_delta(tmp_path, b"", data, 2048) == (data, len(data))
+
+def test_block_size():
+    assert delta.block_size(0) == 2048
+    assert delta.block_size(1 << 30) == 1 << 15
+    assert delta.block_size(1 << 40) == 1 << 17
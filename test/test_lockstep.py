@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+
+import pytest
+
+from fora.lockstep import Barrier, Lockstep, sync
+from fora.main import main
+from fora.utils import ContextStack
+
+_stack: ContextStack[str] = ContextStack("test", ("main",))
+
+INVENTORY = """
+hosts = ["inproc:a", "inproc:b", "inproc:c"]
+"""
+
+DEPLOY = """
+import os
+import threading
+import time
+from fora import host
+from fora.operations import files
+from fora.operations.api import Operation, OperationResult, operation
+
+def log(event):
+    with open(os.path.join(os.environ["FORA_TEST_DIR"], "log"), "a") as f:
+        f.write(f"{host.name}:{event}\\n")
+
+@operation("step")
+def step(n: int, name=None, check=True, op: Operation = Operation.internal_use_only) -> OperationResult:
+    _ = (name, check)
+    op.desc(str(n))
+    # Slow hosts must not fall behind
+    time.sleep(0.05 if host.name == "b" else 0)
+    log(f"probe{n}")
+    if host.name == "c" and n == 2:
+        raise ValueError("failure on c")
+    op.initial_state(done=False)
+    op.final_state(done=True)
+    time.sleep(0.05 if host.name == "a" else 0)
+    log(f"apply{n}")
+    return op.success()
+
+step(1)
+files.upload_content(dest=os.path.join(os.environ["FORA_TEST_DIR"], host.name), content=threading.current_thread().name)
+step(2)
+step(3)
+"""
+
+def test_lockstep(deploy, capsys):
+    with pytest.raises(SystemExit) as e:
+        main(["--lockstep", "inventory.py", "deploy.py"])
+    assert e.value.code == 1
+
+    # Each host runs in its own thread
+    for name in ["a", "b", "c"]:
+        assert (deploy / name).read_text() == f"lockstep-{name}"
+
+    # No host starts a phase before all other hosts have finished the previous one
+    events = [line.split(":") for line in (deploy / "log").read_text().splitlines()]
+    phases = [f"{phase}{n}" for n in [1, 2, 3] for phase in ["probe", "apply"]]
+    assert [e for _, e in events] == sorted((e for _, e in events), key=phases.index)
+    assert sorted(h for h, e in events if e == "apply1") == ["a", "b", "c"]
+    assert sorted(h for h, e in events if e == "probe2") == ["a", "b", "c"]
+    # The failed host doesn't block the others
+    assert sorted(h for h, e in events if e == "apply3") == ["a", "b"]
+
+    captured = capsys.readouterr()
+    assert "a │ host a via inproc:a" in captured.out
+    assert "c │ ValueError: failure on c" in captured.out
+    lines = [line for line in captured.out.splitlines() if line.endswith("step 3")]
+    assert [line[0] for line in lines] == ["a", "b"]
+    assert "script failed on 1 of 3 hosts: c" in captured.err
+
+def test_barrier_leave():
+    barrier = Barrier(3)
+    order = []
+    def run(i):
+        if i == 2:
+            time.sleep(0.05)
+            order.append("leave")
+            barrier.leave()
+            return
+        barrier.wait()
+        order.append(i)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+    assert order[0] == "leave"
+    assert sorted(order[1:]) == [0, 1]
+    assert not any(t.is_alive() for t in threads)
+
+def test_host_contexts(capsys, monkeypatch):
+    monkeypatch.setenv("NO_COLOR", "1")
+    def run(host):
+        _stack.append(host)
+        sync()
+        # Each host only sees its own entries, even though all hosts have appended one
+        print(",".join(_stack))
+        return host == "b"
+    assert Lockstep(["a", "b", "c"]).run(run) == {"b"}
+    assert list(_stack) == ["main"]
+    assert capsys.readouterr().out.splitlines() == ["a │ main,a", "b │ main,b", "c │ main,c"]
+
+SUB_DEPLOY = """
+import os
+from fora import host
+from fora.operations import files, local
+
+local.script("tasks/sub.py")
+files.upload(src="payload.txt", dest=os.path.join(os.environ["FORA_TEST_DIR"], host.name + ".top"))
+"""
+
+SUB_SCRIPT = """
+import os
+from fora import host
+from fora.operations import files
+
+files.upload(src="payload.txt", dest=os.path.join(os.environ["FORA_TEST_DIR"], host.name + ".sub"))
+files.fetch(src=os.path.join(os.environ["FORA_TEST_DIR"], host.name + ".sub"), dest="fetched/" + host.name)
+"""
+
+def test_lockstep_sub_scripts(deploy, tmp_path):
+    (tmp_path / "deploy.py").write_text(SUB_DEPLOY)
+    (tmp_path / "payload.txt").write_text("top")
+    (tmp_path / "tasks").mkdir()
+    (tmp_path / "tasks" / "sub.py").write_text(SUB_SCRIPT)
+    (tmp_path / "tasks" / "payload.txt").write_text("sub")
+    main(["--lockstep", "inventory.py", "deploy.py"])
+
+    # Relative paths are resolved against the directory of the script that uses them
+    for name in ["a", "b", "c"]:
+        assert (deploy / f"{name}.top").read_text() == "top"
+        assert (deploy / f"{name}.sub").read_text() == "sub"
+        assert (tmp_path / "tasks" / "fetched" / name).read_text() == "sub"
+    assert os.getcwd() == str(tmp_path)
@@ -332,6 +332,19 @@ def test_files_upload():
         with open(__file__, 'rb') as g:
             assert f.read() == g.read()
 
+def test_files_fetch():
+    if os.path.exists("/tmp/__pytest_fora_fetched"):
+        os.remove("/tmp/__pytest_fora_fetched")
+    assert files.fetch(src="/tmp/__pytest_fora/testupload", dest="/tmp/__pytest_fora_fetched").changed
+    with open("/tmp/__pytest_fora_fetched", 'rb') as f:
+        with open(__file__, 'rb') as g:
+            assert f.read() == g.read()
+    assert not files.fetch(src="/tmp/__pytest_fora/testupload", dest="/tmp/__pytest_fora_fetched").changed
+    os.remove("/tmp/__pytest_fora_fetched")
+
+    with pytest.raises(OperationError, match="doesn't exist"):
+        files.fetch(src="/tmp/__pytest_fora/nonexistent", dest="/tmp/__pytest_fora_fetched")
+
 def test_files_template_content():
     files.template_content(dest="/tmp/__pytest_fora/testtemplcontent", content="{{ myvar }}", context=dict(myvar="q948fhqh489f"), mode="644")
     with open("/tmp/__pytest_fora/testtemplcontent", 'rb') as f:
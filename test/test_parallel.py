@@ -0,0 +1,47 @@
+import os
+import re
+
+import pytest
+
+from fora.main import main
+
+INVENTORY = """
+hosts = ["inproc:a", "inproc:b", "inproc:c", "inproc:d"]
+"""
+
+DEPLOY = """
+import os
+from fora import host
+from fora.operations import files
+
+files.upload_content(dest=os.path.join(os.environ["FORA_TEST_DIR"], host.name), content=str(os.getpid()))
+print(f"deployed on {host.name}")
+if host.name == "b":
+    raise ValueError("failure on b")
+"""
+
+def test_parallel(deploy, capsys):
+    with pytest.raises(SystemExit) as e:
+        main(["-j", "2", "inventory.py", "deploy.py"])
+    assert e.value.code == 1
+
+    # All hosts are run in worker processes, despite the failure on one of them.
+    # Workers are reused for multiple hosts.
+    pids = {name: (deploy / name).read_text() for name in ["a", "b", "c", "d"]}
+    assert str(os.getpid()) not in pids.values()
+
+    # The output of each host is printed as a whole
+    captured = capsys.readouterr()
+    output = captured.out + captured.err
+    blocks = {m.group(1): m.group(0) for m in re.finditer(r"host (\w) via.*?(?=host \w via|\Z)", output, re.DOTALL)}
+    assert sorted(blocks) == ["a", "b", "c", "d"]
+    for name, block in blocks.items():
+        assert f"deployed on {name}" in block
+    assert "failure on b" in blocks["b"]
+    assert "script failed on 1 of 4 hosts: b" in output
+
+def test_sequential(deploy):
+    with pytest.raises(ValueError, match="failure on b"):
+        main(["inventory.py", "deploy.py"])
+    assert (deploy / "a").read_text() == str(os.getpid())
+    assert not (deploy / "c").exists()
@@ -0,0 +1,95 @@
+import pytest
+
+from fora.main import main, parse_batch_size
+
+INVENTORY = """
+hosts = [dict(url="inproc:a", groups=["db"]),
+         dict(url="inproc:b", groups=["db"]),
+         dict(url="inproc:c", groups=["web"]),
+         dict(url="inproc:d", groups=["web", "edge"]),
+         dict(url="inproc:e", groups=["web"])]
+groups = ["db", dict(name="web", after=["db"]), dict(name="edge", after=["web"])]
+"""
+
+DEPLOY = """
+import os
+from fora import host
+
+with open(os.path.join(os.environ["FORA_TEST_DIR"], "order"), "a") as f:
+    f.write(host.name)
+if host.name in os.environ.get("FORA_TEST_FAIL", ""):
+    raise ValueError(f"failure on {host.name}")
+"""
+
+def run(deploy, argv):
+    with pytest.raises(SystemExit) as e:
+        main(argv + ["inventory.py", "deploy.py"])
+        raise SystemExit(0)
+    return e.value.code, (deploy / "order").read_text()
+
+def test_parse_batch_size():
+    assert parse_batch_size(2, 10) == 2
+    assert parse_batch_size("3", 10) == 3
+    assert parse_batch_size("25%", 10) == 3
+    assert parse_batch_size("1%", 10) == 1
+    assert parse_batch_size("100%", 10) == 10
+    for invalid in [0, "-1", "0%", "101%", "abc", "x%"]:
+        with pytest.raises(ValueError):
+            parse_batch_size(invalid, 10)
+
+def test_all_succeed(deploy, capsys):
+    assert run(deploy, ["--batch-size", "2"]) == (0, "abcde")
+    out = capsys.readouterr().out
+    assert "batch 1/3 a, b" in out
+    assert "batch 3/3 e" in out
+
+def test_stop_after_failed_batch(deploy, monkeypatch, capsys):
+    monkeypatch.setenv("FORA_TEST_FAIL", "b")
+    # By default, the rollout is stopped after the first failure
+    assert run(deploy, ["--batch-size", "40%"]) == (1, "ab")
+    captured = capsys.readouterr()
+    output = captured.out + captured.err
+    assert "failure on b" in output
+    assert "script failed on 1 of 5 hosts: b" in output
+    assert "skipped 3 hosts: c, d, e" in output
+
+def test_failure_budget(deploy, monkeypatch, capsys):
+    monkeypatch.setenv("FORA_TEST_FAIL", "bc")
+    # 1 of 5 hosts may fail, so the second failure stops the rollout immediately
+    assert run(deploy, ["--batch-size", "5", "--max-fail-percentage", "20"]) == (1, "abc")
+    assert "skipped 2 hosts: d, e" in capsys.readouterr().err
+
+def test_failure_budget_not_exceeded(deploy, monkeypatch, capsys):
+    monkeypatch.setenv("FORA_TEST_FAIL", "b")
+    assert run(deploy, ["--batch-size", "1", "--max-fail-percentage", "20"]) == (1, "abcde")
+    err = capsys.readouterr().err
+    assert "script failed on 1 of 5 hosts: b" in err
+    assert "skipped" not in err
+
+def test_batch_by_group(deploy, capsys):
+    # d belongs to edge, which has a higher precedence than web
+    assert run(deploy, ["--batch-by-group", "-H", "d,e,c,b,a"]) == (0, "baecd")
+    out = capsys.readouterr().out
+    assert "batch 1/3 (group db) b, a" in out
+    assert "batch 2/3 (group web) e, c" in out
+    assert "batch 3/3 (group edge) d" in out
+
+def test_inventory_defaults(deploy, tmp_path, monkeypatch, capsys):
+    with open(tmp_path / "inventory.py", "a") as f:
+        f.write('batch_size = "50%"\nbatch_by_group = True\nmax_fail_percentage = 100\n')
+    monkeypatch.setenv("FORA_TEST_FAIL", "ace")
+    assert run(deploy, []) == (1, "abced")
+    out = capsys.readouterr().out
+    assert "batch 4/5 (group web) e" in out
+
+    # Command line flags override the inventory
+    (deploy / "order").unlink()
+    assert run(deploy, ["--no-batch-by-group", "--max-fail-percentage", "0"]) == (1, "a")
+    assert "batch 1/2 a, b, c" in capsys.readouterr().out
+
+def test_parallel_batches(deploy, monkeypatch, capsys):
+    monkeypatch.setenv("FORA_TEST_FAIL", "b")
+    code, order = run(deploy, ["--batch-size", "2", "-j", "2"])
+    assert code == 1
+    assert sorted(order) == ["a", "b"]
+    assert "skipped 3 hosts: c, d, e" in capsys.readouterr().err
@@ -0,0 +1,55 @@
+import os
+from types import SimpleNamespace
+from typing import Any, cast
+
+import fora
+from fora.connectors.ssh import SshConnector
+
+class LocalBootstrapConnector(SshConnector):
+    """Runs the remote command of the ssh connector locally instead of via ssh."""
+    def command(self) -> list[str]:
+        return ["sh", "-c", self.remote_command()]
+
+def connect(dispatcher_cache: bool) -> LocalBootstrapConnector:
+    fora.args = SimpleNamespace(debug=False, dispatcher_cache=dispatcher_cache)
+    connector = LocalBootstrapConnector("ssh://localhost", cast(Any, SimpleNamespace(name="localhost", url="ssh://localhost")))
+    connector.open()
+    return connector
+
+def test_bootstrap_cached(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+
+    # The first connection uploads the dispatcher
+    connector = connect(True)
+    try:
+        assert connector.query_user("root") is not None
+    finally:
+        connector.close()
+    cached = tmp_path / "fora" / f"tunnel_dispatcher_{connector.dispatcher_version}.py"
+    assert cached.exists()
+    assert any((tmp_path / "fora" / "__pycache__").iterdir())
+    mtime = os.stat(cached).st_mtime_ns
+
+    # The second connection uses the cached copy
+    connector = connect(True)
+    try:
+        assert connector.query_user("root") is not None
+    finally:
+        connector.close()
+    assert os.stat(cached).st_mtime_ns == mtime
+
+def test_bootstrap_cache_not_writable(tmp_path, monkeypatch):
+    (tmp_path / "fora").write_text("not a directory")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    connector = connect(True)
+    try:
+        assert connector.query_user("root") is not None
+    finally:
+        connector.close()
+
+def test_bootstrap_inline():
+    connector = connect(False)
+    try:
+        assert connector.query_user("root") is not None
+    finally:
+        connector.close()
@@ -0,0 +1,116 @@
+import os
+import stat
+import sys
+from types import SimpleNamespace
+from typing import Any, cast
+
+import pytest
+
+import fora
+from fora.connectors.ssh import ControlMasterPool, SshConnector
+
+# A stand-in for ssh, which runs the remote command locally. A master is represented by
+# its control socket file, and every started master is counted in $FAKE_SSH_MASTERS.
+FAKE_SSH = f"""#!{sys.executable}
+import os, sys
+args = sys.argv[1:]
+options, control, socket = {{}}, None, None
+while args[0].startswith("-"):
+    flag, value = args[0], args[1]
+    args = args[2:]
+    if flag == "-o":
+        key, _, value = value.partition("=")
+        options[key] = value
+    elif flag == "-O":
+        control = value
+    elif flag == "-S":
+        socket = value
+socket = socket or options.get("ControlPath")
+if control == "check":
+    sys.exit(0 if os.path.exists(socket) and open(socket).read() == "alive" else 255)
+if control == "exit":
+    os.unlink(socket)
+    sys.exit(0)
+if socket is not None and not os.path.exists(socket):
+    with open(os.environ["FAKE_SSH_MASTERS"], "a") as f:
+        f.write("master\\n")
+    with open(socket, "w") as f:
+        f.write("alive")
+os.execvp("sh", ["sh", "-c", args[1]])
+"""
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    program = tmp_path / "ssh"
+    program.write_text(FAKE_SSH)
+    program.chmod(0o755)
+    masters = tmp_path / "masters"
+    masters.write_text("")
+    monkeypatch.setattr(ControlMasterPool, "ssh_program", str(program))
+    monkeypatch.setenv("FAKE_SSH_MASTERS", str(masters))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    fora.args = SimpleNamespace(debug=False)
+    return lambda: len(masters.read_text().splitlines())
+
+def create_host(tmp_path, persist):
+    return cast(Any, SimpleNamespace(name="host", url="ssh://host", ssh_control_persist=persist, ssh_control_dir=str(tmp_path / "control")))
+
+def connect(host) -> SshConnector:
+    connector = SshConnector(host.url, host)
+    connector.open()
+    try:
+        assert connector.query_user("root") is not None
+    finally:
+        connector.close()
+    return connector
+
+def test_master_reused(tmp_path, fake_ssh):
+    host = create_host(tmp_path, 600)
+    connector = connect(host)
+    connect(host)
+    assert fake_ssh() == 1
+
+    control_dir = tmp_path / "control"
+    assert stat.S_IMODE(os.stat(control_dir).st_mode) == 0o700
+    socket = connector.control_pool.socket(host.url, [])
+    assert os.path.exists(socket)
+
+    # Closing the master starts a new one on the next connection
+    connector.control_pool.close(host.url, [])
+    assert not os.path.exists(socket)
+    connect(host)
+    assert fake_ssh() == 2
+
+def test_stale_socket_removed(tmp_path, fake_ssh):
+    host = create_host(tmp_path, 600)
+    pool = ControlMasterPool(host.ssh_control_dir)
+    assert pool.ensure_directory()
+    socket = pool.socket(host.url, [])
+    with open(socket, "w") as f:
+        f.write("dead")
+    assert not pool.check(socket, host.url)
+
+    connect(host)
+    assert fake_ssh() == 1
+    assert pool.check(socket, host.url)
+
+def test_sharing_disabled(tmp_path, fake_ssh):
+    host = create_host(tmp_path, None)
+    connect(host)
+    connect(host)
+    assert fake_ssh() == 0
+    assert not os.path.exists(tmp_path / "control")
+
+def test_directory_not_private(tmp_path, fake_ssh):
+    host = create_host(tmp_path, 600)
+    os.makedirs(host.ssh_control_dir, mode=0o755)
+    os.chmod(host.ssh_control_dir, 0o755)
+    assert ControlMasterPool(host.ssh_control_dir).options(host.url, [], 600) == []
+    connect(host)
+    assert fake_ssh() == 0
+
+def test_options():
+    pool = ControlMasterPool("/nonexistent")
+    assert pool.socket("ssh://a", []) != pool.socket("ssh://b", [])
+    assert pool.socket("ssh://a", []) != pool.socket("ssh://a", ["-p", "2222"])
+    assert len(os.path.basename(pool.socket("ssh://" + "a" * 500, []))) < 32
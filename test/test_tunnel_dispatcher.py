@@ -0,0 +1,377 @@
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import typing
+from types import SimpleNamespace
+from typing import Any, Union
+
+import pytest
+
+import fora
+import fora.connectors.tunnel_dispatcher as td
+
+def test_init():
+    class DefaultArgs:
+        debug = False
+    fora.args = DefaultArgs()
+
+def sample_values(vtype: Any) -> list[Any]:
+    if vtype is bool:
+        return [False, True]
+    if vtype in [td.i32, td.i64]:
+        return [0, -1, 1234]
+    if vtype in [td.u32, td.u64]:
+        return [0, 1, 1234]
+    if vtype is bytes:
+        return [b"", b"\x00\xff" * 8]
+    if vtype is str:
+        return ["", "äöü/path"]
+    if typing.get_origin(vtype) is Union:
+        return [None] + sample_values(typing.get_args(vtype)[0])
+    if typing.get_origin(vtype) is list:
+        return [[], sample_values(typing.get_args(vtype)[0])]
+    if hasattr(vtype, "_fields"):
+        return sample_packets(vtype)
+    raise ValueError(f"No sample values for {vtype}")
+
+def sample_packets(cls: Any) -> list[Any]:
+    fields = [sample_values(cls.__annotations__[f]) for f in cls._fields]
+    n = max([len(v) for v in fields] + [1])
+    return [cls(*[v[i % len(v)] for v in fields]) for i in range(n)]
+
+def generic_encode(packet: Any) -> bytes:
+    out = io.BytesIO()
+    conn = td.Connection(io.BytesIO(), out)
+    td._serialize(conn, td.u32, td.packets.index(type(packet)))
+    for f in packet._fields:
+        td._serialize(conn, type(packet).__annotations__[f], getattr(packet, f))
+    return out.getvalue()
+
+@pytest.mark.parametrize("cls", td.packets, ids=lambda cls: cls.__name__)
+def test_compiled_codec_matches_generic(cls):
+    for packet in sample_packets(cls):
+        data = packet._encode()
+        assert data == generic_encode(packet)
+
+        conn = td.Connection(io.BytesIO(data), io.BytesIO())
+        assert td._deserialize(conn, td.u32) == td.packets.index(cls)
+        decoded = td.packet_deserializers[td.packets.index(cls)](conn)
+        assert type(decoded) is cls
+        assert decoded == packet
+        assert conn.read(1) == b""
+
+def test_receive_packet_roundtrip():
+    packet = td.PacketStat(path="/tmp", follow_links=True, sha512sum=False)
+    out = io.BytesIO()
+    td.Connection(io.BytesIO(), out).write_packet(packet)
+    assert td.receive_packet(td.Connection(io.BytesIO(out.getvalue()), io.BytesIO())) == packet
+
+def test_receive_frame():
+    packet = td.PacketOSError(errno=2, strerror="No such file or directory", msg="test")
+    out = io.BytesIO()
+    td.Connection(io.BytesIO(), out).for_request(7, 1234).write_packet(packet)
+    assert td.receive_frame(td.Connection(io.BytesIO(out.getvalue()), io.BytesIO())) == (7, 1234, packet)
+    with pytest.raises(td.RemoteOSError, match="test"):
+        td.check_response(packet)
+
+def test_receive_packet_truncated():
+    data = td._struct_frame_header.pack(0, 0) + td.PacketStatResult(type="file", mode=0o644, owner="root", group="root", size=1, mtime=2, ctime=3, sha512sum=None)._encode()
+    with pytest.raises(IOError, match="Unexpected EOF"):
+        td.receive_packet(td.Connection(io.BytesIO(data[:-8]), io.BytesIO()))
+
+@pytest.mark.parametrize("algorithm", sorted(td.compression_algorithms))
+def test_compressed_roundtrip(algorithm):
+    packets = [
+        td.PacketUpload(file="/tmp/config", content=b"key = value\n" * 1000),
+        td.PacketUpload(file="/tmp/random", content=os.urandom(100000)),
+        td.PacketStat(path="/tmp"),
+    ]
+    out = io.BytesIO()
+    conn = td.Connection(io.BytesIO(), out)
+    conn.compressor.algorithm = algorithm
+    for packet in packets:
+        conn.write_packet(packet)
+    data = out.getvalue()
+    # Only the compressible packet is compressed
+    assert len(data) < sum(len(p._encode()) + 8 for p in packets) - 10000
+    assert len(data) > 100000
+
+    conn = td.Connection(io.BytesIO(data), io.BytesIO())
+    for packet in packets:
+        assert td.receive_packet(conn) == packet
+
+def test_compressor_skips():
+    compressor = td._Compressor()
+    assert compressor.compress(b"a" * 10000) is None
+    compressor.algorithm = "zlib"
+    assert compressor.compress(b"a" * 10000) is not None
+    assert compressor.compress(b"a" * (td.compression_threshold - 1)) is None
+    assert compressor.compress(os.urandom(10000)) is None
+    assert compressor.compress(os.urandom(100000)) is None
+
+@pytest.mark.parametrize("mmap_threshold", [0, 1 << 30])
+def test_sha512_file(tmp_path, monkeypatch, mmap_threshold):
+    monkeypatch.setattr(td, "hash_mmap_threshold", mmap_threshold)
+    monkeypatch.setattr(td, "hash_chunk_size", 4096)
+    for n in [0, 1, 4096, 100000]:
+        content = os.urandom(n)
+        path = tmp_path / f"file{n}"
+        path.write_bytes(content)
+        assert td._sha512_file(str(path)) == hashlib.sha512(content).digest()
+
+def test_digest_cache(tmp_path, monkeypatch):
+    cache_path = str(tmp_path / "cache" / "digests")
+    a = tmp_path / "a"
+    b = tmp_path / "b"
+    a.write_bytes(b"a")
+    b.write_bytes(b"b")
+
+    # Recently modified files are not cached
+    cache = td._DigestCache(cache_path)
+    cache.put(os.stat(a), b"x" * 64)
+    assert cache.get(os.stat(a)) is None
+
+    monkeypatch.setattr(td._DigestCache, "racy_window_ns", 0)
+    cache1 = td._DigestCache(cache_path)
+    cache2 = td._DigestCache(cache_path)
+    cache1.put(os.stat(a), b"1" * 64)
+    cache2.put(os.stat(b), b"2" * 64)
+    cache1.save()
+    cache2.save()
+
+    # Concurrent caches merge their entries, and the digest cache is consulted before hashing
+    cache = td._DigestCache(cache_path)
+    assert cache.get(os.stat(a)) == b"1" * 64
+    assert cache.get(os.stat(b)) == b"2" * 64
+    assert td._file_digest(str(a), os.stat(a), cache) == b"1" * 64
+    assert td._file_digest(str(a), os.stat(a), None) == hashlib.sha512(b"a").digest()
+
+    # Modified files are hashed again
+    a.write_bytes(b"aa")
+    assert td._file_digest(str(a), os.stat(a), cache) == hashlib.sha512(b"aa").digest()
+    assert cache.get(os.stat(a)) == hashlib.sha512(b"aa").digest()
+
+def test_session_caches(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    def session(request: td.PacketCheckAlive) -> td.Connection:
+        conn = td.Connection(io.BytesIO(), io.BytesIO())
+        request.handle(conn)
+        return conn
+
+    # A daemon serves sessions with different settings, which must not affect each other
+    first = session(td.PacketCheckAlive(digest_cache=True, blob_store_size=td.u64(1 << 20)))
+    second = session(td.PacketCheckAlive())
+    third = session(td.PacketCheckAlive(digest_cache=True, blob_store_size=td.u64(1 << 10)))
+    assert first.session.digest_cache is not None and first.session.blob_store is not None
+    assert second.session.digest_cache is None and second.session.blob_store is None
+    # The digest cache is shared between the sessions that enabled it
+    assert third.session.digest_cache is first.session.digest_cache
+    assert third.session.blob_store is not None and third.session.blob_store.max_size == 1 << 10
+
+def test_user_database(tmp_path, monkeypatch):
+    watched = tmp_path / "passwd"
+    watched.write_text("a")
+    monkeypatch.setattr(td._UserDatabase, "watched_files", [str(watched)])
+    db = td._UserDatabase()
+
+    calls = []
+    def lookup(key):
+        calls.append(key)
+        if key == "missing":
+            raise KeyError(key)
+        return key.upper()
+
+    assert db._lookup(lookup, "x") == "X"
+    assert db._lookup(lookup, "x") == "X"
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            db._lookup(lookup, "missing")
+    assert calls == ["x", "missing"]
+
+    # Modifying a watched file or invalidating discards the cache
+    os.utime(watched, ns=(0, 0))
+    assert db._lookup(lookup, "x") == "X"
+    db.invalidate()
+    assert db._lookup(lookup, "x") == "X"
+    assert calls == ["x", "missing", "x", "x"]
+
+def test_dispatcher_burst(monkeypatch):
+    monkeypatch.setattr(fora, "args", SimpleNamespace(debug=False))
+    workers = 4
+    barrier = threading.Barrier(workers, timeout=5)
+    results: list[bool] = []
+    class Wait:
+        def handle(self, conn):
+            _ = conn
+            try:
+                barrier.wait()
+                results.append(True)
+            except threading.BrokenBarrierError:
+                results.append(False)
+    class Noop:
+        def handle(self, conn):
+            _ = conn
+
+    dispatcher = td._Dispatcher(td.Connection(io.BytesIO(), io.BytesIO()), workers)
+    dispatcher.submit(td.u32(1), td.u32(1), Noop())
+    while dispatcher.idle_workers == 0:
+        threading.Event().wait(0.01)
+    # A burst of requests on different channels is spread over new workers,
+    # even though the first of them was handed to the idle worker
+    for i in range(workers):
+        dispatcher.submit(td.u32(2 + i), td.u32(2 + i), Wait())
+    dispatcher.shutdown()
+    assert results == [True] * workers
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="requires root to create files owned by another user")
+def test_upload_file_ownership(tmp_path, monkeypatch):
+    path = tmp_path / "file"
+    path.write_bytes(b"old")
+    os.chown(path, 1234, 1234)
+    os.chmod(path, 0o664)
+
+    # The ownership of an existing file is kept when it is replaced
+    upload = td._UploadFile(str(path), None, -1, -1)
+    upload.write(b"replaced")
+    assert upload.finish(None)
+    st = os.stat(path)
+    assert (st.st_uid, st.st_gid, st.st_mode & 0o777) == (1234, 1234, 0o664)
+    assert path.read_bytes() == b"replaced"
+
+    # Without the privilege to keep the ownership, the file is written in-place
+    ino = st.st_ino
+    def fchown(fd, uid, gid):
+        raise PermissionError(1, "Operation not permitted")
+    monkeypatch.setattr(os, "fchown", fchown)
+    upload = td._UploadFile(str(path), None, -1, -1)
+    upload.write(b"in-place")
+    assert upload.finish(None)
+    st = os.stat(path)
+    assert (st.st_ino, st.st_uid, st.st_gid, st.st_mode & 0o777) == (ino, 1234, 1234, 0o664)
+    assert path.read_bytes() == b"in-place"
+    assert os.listdir(tmp_path) == ["file"]
+
+def test_blob_store_digest(tmp_path):
+    store = td._BlobStore(str(tmp_path / "blobs"), 1 << 20)
+    (tmp_path / "file").write_bytes(b"content")
+    # Content that doesn't match the digest, e.g. because the file was changed in the meantime, isn't stored
+    store.add(str(tmp_path / "file"), hashlib.sha512(b"other").digest())
+    assert not store.has(hashlib.sha512(b"other").digest())
+    store.add(str(tmp_path / "file"), hashlib.sha512(b"content").digest())
+    blob = store.open(hashlib.sha512(b"content").digest())
+    assert blob is not None
+    with blob:
+        assert blob.read() == b"content"
+    assert [f for f in os.listdir(tmp_path / "blobs") if not f.startswith(".lock")] == [hashlib.sha512(b"content").hexdigest()]
+
+def test_clone_file(tmp_path):
+    content = os.urandom(3 << 20)
+    (tmp_path / "src").write_bytes(content)
+    with open(tmp_path / "src", "rb") as src, open(tmp_path / "dst", "wb") as dst:
+        td._clone_file(src.fileno(), dst.fileno())
+    assert (tmp_path / "dst").read_bytes() == content
+
+# Imports the dispatcher like a remote host does (without fora on the path) and answers
+# a PacketCheckAlive, then reports the modules that were imported on this path.
+STARTUP_SCRIPT = """
+import io, sys
+sys.path.insert(0, sys.argv[1])
+import tunnel_dispatcher as td
+out = io.BytesIO()
+request = td._struct_frame_header.pack(1, 1) + td.PacketCheckAlive(compression=["zlib"])._encode() + td._struct_frame_header.pack(0, 2) + td.PacketExit()._encode()
+td.is_server = True
+td._serve(td.Connection(io.BytesIO(request), out))
+assert td.receive_frame(td.Connection(io.BytesIO(out.getvalue()), io.BytesIO()))[2] == td.PacketAck(compression="zlib")
+print(" ".join(sorted(sys.modules)))
+"""
+
+# Modules that are only needed by some packets and must not be imported before they are used
+LAZY_MODULES = ["concurrent", "copy", "fcntl", "hashlib", "logging", "lzma", "mmap", "socket", "spwd", "subprocess", "tempfile", "traceback"]
+
+# Public top-level modules that the startup path may import in addition to those of the bare interpreter
+EAGER_MODULES = {"collections", "contextlib", "copyreg", "enum", "errno", "functools", "genericpath", "grp", "itertools",
+                 "keyword", "operator", "os", "posixpath", "pwd", "re", "reprlib", "stat", "struct", "threading",
+                 "tunnel_dispatcher", "types", "typing", "warnings", "zlib"}
+
+STARTUP_BUDGET = 10
+"""Budget for importing the dispatcher with cached bytecode, as a multiple of the time it takes to
+start a bare interpreter, so that it doesn't depend on the speed of the machine. Typically takes less than half of this."""
+
+def best_time(command: list[str], env: dict[str, str]) -> float:
+    """Returns the shortest wall-clock time of three runs of the given command."""
+    times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def test_startup(tmp_path):
+    shutil.copy(td.__file__, tmp_path / "tunnel_dispatcher.py")
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    command = [sys.executable, "-S", "-X", "importtime", "-c", STARTUP_SCRIPT, str(tmp_path)]
+    bare = subprocess.run([sys.executable, "-S", "-c", "import io, sys; print(' '.join(sys.modules))"], env=env, check=True, capture_output=True, text=True)
+
+    # The first run compiles the bytecode
+    subprocess.run(command, env=env, check=True, capture_output=True)
+    result = subprocess.run(command, env=env, check=True, capture_output=True, text=True)
+    imported = set(result.stdout.split()) - set(bare.stdout.split())
+    assert not any(module.split(".")[0] in LAZY_MODULES for module in imported)
+    assert {module.split(".")[0] for module in imported if not module.startswith("_")} <= EAGER_MODULES
+
+    # The import time depends on the machine, so it is compared to the startup of a bare interpreter
+    bare_us = best_time([sys.executable, "-S", "-c", "import io, sys"], env) * 1e6
+    cumulative = []
+    for _ in range(3):
+        result = subprocess.run(command, env=env, check=True, capture_output=True, text=True)
+        cumulative.append(next(int(line.split("|")[1]) for line in result.stderr.splitlines() if line.endswith("| tunnel_dispatcher")))
+    print(f"importing the tunnel dispatcher took {min(cumulative)} us, starting a bare interpreter {bare_us:.0f} us")
+    assert min(cumulative) < STARTUP_BUDGET * bare_us
+
+def test_writev_all():
+    r, w = os.pipe()
+    parts = [b"", b"header", b"", os.urandom(1 << 20), memoryview(b"tail"), b""]
+    received = []
+    def read_all():
+        with os.fdopen(r, "rb") as f:
+            received.append(f.read())
+    reader = threading.Thread(target=read_all)
+    reader.start()
+    # The pipe buffer is smaller than the payload, so partial writes occur
+    td._writev_all(w, list(parts))
+    os.close(w)
+    reader.join()
+    assert received == [b"".join(parts)]
+
+def test_batched_writes():
+    r, w = os.pipe()
+    with os.fdopen(r, "rb") as buffer_in, os.fdopen(w, "wb") as buffer_out:
+        conn = td.Connection(io.BytesIO(), buffer_out)
+        assert conn.output.fd == w
+        os.set_blocking(r, False)
+
+        # Packets of a batch are only written when flushed
+        view = conn.for_request(td.u32(1), td.u32(1))
+        view.flush_writes = False
+        for i in range(3):
+            view.write_packet(td.PacketUploadChunk(stream=td.u32(i), data=b"x" * 100))
+        assert buffer_in.read() is None
+        conn.flush()
+
+        reader = td.Connection(buffer_in, io.BytesIO())
+        for i in range(3):
+            assert td.receive_frame(reader) == (1, 1, td.PacketUploadChunk(stream=td.u32(i), data=b"x" * 100))
+
+        # Large batches are written before they are flushed
+        os.set_blocking(r, True)
+        received = []
+        thread = threading.Thread(target=lambda: received.append(td.receive_frame(reader)[2]))
+        thread.start()
+        view.write_packet(td.PacketUploadChunk(stream=td.u32(7), data=b"x" * td._Output.flush_threshold))
+        thread.join(timeout=10)
+        assert received[0].stream == 7